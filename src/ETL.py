@@ -1,11 +1,19 @@
+import hashlib
 import logging
 import os
-from azure.storage.blob import (
-    BlobServiceClient,
-    __version__,
-)
+from functools import partial
+from typing import Optional
 from dotenv import load_dotenv
+from src.blob_transfer import Blob_transfer
 from src.data_processing import Data_processing
+from src.manifest import Run_manifest, file_sha256, month_key_of_file
+from src.metrics import pipeline_metrics
+from src.storage_backend import Blob_info, create_storage_backend
+from src.file_formats import (
+    FILE_EXTENSIONS,
+    dataframe_to_bytes,
+    transformed_file_name,
+)
 
 
 load_dotenv()
@@ -33,34 +41,238 @@ class ETL:
     Takes raw data from raw_data folder, cleans and applies transformations and saves it to transformed_data folder.
 
     ::Parameters::
-    :: None
+    :: storage_backend   : azure or local (see storage_backend), STORAGE_BACKEND env variable or azure if None
+    :: local_storage_path: folder of the local backend, LOCAL_STORAGE_PATH env variable or data/blob_storage if None
+    :: connection_string : azure storage connection string, AZURE_STORAGE_CONNECTION_STRING env variable is used if None.
+                           "UseDevelopmentStorage=true" connects to a local Azurite emulator.
+    :: max_workers       : number of files transferred at the same time
+    :: retries           : retries per file before the transfer fails
+    :: backoff_seconds   : wait before the first retry (doubled for every next one)
+    :: max_concurrency   : connections used for a single large blob
+    :: download_chunk_size: bytes requested per GET when streaming a blob to disk
+    :: compression       : gzip or zstd compresses csv blobs while they are uploaded and sets their content-encoding,
+                           None uploads plain files. Parquet / arrow files are compressed internally and sent as they are.
+    :: compression_level : gzip (1-9) or zstd (1-22) level, default of the codec if None
+    :: block_upload      : uploads files as blocks of block_size staged in parallel and journaled in data/upload_journal,
+                           a failed or interrupted upload resumes with the missing blocks only (see block_upload)
+    :: block_size        : bytes of a local file per block
+    :: keep_downloads_compressed: raw blobs with a content-encoding are saved as .csv.gz / .csv.zst
+                           and read compressed by Data_processing, instead of being decompressed while downloading
+
+    Settings from connection_string to block_size are used by the azure backend only.
 
     :: IMPORTANT::
-    : It is required to have access to azure servers.
+    : The azure backend requires access to azure servers (or Azurite).
     :: Requirements ::
     :Azure_storage_connection_string :
 
     :: Functions ::
 
+    :: upload_single_file       : -> uploads single local file to blob storage (used for batch uploads)
+    :: download_single_blob     : -> downloads single blob to local folder (used for batch extractions)
+    :: upload_single_data       : -> uploads bytes held in memory to blob storage
+    :: open_blob_stream         : -> opens blob as a binary stream read while it downloads
     :: upload_raw_data_to_azure : -> stores raw taxi data from raw_data folder to azure blob storage
-    :: extract_singe_blob       : -> extracts single blob from azure blob storage (used for batch extractions)
+    :: upload_raw_month_to_azure: -> stores raw file of a single month and removes it from raw_data folder
     :: extract_raw_taxi_data_from_azure: -> extracts all raw taxi data from azure
     :: transform_raw_data       : -> transforms raw data using Data_processing class
     :: upload_transformed_data_to_azure: -> uploads transformed data to azure blob storage
+    :: upload_transformed_dataframe_to_azure: -> uploads transformed dataframe from memory to azure blob storage
     :: extract_transformed_data_from_azure: -> extracts all transformed data from azure blob storage
     :: delete blob              : -> deletes blob from azure blob storage
+    :: delete_other_formats_of_transformed_blob: -> deletes transformed blobs of a month saved in other formats
+    :: get_blob_etag            : -> returns etag of the blob
+    :: is_upload_unchanged      : -> checks manifest whether the same content is already uploaded
+    :: is_extracted             : -> checks manifest whether the same blob version is already downloaded
+    :: record_upload            : -> checkpoints an uploaded file in the manifest
+    :: record_download          : -> checkpoints a downloaded blob in the manifest
+    :: raw_fingerprint          : -> returns manifest fingerprint of extracted raw month
     :: delete_container         : -> deletes container with predefined name in function
 
     return:: None
 
     """
 
-    def __init__(self) -> None:
-        self.connection = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-        self.blob_service_client = BlobServiceClient.from_connection_string(
-            self.connection
+    def __init__(
+        self,
+        connection_string: Optional[str] = None,
+        max_workers: int = 4,
+        retries: int = 3,
+        backoff_seconds: float = 1.0,
+        max_concurrency: int = 4,
+        download_chunk_size: int = 4 * 1024 * 1024,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+        keep_downloads_compressed: bool = False,
+        block_upload: bool = False,
+        block_size: int = 8 * 1024 * 1024,
+        storage_backend: Optional[str] = None,
+        local_storage_path: Optional[str] = None,
+    ) -> None:
+        self.storage_backend = storage_backend or os.getenv("STORAGE_BACKEND", "azure")
+        if self.storage_backend == "local":
+            settings = {"root": local_storage_path}
+        else:
+            settings = {
+                "connection_string": connection_string,
+                "max_concurrency": max_concurrency,
+                "download_chunk_size": download_chunk_size,
+                "compression": compression,
+                "compression_level": compression_level,
+                "keep_downloads_compressed": keep_downloads_compressed,
+                "block_upload": block_upload,
+                "block_size": block_size,
+            }
+        self.storage = create_storage_backend(self.storage_backend, **settings)
+        self.blob_transfer = Blob_transfer(
+            max_workers=max_workers,
+            retries=retries,
+            backoff_seconds=backoff_seconds,
+            max_concurrency=max_concurrency,
         )
 
+    def upload_single_file(
+        self, container_name: str, upload_file_path: str, blob_name: str
+    ):
+        """
+        Uploads single local file to blob storage (see upload_file of the storage backend).
+
+        :param container_name:-> name of the container in blob storage
+        :param upload_file_path:-> path of the local file
+        :param blob_name:-> name of the blob to create or overwrite
+
+        return:: properties of the uploaded blob (etag, last_modified)
+        """
+        return self.storage.upload_file(container_name, upload_file_path, blob_name)
+
+    def upload_single_data(self, container_name: str, data: bytes, blob_name: str):
+        """
+        Uploads bytes held in memory to blob storage, used when data is not staged in local files.
+
+        :param container_name:-> name of the container in blob storage
+        :param data:-> content of the blob
+        :param blob_name:-> name of the blob to create or overwrite
+
+        return:: properties of the uploaded blob (etag, last_modified)
+        """
+        return self.storage.upload_data(container_name, data, blob_name)
+
+    def open_blob_stream(self, container_name: str, blob_name: str):
+        """
+        Opens blob as a read-only binary stream, so eg. pandas can parse a raw month straight from blob storage
+        without a local file. Azure blobs are downloaded chunk by chunk while the stream is read.
+
+        :param container_name:-> name of the container in blob storage
+        :param blob_name:-> name of the blob to read
+
+        return:: binary file-like object
+        """
+        stream = self.storage.open_blob_stream(container_name, blob_name)
+        logger.debug(f"{blob_name} opened as a stream")
+        return stream
+
+    def download_single_blob(
+        self, container_name: str, blob: Blob_info, local_blob_path: str
+    ):
+        """
+        Downloads single blob from blob storage to local folder (see download_file of the storage backend).
+        Downloads are written to ".part" files and renamed when complete.
+
+        :param container_name:-> name of the container in blob storage
+        :param blob:-> listed blob to download
+        :param local_blob_path:-> local folder to save the blob to
+
+        return:: None
+        """
+        try:
+            self.storage.download_file(container_name, blob, local_blob_path)
+            logger.debug(f"{blob.name} was saved to {local_blob_path}")
+        except:
+            logger.exception(
+                f"there was a problem reaching single {blob.name} at {local_blob_path}"
+            )
+            raise
+
+    def get_blob_etag(self, container_name: str, blob_name: str) -> Optional[str]:
+        """
+        Returns etag of the blob, None if the blob does not exist.
+        """
+        return self.storage.get_blob_etag(container_name, blob_name)
+
+    def is_upload_unchanged(
+        self,
+        manifest: Run_manifest,
+        stage: str,
+        container_name: str,
+        blob_name: str,
+        fingerprint: str,
+    ) -> bool:
+        """
+        True if the same content was uploaded before and the blob was not changed since.
+
+        :param manifest:-> run manifest
+        :param stage:-> upload stage recorded in the manifest
+        :param container_name:-> name of the container in azure blob storage
+        :param blob_name:-> name of the uploaded blob
+        :param fingerprint:-> sha256 of the local file
+        """
+        month_key = month_key_of_file(blob_name)
+        if not manifest.is_unchanged(stage, month_key, fingerprint):
+            return False
+        recorded_etag = manifest.get(stage, month_key)["etag"]
+        return self.get_blob_etag(container_name, blob_name) == recorded_etag
+
+    def is_extracted(
+        self,
+        manifest: Run_manifest,
+        stage: str,
+        local_blob_path: str,
+        blob_name: str,
+        etag: str,
+        local_file_name: Optional[str] = None,
+    ) -> bool:
+        """
+        True if this version (etag) of the blob was already downloaded by an interrupted run and is still on disk.
+        Downloads are renamed from ".part" files only when complete, so an existing file is never truncated.
+        local_file_name is the name on disk if it differs from blob_name (blob kept compressed).
+        """
+        return os.path.exists(
+            os.path.join(local_blob_path, local_file_name or blob_name)
+        ) and manifest.is_unchanged(stage, month_key_of_file(blob_name), etag)
+
+    def record_upload(
+        self,
+        manifest: Optional[Run_manifest],
+        stage: str,
+        fingerprints: dict,
+        blob_name: str,
+        result: dict,
+    ) -> None:
+        """
+        Checkpoints a single uploaded file in the manifest (used as on_result of Blob_transfer.run).
+        """
+        if manifest is not None:
+            manifest.record(
+                stage,
+                month_key_of_file(blob_name),
+                fingerprints[blob_name],
+                etag=result["etag"],
+            )
+
+    def record_download(
+        self,
+        manifest: Optional[Run_manifest],
+        stage: str,
+        etags: dict,
+        blob_name: str,
+        result,
+    ) -> None:
+        """
+        Checkpoints a single downloaded blob in the manifest (used as on_result of Blob_transfer.run).
+        """
+        if manifest is not None:
+            manifest.record(stage, month_key_of_file(blob_name), etags[blob_name])
+
     def delete_container(self, container_name: str):
         """
         Deletes container from azure blob storage.
@@ -70,11 +282,7 @@ class ETL:
         return:: None
         """
         try:
-            my_container = self.blob_service_client.get_container_client(
-                container=container_name
-            )
-            logger.debug(f"successfully connected to {container_name}")
-            my_container.delete_container()
+            self.storage.delete_container(container_name)
             logger.debug("container successfully deleted")
         except ConnectionError or ValueError:
             logger.exception(
@@ -84,53 +292,76 @@ class ETL:
             logger.info("Container {container_name} was successfuly deleted")
 
     def upload_raw_data_to_azure(
-        self, start_month: int, end_month: int, year: str = "2021"
+        self,
+        start_month: int,
+        end_month: int,
+        year: str = "2021",
+        manifest: Optional[Run_manifest] = None,
     ):
         """
         Uploads raw data from local raw_data folder to azure blob storage.
+        With a manifest, files with the same content as the last upload are skipped.
 
         param: start_month:-> first month of dataset (tipically 1)
         param: end_month:-> last month of dataset (tipically 12) in this case 7
         param: year:-> str value set to 2021
+        param: manifest:-> run manifest for incremental runs, every file is uploaded if None
 
         return:: None
         """
         try:
             container_name = "raw-yellow-taxi-data"
-            try:
-                self.blob_service_client.create_container(container_name)
-                logger.debug("container created successfully")
-
-            except:
-                logger.info("Table was already created!")
-            else:
-                self.blob_service_client.get_container_client(container_name)
-                logger.info("container existed, client will be retrieved")
+            self.storage.create_container(container_name)
+            logger.debug(f"container {container_name} is ready")
 
             raw_data_file_path = "data/raw_data"
             months = [str(i).zfill(2) for i in range(start_month, end_month + 1)]
 
+            transfers = {}
+            fingerprints = {}
             for month in months:
-
                 temp_filename = f"yellow_tripdata_{year}-" + str(month) + ".csv"
-                blob_client = self.blob_service_client.get_blob_client(
-                    container=container_name, blob=temp_filename
-                )
-                logger.debug("blob client created")
-
-                # uploads data to azure
                 upload_file_path = os.path.join(raw_data_file_path, temp_filename)
-                with open(upload_file_path, "rb") as data:
-                    blob_client.upload_blob(data, overwrite=True)
+                if manifest is not None:
+                    if not os.path.exists(upload_file_path) and manifest.get(
+                        "raw_upload", month_key_of_file(temp_filename)
+                    ):
+                        # uploaded and removed by an earlier (interrupted) run
+                        logger.info(f"{temp_filename} was already uploaded, skipped")
+                        continue
+                    fingerprints[temp_filename] = file_sha256(upload_file_path)
+                    if self.is_upload_unchanged(
+                        manifest,
+                        "raw_upload",
+                        container_name,
+                        temp_filename,
+                        fingerprints[temp_filename],
+                    ):
+                        logger.info(f"{temp_filename} did not change, upload skipped")
+                        continue
+                transfers[temp_filename] = partial(
+                    self.upload_single_file,
+                    container_name,
+                    upload_file_path,
+                    temp_filename,
+                )
 
-                logger.debug(
-                    f"master, problem uploading {temp_filename} to container {container_name}"
+            # uploads data to azure, files are sent in parallel
+            with pipeline_metrics.stage("raw_upload", files=len(transfers)) as metrics:
+                metrics["bytes"] = sum(
+                    os.path.getsize(os.path.join(raw_data_file_path, file_name))
+                    for file_name in transfers
                 )
-                logger.info(
-                    f"{temp_filename} was succesfully moved to {container_name}"
+                # every uploaded file is checkpointed at once, so an interrupted run does not send it again
+                self.blob_transfer.run(
+                    transfers,
+                    on_result=partial(
+                        self.record_upload, manifest, "raw_upload", fingerprints
+                    ),
                 )
+            logger.info(f"{list(transfers)} were succesfully moved to {container_name}")
 
-        except ConnectionRefusedError:
+        except ConnectionError:
             logger.exception("there was a problem with connection or path provided")
         else:
             # removes files after upload is compleated.
@@ -141,51 +372,114 @@ class ETL:
                 "Raw data was successfully transfered and deleted from data/raw folder."
             )
 
-    def extract_single_taxi_blob(
-        self, file_name: str, file_content, local_blob_path: str
-    ):
+    def upload_raw_month_to_azure(
+        self, year, month: str, manifest: Optional[Run_manifest] = None
+    ) -> Optional[str]:
         """
-        writes single blob from azure blob storage. used in other functions for bulk extraction.
+        Uploads raw file of a single month from local raw_data folder to azure blob storage and removes only that file,
+        so other months can still wait for their turn (used by the pipelined run).
+        With a manifest, a file with the same content as the last upload is not sent again.
 
-        :param file_name:-> title of the csv file to retreive.
-        :param local_blob_path:-> path to the blob on the device.
+        param: year:-> year of the data
+        param: month:-> two digit str representation of a month, eg. 01, 02
+        param: manifest:-> run manifest for incremental runs, the file is always uploaded if None
 
-        return:: None
+        return:: etag of the raw blob, None if there is neither a local file nor a blob
         """
-        try:
-            download_file_path = os.path.join(local_blob_path, file_name)
-
-            with open(download_file_path, "wb") as file:
-                file.write(file_content)
-            logger.debug("There was a problem extracting single taxi blob")
-        except:
-            logger.exception(
-                f"there was a problem reaching single {file_name} at {local_blob_path}"
+        container_name = "raw-yellow-taxi-data"
+        self.storage.create_container(container_name)
+
+        file_name = f"yellow_tripdata_{year}-{month}.csv"
+        upload_file_path = os.path.join("data/raw_data", file_name)
+        if not os.path.exists(upload_file_path):
+            # uploaded and removed by an earlier run
+            logger.info(f"{file_name} is not in data/raw_data, blob is used as it is")
+            return self.get_blob_etag(container_name, file_name)
+
+        month_key = f"{year}-{month}"
+        fingerprint = None
+        if manifest is not None:
+            fingerprint = file_sha256(upload_file_path)
+            if self.is_upload_unchanged(
+                manifest, "raw_upload", container_name, file_name, fingerprint
+            ):
+                logger.info(f"{file_name} did not change, upload skipped")
+                os.remove(upload_file_path)
+                return manifest.get("raw_upload", month_key)["etag"]
+
+        with pipeline_metrics.stage(
+            "raw_upload",
+            month_key=month_key,
+            files=1,
+            bytes=os.path.getsize(upload_file_path),
+        ):
+            results = self.blob_transfer.run(
+                {
+                    file_name: partial(
+                        self.upload_single_file,
+                        container_name,
+                        upload_file_path,
+                        file_name,
+                    )
+                }
             )
-
-    def extract_raw_taxi_data_from_azure(self):
+        etag = results[file_name]["etag"]
+        if manifest is not None:
+            manifest.record("raw_upload", month_key, fingerprint, etag=etag)
+        os.remove(upload_file_path)
+        logger.info(f"{file_name} was moved to {container_name} and removed locally")
+        return etag
+
+    def extract_raw_taxi_data_from_azure(self, manifest: Optional[Run_manifest] = None):
         """
         Extracts all raw taxi data from azure blob storage.
+        With a manifest, blobs which were already transformed in the same version (etag) are skipped.
 
-        :param: None
+        :param: manifest:-> run manifest for incremental runs, every blob is extracted if None
         return: None
         """
         try:
-            my_container = self.blob_service_client.get_container_client(
-                "raw-yellow-taxi-data"
-            )
-            list_of_blobs = my_container.list_blobs()
+            list_of_blobs = self.storage.list_blobs("raw-yellow-taxi-data")
             local_blob_path = "data/extracted_from_azure_raw"
 
+            transfers = {}
+            etags = {}
+            blob_sizes = {}
             for blob in list_of_blobs:
-                single_csv_file = (
-                    my_container.get_blob_client(blob).download_blob().readall()
+                if manifest is not None and manifest.is_unchanged(
+                    "transform", month_key_of_file(blob.name), blob.etag
+                ):
+                    logger.info(f"{blob.name} was already transformed, skipped")
+                    continue
+                if manifest is not None and self.is_extracted(
+                    manifest,
+                    "raw_extract",
+                    local_blob_path,
+                    blob.name,
+                    blob.etag,
+                    self.storage.local_file_name("raw-yellow-taxi-data", blob),
+                ):
+                    logger.info(f"{blob.name} was already extracted, skipped")
+                    continue
+                etags[blob.name] = blob.etag
+                blob_sizes[blob.name] = blob.size
+                transfers[blob.name] = partial(
+                    self.download_single_blob,
+                    "raw-yellow-taxi-data",
+                    blob,
+                    local_blob_path,
                 )
-                self.extract_single_taxi_blob(
-                    blob.name, single_csv_file, local_blob_path
+            with pipeline_metrics.stage(
+                "raw_extract", files=len(transfers), bytes=sum(blob_sizes.values())
+            ):
+                self.blob_transfer.run(
+                    transfers,
+                    on_result=partial(
+                        self.record_download, manifest, "raw_extract", etags
+                    ),
                 )
 
-            logger.info(f"blob was successfuly extracted")
+            logger.info(f"blobs {list(transfers)} were successfuly extracted")
         except ConnectionError:
             logger.exception(
                 "there was an error while extracting raw taxi data from azure, master"
@@ -195,21 +489,90 @@ class ETL:
                 "ALL files were SUCCESSFULLY moved from blob storage -> machine"
             )
 
-    def transform_raw_data(self, start_month: int, end_month: int, year: int):
+    def transform_raw_data(
+        self,
+        start_month: int,
+        end_month: int,
+        year: int,
+        chunk_size: Optional[int] = None,
+        workers: int = 1,
+        output_format: str = "csv",
+        manifest: Optional[Run_manifest] = None,
+        fused_cleaning: bool = False,
+        csv_engine: str = "inferred",
+        compact: bool = False,
+    ):
         """
         Transforms data using Data_processing class.
+        With a manifest, only months with extracted raw data are transformed (others did not change).
 
         :param start_month:-> first month (int 1/2/3 etc.) to start transformations.
         :param end_month:-> last month (int (1/2/3/ etc)) to end transformations.
         :param year:-> year (int) of datasets to be used.
+        :param chunk_size:-> rows per chunk for streaming transformation (None reads whole months).
+        :param workers:-> number of processes transforming months in parallel.
+        :param output_format:-> format of transformed files: csv, parquet or arrow.
+        :param manifest:-> run manifest for incremental runs, every month is transformed if None
+        :param fused_cleaning:-> applies all cleaning rules as a single mask (see Data_processing.clean_dataframe_fused)
+        :param csv_engine:-> reader of raw csv files: inferred, typed or pyarrow (see raw_schema)
+        :param compact:-> stores parquet / arrow files in compact layout (see compact_trips)
 
         return:: None
         """
 
         try:
-            data_processing = Data_processing(start_month, end_month, year)
+            data_processing = Data_processing(
+                start_month,
+                end_month,
+                year,
+                chunk_size=chunk_size,
+                workers=workers,
+                output_format=output_format,
+                fused_cleaning=fused_cleaning,
+                csv_engine=csv_engine,
+                compact=compact,
+            )
             logger.debug("data processing class loaded successfully")
-            data_processing.run()
+            if manifest is not None:
+                data_processing.months = [
+                    month
+                    for month in data_processing.months
+                    if os.path.exists(data_processing.raw_file_path(month))
+                ]
+                raw_fingerprints = {
+                    month: self.raw_fingerprint(manifest, data_processing, month)
+                    for month in data_processing.months
+                }
+                # months transformed by an interrupted run before their raw files were removed
+                for month in list(data_processing.months):
+                    if manifest.is_unchanged(
+                        "transform", f"{year}-{month}", raw_fingerprints[month]
+                    ):
+                        logger.info(f"{year}-{month} was already transformed, skipped")
+                        data_processing.months.remove(month)
+                logger.info(f"months {data_processing.months} will be transformed")
+
+            def record_transform(month: str, rows_saved: int) -> None:
+                if manifest is not None:
+                    manifest.record(
+                        "transform",
+                        f"{year}-{month}",
+                        raw_fingerprints[month],
+                        rows=rows_saved,
+                    )
+
+            with pipeline_metrics.stage(
+                "transform", months=len(data_processing.months), workers=workers
+            ) as metrics:
+                # every month is checkpointed as soon as it is saved
+                data_processing.run(on_month_saved=record_transform)
+                metrics["rows_in"] = sum(data_processing.rows_read.values())
+                metrics["rows_out"] = sum(data_processing.month_results.values())
+            if data_processing.month_failures:
+                # keeps extracted raw data so failed months can be transformed again
+                raise ValueError(
+                    f"months {sorted(data_processing.month_failures)} were not transformed"
+                )
 
         except ValueError:
             logger.exception(
@@ -224,49 +587,92 @@ class ETL:
                 "All files were successfuly transformed and extracted raw data removed."
             )
 
+    def raw_fingerprint(
+        self, manifest: Run_manifest, data_processing: Data_processing, month: str
+    ) -> str:
+        """
+        Returns etag of the extracted raw blob of the month, or sha256 of the raw file if it was not extracted by this ETL.
+        """
+        entry = manifest.get("raw_extract", f"{data_processing.year}-{month}")
+        if entry is not None:
+            return entry["fingerprint"]
+        return file_sha256(data_processing.raw_file_path(month))
+
     def upload_transformed_data_to_azure(
-        self, start_month: int, end_month: int, year: int
+        self,
+        start_month: int,
+        end_month: int,
+        year: int,
+        output_format: str = "csv",
+        manifest: Optional[Run_manifest] = None,
     ):
         """
-        Uploads transformed data from local transformed_data folder to azure blob storage
+        Uploads transformed data from local transformed_data folder to azure blob storage.
+        Blobs of the same month saved in other formats by earlier runs are removed, so only one copy is extracted later.
 
         :param start_month:-> first month (int 1/2/3 etc.) to start transformations.
         :param end_month:-> last month (int (1/2/3/ etc)) to end transformations.
         :param year:-> year (int) of datasets to be used.
+        :param output_format:-> format the data was transformed to: csv, parquet or arrow.
+        :param manifest:-> run manifest for incremental runs. Only months transformed in this run are uploaded,
+                           and only if their content changed.
 
         return:: None
 
         """
         try:
             container_name = "transformed-yellow-taxi-data"
-            try:
-                self.blob_service_client.create_container(container_name)
-                logger.debug(f"container {container_name} created successfully")
-            except:
-                logger.info("container already exists, container client received")
-            else:
-                self.blob_service_client.get_container_client(container_name)
+            self.storage.create_container(container_name)
+            logger.debug(f"container {container_name} is ready")
 
             raw_data_file_path = "data/transformed_data"
             months = [str(i).zfill(2) for i in range(start_month, end_month + 1)]
 
+            transfers = {}
+            fingerprints = {}
             for month in months:
+                temp_filename = transformed_file_name(year, month, output_format)
+                upload_file_path = os.path.join(raw_data_file_path, temp_filename)
+                if manifest is not None:
+                    if not os.path.exists(upload_file_path):
+                        continue
+                    fingerprints[temp_filename] = file_sha256(upload_file_path)
+                    if self.is_upload_unchanged(
+                        manifest,
+                        "transformed_upload",
+                        container_name,
+                        temp_filename,
+                        fingerprints[temp_filename],
+                    ):
+                        logger.info(f"{temp_filename} did not change, upload skipped")
+                        continue
+                transfers[temp_filename] = partial(
+                    self.upload_single_file,
+                    container_name,
+                    upload_file_path,
+                    temp_filename,
+                )
 
-                temp_filename = (
-                    "clean_yellow_trip_data_" + str(year) + "-" + str(month) + ".csv"
+            with pipeline_metrics.stage(
+                "transformed_upload", files=len(transfers)
+            ) as metrics:
+                metrics["bytes"] = sum(
+                    os.path.getsize(os.path.join(raw_data_file_path, file_name))
+                    for file_name in transfers
                 )
-                logger.debug(f"{temp_filename} has been read")
-                blob_client = self.blob_service_client.get_blob_client(
-                    container=container_name, blob=temp_filename
+                self.blob_transfer.run(
+                    transfers,
+                    on_result=partial(
+                        self.record_upload, manifest, "transformed_upload", fingerprints
+                    ),
                 )
-                logger.debug("blob lcient connection was done successfully")
+            logger.info(
+                f"{list(transfers)} were succesfully inserted to {container_name}"
+            )
 
-                upload_file_path = os.path.join(raw_data_file_path, temp_filename)
-                with open(upload_file_path, "rb") as data:
-                    blob_client.upload_blob(data, overwrite=True)
-                logger.debug(f"inserting {temp_filename} to azure.", exc_info=1)
-                logger.info(
-                    f"{temp_filename} was succesfully inserted to {container_name}"
+            for month in months:
+                self.delete_other_formats_of_transformed_blob(
+                    container_name, year, month, output_format
                 )
         except ConnectionError or ValueError:
             logger.exception(
@@ -282,33 +688,118 @@ class ETL:
                 "ALL files were SUCCESSFULLY moved to transformed azure blob storage and removed from transformed_data folder."
             )
 
-    def extract_transformed_taxi_data_from_azure(self):
+    def upload_transformed_dataframe_to_azure(
+        self,
+        dataframe,
+        year,
+        month: str,
+        output_format: str = "csv",
+        manifest: Optional[Run_manifest] = None,
+        compact: bool = False,
+    ):
+        """
+        Uploads transformed dataframe of a single month straight from memory to azure blob storage.
+        Used by the in-memory pipeline, where transformed data is never saved to transformed_data folder.
+
+        :param dataframe:-> transformed or compact pandas dataframe
+        :param year:-> year of the data.
+        :param month:-> two digit str representation of a month, eg. 01, 02
+        :param output_format:-> format the dataframe is serialised to: csv, parquet or arrow.
+        :param manifest:-> run manifest, etag of the uploaded blob is recorded if given. The same content uploaded before
+                           (eg. by an interrupted run) is not sent again.
+        :param compact:-> stores parquet / arrow blobs in compact layout (see compact_trips)
+
+        return:: etag of the uploaded blob
+        """
+        container_name = "transformed-yellow-taxi-data"
+        self.storage.create_container(container_name)
+
+        blob_name = transformed_file_name(year, month, output_format)
+        with pipeline_metrics.stage(
+            "transformed_upload", month_key=f"{year}-{month}", rows_in=len(dataframe)
+        ) as metrics:
+            data = dataframe_to_bytes(dataframe, output_format, compact=compact)
+            metrics["bytes"] = len(data)
+            fingerprint = hashlib.sha256(data).hexdigest()
+            if manifest is not None and self.is_upload_unchanged(
+                manifest, "transformed_upload", container_name, blob_name, fingerprint
+            ):
+                logger.info(f"{blob_name} did not change, upload skipped")
+                return manifest.get("transformed_upload", f"{year}-{month}")["etag"]
+            results = self.blob_transfer.run(
+                {
+                    blob_name: partial(
+                        self.upload_single_data, container_name, data, blob_name
+                    )
+                }
+            )
+        etag = results[blob_name]["etag"]
+        if manifest is not None:
+            manifest.record(
+                "transformed_upload", f"{year}-{month}", fingerprint, etag=etag
+            )
+        self.delete_other_formats_of_transformed_blob(
+            container_name, year, month, output_format
+        )
+        logger.info(f"{blob_name} was uploaded to {container_name} from memory")
+        return etag
+
+    def extract_transformed_taxi_data_from_azure(
+        self, manifest: Optional[Run_manifest] = None
+    ):
         """
         Extracts all transformed data from azure blob storage to local folder
+        With a manifest, blobs which were already loaded to sql in the same version (etag) are skipped.
 
-        :param: None
+        :param: manifest:-> run manifest for incremental runs, every blob is extracted if None
 
         return:: None
         """
         try:
-            my_container = self.blob_service_client.get_container_client(
-                "transformed-yellow-taxi-data"
-            )
-            logger.debug("container client retreived")
-            list_of_blobs = my_container.list_blobs()
+            list_of_blobs = self.storage.list_blobs("transformed-yellow-taxi-data")
             logger.debug("list of blobs received")
             local_blob_path = "data/extracted_from_azure_transformed"
             logger.debug("local path created for blobs to be extracted")
 
+            transfers = {}
+            etags = {}
+            blob_sizes = {}
             for blob in list_of_blobs:
-                single_csv_file = (
-                    my_container.get_blob_client(blob).download_blob().readall()
+                if manifest is not None and manifest.is_unchanged(
+                    "sql_load", month_key_of_file(blob.name), blob.etag
+                ):
+                    logger.info(f"{blob.name} was already loaded to sql, skipped")
+                    continue
+                if manifest is not None and self.is_extracted(
+                    manifest,
+                    "transformed_extract",
+                    local_blob_path,
+                    blob.name,
+                    blob.etag,
+                ):
+                    logger.info(f"{blob.name} was already extracted, skipped")
+                    continue
+                etags[blob.name] = blob.etag
+                blob_sizes[blob.name] = blob.size
+                transfers[blob.name] = partial(
+                    self.download_single_blob,
+                    "transformed-yellow-taxi-data",
+                    blob,
+                    local_blob_path,
                 )
-                self.extract_single_taxi_blob(
-                    blob.name, single_csv_file, local_blob_path
+            with pipeline_metrics.stage(
+                "transformed_extract",
+                files=len(transfers),
+                bytes=sum(blob_sizes.values()),
+            ):
+                self.blob_transfer.run(
+                    transfers,
+                    on_result=partial(
+                        self.record_download, manifest, "transformed_extract", etags
+                    ),
                 )
-                logger.info(f"blob exctarcted {blob.name}")
-        except ValueError or ConnectionError:
+            logger.info(f"blobs exctarcted {list(transfers)}")
+        except (ValueError, ConnectionError):
             logger.exception(
                 f"there something wrong extracting transformed taxi data from azure"
             )
@@ -317,6 +808,25 @@ class ETL:
                 "ALL transformed taxi data files were SUCCESSFULLY moved from azure"
             )
 
+    def delete_other_formats_of_transformed_blob(
+        self, container_name: str, year, month: str, output_format: str
+    ):
+        """
+        Deletes blobs of the transformed month saved in formats other than output_format.
+
+        :param: container_name:-> container name in blob storage as a string.
+        :param: year:-> year of the data.
+        :param: month:-> two digit str representation of a month, eg. 01, 02
+        :param: output_format:-> format which is kept.
+        """
+        for other_format in FILE_EXTENSIONS:
+            if other_format == output_format:
+                continue
+            blob_name = transformed_file_name(year, month, other_format)
+            if self.storage.blob_exists(container_name, blob_name):
+                self.storage.delete_blob(container_name, blob_name)
+                logger.info(f"{blob_name} left from an earlier run was deleted")
+
     def delete_blob(self, container_name: str, blob_name: str):
         """
         Deletes single blob from azure blob storage.
@@ -325,11 +835,7 @@ class ETL:
         :param: blob_name:-> blob name as a string.
         """
         try:
-            my_container = self.blob_service_client.get_container_client(
-                container=container_name
-            )
-            logger.debug(f"successfully connected to {container_name}")
-            my_container.delete_blob(blob_name)
+            self.storage.delete_blob(container_name, blob_name)
             logger.debug("there was an error deleting single blob")
         except ValueError or ConnectionError:
             logger.exception(
@@ -0,0 +1,349 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from functools import partial
+from typing import Callable, Optional
+
+import pandas as pd
+
+from src.blob_transfer import Blob_transfer
+from src.compact_trips import encode_compact_trips
+from src.data_processing import Data_processing
+from src.database import Database_interactions
+from src.file_formats import (
+    FILE_EXTENSIONS,
+    Transformed_data_writer,
+    pa,
+    read_transformed_file,
+)
+from src.range_index import Range_query_index
+from src.storage_backend import Local_storage_backend
+from src.synthetic_data import write_synthetic_month
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/benchmark.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+PERIOD = ("2021-02-03 00:00:00", "2021-02-20 12:00:00")
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    """
+    Times every stage of the pipeline on synthetic months (see synthetic_data) of several sizes.
+    Azure is replaced by the local storage backend behind the same transfer engine, sql server by the sqlite backend
+    of the real loader (see sql_backend).
+
+    ::Parameters::
+    :: sizes  : rows of the synthetic months
+    :: repeat : runs of every stage, the fastest one is reported
+    :: seed   : seed of the synthetic data, same seed gives the same data
+
+    ::Functions::
+    :: time_stage : -> runs a stage repeat times and records the fastest run
+    :: run_size   : -> runs all stages on one synthetic month
+    :: run        : -> runs all sizes and returns the results
+    :: save       : -> writes results as json
+    """
+
+    def __init__(self, sizes=None, repeat: int = 3, seed: int = 0) -> None:
+        self.sizes = sizes or DEFAULT_SIZES
+        self.repeat = repeat
+        self.seed = seed
+        self.year = 2021
+        self.month = "02"
+        self.results = []
+        # rows of the synthetic month being benchmarked, stages after cleaning process fewer rows
+        self.current_size = None
+
+    def time_stage(
+        self, stage: str, rows: int, function: Callable, setup: Callable = None
+    ):
+        """
+        Runs function repeat times and records the fastest run. setup runs before every run, untimed,
+        and its result is passed to function.
+
+        return:: result of the last run
+        """
+        best = None
+        for _ in range(self.repeat):
+            argument = setup() if setup is not None else None
+            started = time.perf_counter()
+            result = function(argument) if setup is not None else function()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        self.results.append(
+            {
+                "stage": stage,
+                "size": self.current_size,
+                "rows": rows,
+                "seconds": round(best, 6),
+                "rows_per_second": round(rows / best) if best else None,
+            }
+        )
+        logger.info(f"{stage:<40} {rows:>10} rows {best:>10.4f}s")
+        return result
+
+    def run_size(self, rows: int, directory: str) -> None:
+        raw_path = os.path.join(
+            directory, f"yellow_tripdata_{self.year}-{self.month}.csv"
+        )
+        write_synthetic_month(
+            raw_path, self.year, int(self.month), rows, seed=self.seed
+        )
+        data_processing = Data_processing(int(self.month), int(self.month), self.year)
+
+        csv_engines = ["typed"] + (["pyarrow"] if pa is not None else []) + ["inferred"]
+        for csv_engine in csv_engines:
+            data_processing.csv_engine = csv_engine
+            raw = self.time_stage(
+                f"read_{csv_engine}",
+                rows,
+                partial(data_processing.read_csv_file, self.month, raw_path),
+            )
+
+        # every step gets its own copy, remove_extremely_short_and_long_rides adds a column to its input
+        step_input = raw
+        for step in [
+            data_processing.remove_negative_passenger_count,
+            data_processing.rename_columns,
+            partial(data_processing.remove_outliers, month=self.month),
+            data_processing.remove_extremely_short_and_long_rides,
+        ]:
+            name = getattr(step, "__name__", None) or step.func.__name__
+            step_input = self.time_stage(
+                f"clean_{name}", rows, step, setup=step_input.copy
+            )
+        cleaned = step_input
+        self.time_stage(
+            "clean_fused",
+            rows,
+            partial(data_processing.clean_dataframe_fused, month=self.month),
+            setup=raw.copy,
+        )
+        compact = self.time_stage(
+            "encode_compact", len(cleaned), partial(encode_compact_trips, cleaned)
+        )
+
+        saved_paths = {}
+        output_formats = ["csv"] + (["parquet", "arrow"] if pa is not None else [])
+        for output_format in output_formats:
+            for layout, dataframe in [("plain", cleaned), ("compact", compact)]:
+                if layout == "compact" and output_format == "csv":
+                    continue
+                path = os.path.join(
+                    directory,
+                    f"clean_{layout}_{self.year}-{self.month}{FILE_EXTENSIONS[output_format]}",
+                )
+
+                def save(
+                    path=path,
+                    output_format=output_format,
+                    layout=layout,
+                    dataframe=dataframe,
+                ):
+                    with Transformed_data_writer(
+                        path, output_format, compact=layout == "compact"
+                    ) as writer:
+                        writer.write(dataframe)
+
+                self.time_stage(f"save_{output_format}_{layout}", len(cleaned), save)
+                saved_paths[f"{output_format}_{layout}"] = path
+
+        # local storage backend, files move through the same transfer engine as ETL uses
+        blob_transfer = Blob_transfer(max_workers=4, retries=0)
+        storage = Local_storage_backend(os.path.join(directory, "storage"))
+        storage.create_container("benchmark")
+        downloads = os.path.join(directory, "downloads")
+        os.makedirs(downloads, exist_ok=True)
+        for name, path in saved_paths.items():
+            blob_name = os.path.basename(path)
+            self.time_stage(
+                f"upload_{name}",
+                len(cleaned),
+                partial(
+                    blob_transfer.run,
+                    {name: partial(storage.upload_file, "benchmark", path, blob_name)},
+                ),
+            )
+            blob = next(
+                blob
+                for blob in storage.list_blobs("benchmark")
+                if blob.name == blob_name
+            )
+            downloaded_path = os.path.join(downloads, blob_name)
+            self.time_stage(
+                f"download_{name}",
+                len(cleaned),
+                partial(
+                    blob_transfer.run,
+                    {
+                        name: partial(
+                            storage.download_file, "benchmark", blob, downloads
+                        )
+                    },
+                ),
+            )
+            self.time_stage(
+                f"read_transformed_{name}",
+                len(cleaned),
+                partial(read_transformed_file, downloaded_path),
+            )
+
+        self.run_sql_stages(cleaned, directory)
+
+        index = self.time_stage(
+            "range_index_build",
+            len(cleaned),
+            partial(Range_query_index.from_dataframe, cleaned),
+        )
+        self.time_stage(
+            "range_index_query", len(cleaned), partial(index.aggregate, *PERIOD)
+        )
+
+    def run_sql_stages(self, cleaned: pd.DataFrame, directory: str) -> None:
+        """
+        Loads cleaned data with Database_interactions to a new sqlite database per run (rows and rollups)
+        and times the average query from raw rows and from rollups.
+        """
+        databases = []
+
+        def new_database():
+            database_interactions = Database_interactions(
+                sql_backend="sqlite",
+                sqlite_path=os.path.join(directory, f"trips_{len(databases)}.sqlite"),
+            )
+            database_interactions.create_table()
+            databases.append(database_interactions)
+            return database_interactions
+
+        def load(database_interactions):
+            database_interactions.insert_dataframe_to_sql_db(cleaned, "benchmark")
+            return database_interactions
+
+        database_interactions = self.time_stage(
+            "sql_insert", len(cleaned), load, setup=new_database
+        )
+
+        def query(rollups):
+            database_interactions.rollups = rollups
+            with database_interactions.connection() as (conn, cursor):
+                return database_interactions.query_average_passenger_count(
+                    cursor, *PERIOD
+                )
+
+        self.time_stage("sql_query_average", len(cleaned), partial(query, False))
+        self.time_stage("sql_query_average_rollups", len(cleaned), partial(query, True))
+        for database in databases:
+            database.close_pool()
+
+    def run(self) -> dict:
+        self.results = []
+        for rows in self.sizes:
+            self.current_size = rows
+            with tempfile.TemporaryDirectory() as directory:
+                self.run_size(rows, directory)
+        return {
+            "commit": current_commit(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "pyarrow": pa.__version__ if pa is not None else None,
+            "machine": platform.machine(),
+            "seed": self.seed,
+            "repeat": self.repeat,
+            "results": self.results,
+        }
+
+    @staticmethod
+    def save(report: dict, path: Optional[str] = None) -> str:
+        path = path or os.path.join(
+            "benchmark_results", f"{report['commit'] or 'uncommitted'}.json"
+        )
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+        logger.info(f"benchmark results saved to {path}")
+        return path
+
+
+def compare_reports(old_path: str, new_path: str) -> pd.DataFrame:
+    """
+    Compares two saved benchmark results, stage by stage and size (rows of the synthetic month) by size.
+
+    return:: pandas dataframe with seconds of both runs and change in percent (negative is faster)
+    """
+    reports = []
+    for path in [old_path, new_path]:
+        with open(path) as file:
+            reports.append(pd.DataFrame(json.load(file)["results"]))
+    comparison = reports[0].merge(
+        reports[1], on=["stage", "size"], how="outer", suffixes=("_old", "_new")
+    )
+    comparison["change_percent"] = (
+        (comparison.seconds_new / comparison.seconds_old - 1) * 100
+    ).round(1)
+    return comparison[["stage", "size", "seconds_old", "seconds_new", "change_percent"]]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="benchmarks pipeline stages on synthetic yellow taxi data"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        help="json file of the results, benchmark_results/<commit>.json by default",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="compares two saved results instead of running",
+    )
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(compare_reports(*arguments.compare).to_string(index=False))
+        return
+    benchmark = Benchmark(arguments.sizes, repeat=arguments.repeat, seed=arguments.seed)
+    Benchmark.save(benchmark.run(), arguments.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import io
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, Optional
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/blob_transfer.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+class Transfer_error(ConnectionError):
+    """
+    Raised when some files could not be transferred after all retries.
+    failures holds file name -> last error.
+    """
+
+    def __init__(self, failures: Dict[str, str]) -> None:
+        super().__init__(f"transfer failed for {sorted(failures)}")
+        self.failures = failures
+
+
+class Blob_chunk_stream(io.RawIOBase):
+    """
+    Read-only file-like view over the chunks of a blob download.
+    Lets pandas parse a blob while it is being downloaded, without a local file or the whole blob in memory.
+
+    ::Parameters::
+    :: chunks : iterator of bytes, eg. StorageStreamDownloader.chunks()
+    """
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self.chunks = chunks
+        self.current_chunk = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.current_chunk:
+            try:
+                self.current_chunk = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.current_chunk))
+        buffer[:size] = self.current_chunk[:size]
+        self.current_chunk = self.current_chunk[size:]
+        return size
+
+
+class Blob_transfer:
+    """
+    Runs file transfers (uploads or downloads) concurrently in a bounded thread pool and retries every file on its own.
+
+    ::Parameters::
+    :: max_workers    : number of files moved at the same time
+    :: retries        : attempts per file after the first one fails
+    :: backoff_seconds: wait before the first retry, doubled for every next retry (plus random jitter)
+    :: max_concurrency: connections the azure sdk uses for a single large blob (passed to upload_blob / download_blob)
+
+    ::Functions::
+    :: run_with_retries: -> runs a single transfer, retrying with exponential backoff
+    :: run             : -> runs all transfers concurrently, raises Transfer_error if any file failed
+
+    return:: None
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        retries: int = 3,
+        backoff_seconds: float = 1.0,
+        max_concurrency: int = 4,
+    ) -> None:
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.max_concurrency = max_concurrency
+
+    def run_with_retries(self, name: str, transfer: Callable[[], Any]) -> Any:
+        """
+        Runs a single transfer. Every failure is retried after an exponentially growing wait.
+
+        :param name:-> file name used in logs.
+        :param transfer:-> function without arguments doing the transfer.
+
+        return:: whatever transfer returns
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return transfer()
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                wait = self.backoff_seconds * 2 ** attempt
+                wait += random.uniform(0, self.backoff_seconds)
+                logger.warning(
+                    f"{name} transfer attempt {attempt + 1} failed, retrying in {wait:.1f}s",
+                    exc_info=True,
+                )
+                time.sleep(wait)
+
+    def run(
+        self,
+        transfers: Dict[str, Callable[[], Any]],
+        on_result: Optional[Callable[[str, Any], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Runs all transfers in max_workers threads.
+
+        :param transfers:-> file name -> function without arguments doing the transfer.
+        :param on_result:-> called with file name and result as soon as a file is transferred, in the calling thread
+                            (eg. to checkpoint it before other files finish)
+
+        return:: file name -> result of the transfer
+        """
+        results = {}
+        failures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.run_with_retries, name, transfer): name
+                for name, transfer in transfers.items()
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                    if on_result is not None:
+                        on_result(name, results[name])
+                    logger.info(f"{name} transferred")
+                except Exception as error:
+                    failures[name] = repr(error)
+                    logger.exception(f"{name} was not transferred")
+
+        if failures:
+            raise Transfer_error(failures)
+        return results
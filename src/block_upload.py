@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+try:
+    from azure.storage.blob import BlobBlock
+except ImportError:  # only used with the azure storage backend
+    BlobBlock = None
+
+from src.compression import check_compression, compress_bytes
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/block_upload.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+# azure allows at most 50 000 committed blocks per blob
+MAX_BLOCKS = 50000
+
+
+class Block_upload_journal:
+    """
+    Local record of the blocks of one blob upload that were already staged, kept as a json file.
+    Renamed into place on every save, so a crash never leaves a half written journal.
+
+    ::Parameters::
+    :: path : json file of the journal
+
+    ::Functions::
+    :: load         : -> returns recorded upload, None if there is no journal
+    :: start        : -> starts a new upload of a source with a new upload id
+    :: record_block : -> records a staged block and saves the journal
+    :: remove       : -> deletes the journal once the block list is committed
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.upload = None
+        self._lock = threading.Lock()
+
+    def load(self) -> Optional[dict]:
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.upload = json.load(file)
+        return self.upload
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(self.upload, file, indent=2, sort_keys=True)
+        os.replace(temporary_path, self.path)
+
+    def start(self, source: dict) -> dict:
+        """
+        :param source:-> size / mtime of the file and block settings, a journal of another source is not resumed
+        """
+        with self._lock:
+            self.upload = {
+                "upload_id": uuid.uuid4().hex[:12],
+                "source": source,
+                "staged_blocks": [],
+            }
+            self.save()
+        return self.upload
+
+    def record_block(self, index: int) -> None:
+        with self._lock:
+            self.upload["staged_blocks"].append(index)
+            self.save()
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.upload = None
+
+
+class Block_uploader:
+    """
+    Uploads a large file as a block blob: the file is split into blocks of block_size bytes, blocks are staged in
+    parallel (stage_block) and every staged block is recorded in a local journal. An interrupted upload (failed block,
+    killed process, retry of Blob_transfer) resumes with the blocks that are missing, and the blob appears only when
+    commit_block_list commits all blocks in order.
+    With compression every block is compressed on its own (a gzip member / zstd frame per block), so blocks stay
+    independent and the committed blob is still a single valid gzip / zstd stream.
+
+    ::Parameters::
+    :: journal_path      : folder of the journals, one json file per container and blob
+    :: block_size        : bytes of the local file per block
+    :: max_concurrency   : blocks staged at the same time
+    :: compression_level : level of the codec of compressed uploads, default of the codec if None
+
+    ::Functions::
+    :: journal      : -> journal of a blob upload
+    :: source_of    : -> identity of a local file and of the block settings, decides whether a journal can be resumed
+    :: block_id     : -> id of a block of an upload
+    :: read_block   : -> reads (and compresses) a block of the local file
+    :: upload       : -> stages missing blocks and commits the block list
+
+    return:: None
+    """
+
+    def __init__(
+        self,
+        journal_path: str = "data/upload_journal",
+        block_size: int = 8 * 1024 * 1024,
+        max_concurrency: int = 4,
+        compression_level: Optional[int] = None,
+    ) -> None:
+        self.journal_path = journal_path
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
+        self.compression_level = compression_level
+
+    def journal(self, container_name: str, blob_name: str) -> Block_upload_journal:
+        file_name = re.sub(r"[^\w.-]", "_", f"{container_name}__{blob_name}")
+        return Block_upload_journal(
+            os.path.join(self.journal_path, file_name + ".json")
+        )
+
+    def source_of(self, file_path: str, compression: Optional[str]) -> dict:
+        status = os.stat(file_path)
+        return {
+            "size": status.st_size,
+            "mtime_ns": status.st_mtime_ns,
+            "block_size": self.block_size,
+            "compression": compression,
+            "compression_level": self.compression_level if compression else None,
+        }
+
+    def block_id(self, upload_id: str, index: int) -> str:
+        # ids of one blob must have the same length, the upload id keeps blocks of other uploads apart
+        return f"{upload_id}-{index:06d}"
+
+    def read_block(
+        self, file_path: str, index: int, compression: Optional[str]
+    ) -> bytes:
+        with open(file_path, "rb") as file:
+            file.seek(index * self.block_size)
+            data = file.read(self.block_size)
+        if compression is not None:
+            data = compress_bytes(data, compression, self.compression_level)
+        return data
+
+    def upload(
+        self,
+        blob_client,
+        file_path: str,
+        compression: Optional[str] = None,
+        content_settings=None,
+    ) -> dict:
+        """
+        Uploads file_path to the blob, resuming an upload recorded in the journal if the file and block settings are the same.
+
+        :param blob_client:-> BlobClient of the target blob
+        :param file_path:-> local file to upload
+        :param compression:-> gzip / zstd compresses every block, None sends the file as it is
+        :param content_settings:-> content settings of the committed blob (eg. content-encoding)
+
+        return:: properties of the committed blob (etag, last_modified)
+        """
+        check_compression(compression)
+        journal = self.journal(blob_client.container_name, blob_client.blob_name)
+        source = self.source_of(file_path, compression)
+        block_count = -(-source["size"] // self.block_size)
+        if block_count > MAX_BLOCKS:
+            raise ValueError(
+                f"{file_path} needs {block_count} blocks, more than {MAX_BLOCKS}. Use a larger block_size."
+            )
+
+        upload = journal.load()
+        if upload is None or upload["source"] != source:
+            upload = journal.start(source)
+            staged = set()
+        else:
+            staged = self.staged_blocks(blob_client, upload)
+            logger.info(
+                f"{blob_client.blob_name} upload resumed, {len(staged)} of {block_count} blocks already staged"
+            )
+
+        missing = [index for index in range(block_count) if index not in staged]
+
+        def stage(index: int) -> None:
+            blob_client.stage_block(
+                self.block_id(upload["upload_id"], index),
+                self.read_block(file_path, index, compression),
+            )
+            journal.record_block(index)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            # list() raises the first failed block, staged ones stay in the journal
+            list(executor.map(stage, missing))
+        logger.debug(f"{len(missing)} blocks of {blob_client.blob_name} staged")
+
+        result = blob_client.commit_block_list(
+            [
+                BlobBlock(block_id=self.block_id(upload["upload_id"], index))
+                for index in range(block_count)
+            ],
+            content_settings=content_settings,
+        )
+        journal.remove()
+        logger.info(
+            f"{blob_client.blob_name} committed from {block_count} blocks, {len(missing)} uploaded in this attempt"
+        )
+        return result
+
+    def staged_blocks(self, blob_client, upload: dict) -> set:
+        """
+        Returns blocks recorded in the journal which are still uncommitted on the server.
+        Azure drops uncommitted blocks after a week or when another upload commits the blob, those are staged again.
+        """
+        _, uncommitted = blob_client.get_block_list("uncommitted")
+        server_ids = {block.id for block in uncommitted}
+        return {
+            index
+            for index in upload["staged_blocks"]
+            if self.block_id(upload["upload_id"], index) in server_ids
+        }
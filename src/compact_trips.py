@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+
+# "offset" - int32 seconds since the start of the pickup month, with a categorical month column
+# "epoch"  - int64 seconds since 1970-01-01, month column only if asked for
+TIME_ENCODINGS = ["offset", "epoch"]
+
+
+def is_compact(dataframe: pd.DataFrame) -> bool:
+    """
+    True if the dataframe is in compact representation (see encode_compact_trips).
+    """
+    return "pickup_offset" in dataframe.columns or "pickup_epoch" in dataframe.columns
+
+
+def _month_key_categorical(month_starts: np.ndarray) -> pd.Categorical:
+    months, codes = np.unique(month_starts, return_inverse=True)
+    return pd.Categorical.from_codes(
+        codes.astype("int8" if len(months) < 128 else "int16"),
+        categories=np.datetime_as_string(months, unit="M"),
+    )
+
+
+def encode_compact_trips(
+    dataframe: pd.DataFrame, time_encoding: str = "offset", month_key: bool = False
+) -> pd.DataFrame:
+    """
+    Encodes transformed trips in compact form, about 10 bytes per trip instead of 24:
+
+    :: offset: month (categorical "year-month" of the pickup), pickup_offset / dropoff_offset (int32 seconds since the month start)
+    :: epoch : pickup_epoch / dropoff_epoch (int64 seconds since 1970-01-01), month only if month_key is True
+    passenger_count becomes nullable uint8. Dates are kept with second precision, as in the raw files.
+
+    :param dataframe:-> transformed dataframe (pickup_datetime, dropoff_datetime, passenger_count), compact ones are returned as they are
+    :param time_encoding:-> offset or epoch
+    :param month_key:-> adds the categorical month column in epoch encoding
+
+    return:: compact pandas dataframe with the index of the input
+    """
+    if time_encoding not in TIME_ENCODINGS:
+        raise ValueError(
+            f"time encoding {time_encoding} is not one of {TIME_ENCODINGS}"
+        )
+    if is_compact(dataframe):
+        return dataframe
+    pickup = dataframe.pickup_datetime.to_numpy(dtype="datetime64[s]")
+    dropoff = dataframe.dropoff_datetime.to_numpy(dtype="datetime64[s]")
+    if np.isnat(pickup).any() or np.isnat(dropoff).any():
+        raise ValueError(
+            "compact representation needs pickup and dropoff of every trip"
+        )
+    passenger_count = dataframe.passenger_count.to_numpy(
+        dtype="float64", na_value=np.nan
+    )
+    if (passenger_count < 0).any() or (passenger_count > 255).any():
+        raise ValueError("passenger count does not fit into uint8")
+
+    columns = {}
+    if time_encoding == "offset":
+        month_starts = pickup.astype("datetime64[M]")
+        month_start_seconds = month_starts.astype("datetime64[s]")
+        pickup_offset = (pickup - month_start_seconds).astype("int64")
+        dropoff_offset = (dropoff - month_start_seconds).astype("int64")
+        limit = np.iinfo("int32")
+        if (
+            dropoff_offset.min(initial=0) < limit.min
+            or dropoff_offset.max(initial=0) > limit.max
+        ):
+            raise ValueError(
+                "dropoff is too far from the pickup month for int32 offsets"
+            )
+        columns["month"] = _month_key_categorical(month_starts)
+        columns["pickup_offset"] = pickup_offset.astype("int32")
+        columns["dropoff_offset"] = dropoff_offset.astype("int32")
+    else:
+        if month_key:
+            columns["month"] = _month_key_categorical(pickup.astype("datetime64[M]"))
+        columns["pickup_epoch"] = pickup.astype("int64")
+        columns["dropoff_epoch"] = dropoff.astype("int64")
+    columns["passenger_count"] = pd.array(passenger_count, dtype="UInt8")
+    return pd.DataFrame(columns, index=dataframe.index)
+
+
+def decode_compact_trips(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """
+    Decodes compact trips back to the transformed layout: pickup_datetime, dropoff_datetime (datetime64[ns])
+    and passenger_count. Dataframes which are not compact are returned as they are.
+
+    :param dataframe:-> dataframe made by encode_compact_trips
+
+    return:: pandas dataframe with the index of the input
+    """
+    if not is_compact(dataframe):
+        return dataframe
+    if "pickup_offset" in dataframe.columns:
+        month = dataframe.month.cat
+        category_starts = pd.to_datetime(month.categories).to_numpy(
+            dtype="datetime64[s]"
+        )
+        month_start_seconds = category_starts[month.codes.to_numpy()]
+        pickup = month_start_seconds + dataframe.pickup_offset.to_numpy().astype(
+            "timedelta64[s]"
+        )
+        dropoff = month_start_seconds + dataframe.dropoff_offset.to_numpy().astype(
+            "timedelta64[s]"
+        )
+    else:
+        pickup = dataframe.pickup_epoch.to_numpy().astype("datetime64[s]")
+        dropoff = dataframe.dropoff_epoch.to_numpy().astype("datetime64[s]")
+    return pd.DataFrame(
+        {
+            "pickup_datetime": pickup.astype("datetime64[ns]"),
+            "dropoff_datetime": dropoff.astype("datetime64[ns]"),
+            "passenger_count": dataframe.passenger_count.astype("Int64"),
+        },
+        index=dataframe.index,
+    )
+
+
+def trip_month_keys(dataframe: pd.DataFrame) -> list:
+    """
+    Returns sorted "year-month" keys of pickups in a transformed or compact dataframe.
+    """
+    if "month" in dataframe.columns:
+        return sorted(dataframe.month.unique().astype(str))
+    return sorted(
+        str(month)
+        for month in dataframe.pickup_datetime.dt.to_period("M").dropna().unique()
+    )
@@ -0,0 +1,190 @@
+import gzip
+import io
+import os
+import zlib
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:  # gzip still works without zstandard
+    zstandard = None
+
+
+# codecs of compressed blob transfers, named after the content-encoding set on the blob
+COMPRESSIONS = ["gzip", "zstd"]
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+# suffix of compressed files kept on disk, eg. yellow_tripdata_2021-01.csv.gz
+FILE_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# gzip container instead of a raw zlib stream
+_GZIP_WINDOW_BITS = 16 + zlib.MAX_WBITS
+
+
+def check_compression(compression: Optional[str]) -> None:
+    if compression is None:
+        return
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression {compression} is not one of {COMPRESSIONS}")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstandard is required to use zstd compression")
+
+
+def compression_of_encoding(content_encoding: Optional[str]) -> Optional[str]:
+    """
+    Returns compression of a blob with the content-encoding, None for plain blobs.
+    """
+    if content_encoding in COMPRESSIONS:
+        return content_encoding
+    return None
+
+
+def compression_of_file(path: str) -> Optional[str]:
+    """
+    Returns compression of a file by its suffix (.gz or .zst), None for plain files.
+    """
+    for compression, suffix in FILE_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def _compressor(compression: str, level: Optional[int]):
+    level = DEFAULT_LEVELS[compression] if level is None else level
+    if compression == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, _GZIP_WINDOW_BITS)
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def _decompressor(compression: str):
+    if compression == "gzip":
+        return zlib.decompressobj(_GZIP_WINDOW_BITS)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def compress_bytes(data: bytes, compression: str, level: Optional[int] = None) -> bytes:
+    check_compression(compression)
+    compressor = _compressor(compression, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Compressing_reader(io.RawIOBase):
+    """
+    Read-only file-like object returning the compressed content of source, compressed chunk by chunk while it is read.
+    Lets upload_blob send a compressed file without a compressed copy on disk or in memory.
+
+    ::Parameters::
+    :: source      : binary file-like object with plain data
+    :: compression : gzip or zstd
+    :: level       : compression level, DEFAULT_LEVELS if None
+    :: chunk_size  : bytes read from source at once
+    """
+
+    def __init__(
+        self,
+        source,
+        compression: str,
+        level: Optional[int] = None,
+        chunk_size: int = 1024 * 1024,
+    ) -> None:
+        check_compression(compression)
+        self.source = source
+        self.chunk_size = chunk_size
+        self.compressor = _compressor(compression, level)
+        self.pending = b""
+        self.finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending and not self.finished:
+            chunk = self.source.read(self.chunk_size)
+            if chunk:
+                self.pending = self.compressor.compress(chunk)
+            else:
+                self.pending = self.compressor.flush()
+                self.finished = True
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+class Decompressing_writer(io.RawIOBase):
+    """
+    Write-only file-like object decompressing everything written to it into target,
+    so a compressed blob download can be written straight to a plain local file.
+
+    ::Parameters::
+    :: target      : binary file-like object the plain data is written to
+    :: compression : gzip or zstd
+    """
+
+    def __init__(self, target, compression: str) -> None:
+        check_compression(compression)
+        self.target = target
+        self.compression = compression
+        self.decompressor = _decompressor(compression)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        size = len(data)
+        data = bytes(data)
+        while data:
+            # blobs uploaded in blocks are several gzip members / zstd frames, each one needs a new decompressor,
+            # also when a write ends exactly at the end of a frame (zstd decompressors can not be used again)
+            if self.decompressor.eof:
+                self.decompressor = _decompressor(self.compression)
+            self.target.write(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data if self.decompressor.eof else b""
+        return size
+
+    def finish(self) -> None:
+        """
+        Writes data still held by the decompressor, call it once everything was written.
+        """
+        if hasattr(self.decompressor, "flush"):
+            self.target.write(self.decompressor.flush())
+
+
+def open_decompressed(source, compression: Optional[str]):
+    """
+    Returns a binary file-like object reading plain data from a compressed source, or the source itself if it is plain.
+
+    :param source:-> binary file-like object, eg. a blob stream or an open local file
+    :param compression:-> gzip, zstd or None
+    """
+    if compression is None:
+        return source
+    check_compression(compression)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=source, mode="rb")
+    return io.BufferedReader(
+        zstandard.ZstdDecompressor().stream_reader(source, read_across_frames=True)
+    )
+
+
+def open_file_decompressed(path: str):
+    """
+    Opens a local file for binary reading, decompressing it if its suffix is .gz or .zst.
+    """
+    return open_decompressed(open(path, "rb"), compression_of_file(path))
+
+
+def compressed_file_path(path: str, compression: Optional[str]) -> str:
+    if compression is None:
+        return path
+    return path + FILE_SUFFIXES[compression]
+
+
+def existing_file_path(path: str) -> str:
+    """
+    Returns path of the plain file if it exists, otherwise of an existing compressed copy (path + .gz / .zst),
+    or path itself if there is neither.
+    """
+    for candidate in [path] + [path + suffix for suffix in FILE_SUFFIXES.values()]:
+        if os.path.exists(candidate):
+            return candidate
+    return path
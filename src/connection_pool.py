@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/connection_pool.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+class Connection_pool_timeout(ConnectionError):
+    """
+    Raised when no connection became free within checkout_timeout_seconds.
+    """
+
+
+class Connection_pool:
+    """
+    Keeps database connections open between calls, so the connection handshake is paid once instead of for every query.
+
+    ::Parameters::
+    :: connect                 : function without arguments opening a new connection, eg. lambda: pyodbc.connect(...)
+    :: max_size                : connections open at the same time (in use and idle), checkout waits when all are in use
+    :: idle_timeout_seconds    : idle connections older than this are closed instead of reused
+    :: health_check_sql        : run on an idle connection before reuse, connections failing it are replaced
+    :: checkout_timeout_seconds: how long checkout waits for a free connection
+
+    ::Functions::
+    :: checkout  : -> context manager lending a connection, it goes back to the pool on exit
+    :: close_all : -> closes idle connections, the pool opens new ones when needed again
+    :: stats     : -> connections opened, reused, discarded and currently idle / in use
+
+    return:: None
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        max_size: int = 4,
+        idle_timeout_seconds: float = 300,
+        health_check_sql: Optional[str] = "SELECT 1",
+        checkout_timeout_seconds: float = 30,
+    ) -> None:
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.health_check_sql = health_check_sql
+        self.checkout_timeout_seconds = checkout_timeout_seconds
+        # idle connections with the time they were returned, most recently returned last
+        self.idle = []
+        self.in_use = 0
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+        self._condition = threading.Condition()
+
+    def _discard(self, connection: Any) -> None:
+        self.discarded += 1
+        try:
+            connection.close()
+        except Exception:
+            logger.debug("connection was already closed", exc_info=True)
+
+    def _is_healthy(self, connection: Any) -> bool:
+        if self.health_check_sql is None:
+            return True
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(self.health_check_sql).fetchall()
+            finally:
+                cursor.close()
+        except Exception:
+            logger.warning("pooled connection failed health check", exc_info=True)
+            return False
+        return True
+
+    def _take_idle(self) -> Optional[Any]:
+        """
+        Returns most recently used idle connection that is not too old, closing expired ones. Called with the lock held.
+        """
+        now = time.monotonic()
+        expired = [
+            connection
+            for connection, returned_at in self.idle
+            if now - returned_at >= self.idle_timeout_seconds
+        ]
+        self.idle = [
+            (connection, returned_at)
+            for connection, returned_at in self.idle
+            if now - returned_at < self.idle_timeout_seconds
+        ]
+        for connection in expired:
+            logger.debug("idle connection expired")
+            self._discard(connection)
+        if self.idle:
+            return self.idle.pop()[0]
+        return None
+
+    def _acquire(self) -> Any:
+        deadline = time.monotonic() + self.checkout_timeout_seconds
+        with self._condition:
+            while True:
+                connection = self._take_idle()
+                if (
+                    connection is not None
+                    or len(self.idle) + self.in_use < self.max_size
+                ):
+                    self.in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Connection_pool_timeout(
+                        f"no free connection within {self.checkout_timeout_seconds}s, max_size is {self.max_size}"
+                    )
+                self._condition.wait(remaining)
+
+        try:
+            # health check and connect run without the lock, they can take a network round trip
+            if connection is not None and self._is_healthy(connection):
+                self.reused += 1
+                return connection
+            if connection is not None:
+                self._discard(connection)
+            connection = self.connect()
+            self.opened += 1
+            logger.debug("new pooled connection opened")
+            return connection
+        except BaseException:
+            with self._condition:
+                self.in_use -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, connection: Any, broken: bool) -> None:
+        with self._condition:
+            self.in_use -= 1
+            if broken:
+                self._discard(connection)
+            else:
+                self.idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def checkout(self) -> Iterator[Any]:
+        """
+        Lends a connection for the with block. Uncommitted work is rolled back if the block raises,
+        connections that can not even roll back are closed instead of returned.
+        """
+        connection = self._acquire()
+        broken = False
+        try:
+            yield connection
+        except BaseException:
+            try:
+                connection.rollback()
+            except Exception:
+                logger.warning(
+                    "rollback failed, connection is discarded", exc_info=True
+                )
+                broken = True
+            raise
+        finally:
+            self._release(connection, broken)
+
+    def close_all(self) -> None:
+        with self._condition:
+            for connection, _ in self.idle:
+                self._discard(connection)
+            self.idle = []
+        logger.info(f"idle pooled connections closed, {self.stats()}")
+
+    def stats(self) -> dict:
+        return {
+            "opened": self.opened,
+            "reused": self.reused,
+            "discarded": self.discarded,
+            "idle": len(self.idle),
+            "in_use": self.in_use,
+        }
@@ -1,6 +1,22 @@
+import numpy as np
 import pandas as pd
 from pandas.core.frame import DataFrame
+from typing import Callable, Iterator, Optional
 import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logging.handlers import QueueHandler, QueueListener
+
+from src.compact_trips import encode_compact_trips
+from src.compression import (
+    compression_of_file,
+    existing_file_path,
+    open_file_decompressed,
+)
+from src.file_formats import Transformed_data_writer, transformed_file_name
+from src.metrics import pipeline_metrics
+from src.raw_schema import CSV_ENGINES, read_raw_csv, read_raw_csv_in_chunks
 
 
 logger = logging.getLogger(__name__)
@@ -9,7 +25,8 @@ formatter = logging.Formatter(
     "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
 )
 
-file_handler = logging.FileHandler("logs/data_processing.log", "w")
+# delay=True: worker processes started with "spawn" re-import this module and must not truncate the log
+file_handler = logging.FileHandler("logs/data_processing.log", "w", delay=True)
 file_handler.setLevel(logging.INFO)
 file_handler.setFormatter(formatter)
 
@@ -20,6 +37,52 @@ logger.addHandler(file_handler)
 logger.addHandler(stream_handler)
 
 
+# rides shorter than 5 seconds are likely mistakes, 12 hour shifts are a common standard in ny taxies.
+# database rollups rely on every loaded ride being shorter than MAX_TRIP_DURATION_IN_SECONDS.
+MIN_TRIP_DURATION_IN_SECONDS = 5
+MAX_TRIP_DURATION_IN_SECONDS = 43200
+
+# cleaning rules in the order they are applied, rejected rows are counted against the first rule they fail
+# missing passenger counts fail "passenger_count >= 0" as well, they are counted on their own
+CLEANING_RULES = [
+    "missing_passenger_count",
+    "negative_passenger_count",
+    "pickup_outside_month",
+    "extremely_short_or_long_ride",
+]
+
+
+# loggers of the modules running in worker processes, their records are written by the parent process
+WORKER_LOGGERS = [__name__, "src.file_formats", "src.raw_schema", "src.metrics"]
+
+
+class _Parent_log_handler(logging.Handler):
+    """
+    Handles a record received from a worker with the handlers of the logger that created it in the parent process.
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+def _init_worker_logging(log_queue: multiprocessing.Queue) -> None:
+    """
+    Runs once in every worker process. Replaces the file and stream handlers of WORKER_LOGGERS with a queue handler,
+    so log records are written by the parent process only and lines never interleave.
+    """
+    for logger_name in WORKER_LOGGERS:
+        worker_logger = logging.getLogger(logger_name)
+        worker_logger.handlers.clear()
+        worker_logger.addHandler(QueueHandler(log_queue))
+
+
+def _closing_chunks(chunks, file) -> Iterator[pd.DataFrame]:
+    try:
+        yield from chunks
+    finally:
+        file.close()
+
+
 class Data_processing:
     """
 
@@ -30,15 +93,33 @@ class Data_processing:
     :: start_month_of_reports : first month for the csv file in raw data (currently 1)
     : end_month_of_report    : last month of the csv file of 2021 (currently 7)
     : year                   : year of the data used
+    : chunk_size             : number of rows read at once in streaming mode (None reads the whole month)
+    : workers                : number of processes transforming months in parallel (1 runs in this process)
+    : output_format          : format of transformed files: csv, parquet or arrow
+    : compact                : True keeps cleaned months as compact frames (int32 offsets, uint8 passenger count, see compact_trips)
+                               and stores parquet / arrow files in the same layout
+    : csv_engine             : inferred (pandas type inference), typed (explicit schema of the year) or pyarrow (see raw_schema)
+    : fused_cleaning         : True applies all cleaning rules as one mask and copies the data once (see clean_dataframe_fused)
 
     :: Functions ::
 
     :: remove_negative_passenger_count: -> removes rows where passenger count >= 0
     :: rename_columns   : -> renames columns to more convenient naming
+    :: raw_file_path    : -> path of the extracted raw csv file of the month
+    :: open_raw_file    : -> path of the raw file, or a decompressing file object if it is kept compressed
     :: read_csv_file    : -> reads the csv file
+    :: read_csv_file_in_chunks : -> reads the csv file in chunks of chunk_size rows
     :: remove_outliers  : -> removes dates that are not in range of the month the dataset is built.
     :: remove_extremely_short_and_long_rides : -> removes rides where duration is less than 5 seconds and longer than 12hour shift.
-    :: save_cleaned_csv_files: -> saves transformed dataframe
+    :: last_day_of_month : -> last day used by remove_outliers for the month
+    :: clean_dataframe_fused : -> applies all cleaning steps as a single mask, counting rejected rows per rule
+    :: transform_dataframe : -> applies all cleaning steps to a dataframe (or a chunk of it)
+    :: output_file_path : -> path of the transformed file of the month
+    :: save_cleaned_file: -> saves transformed dataframe in output_format
+    :: run_month_in_chunks : -> streams one month through the cleaning steps chunk by chunk
+    :: transform_month : -> reads and cleans a single month and returns it without saving
+    :: process_month : -> reads, cleans and saves a single month
+    :: run_in_parallel : -> transforms months in a process pool
     :: run : -> general functionto combine it all
 
 
@@ -46,14 +127,39 @@ class Data_processing:
     """
 
     def __init__(
-        self, start_month_of_report: int, end_month_of_report: int, year: int
+        self,
+        start_month_of_report: int,
+        end_month_of_report: int,
+        year: int,
+        chunk_size: Optional[int] = None,
+        workers: int = 1,
+        output_format: str = "csv",
+        fused_cleaning: bool = False,
+        csv_engine: str = "inferred",
+        compact: bool = False,
     ) -> None:
+        if csv_engine != "inferred" and csv_engine not in CSV_ENGINES:
+            raise ValueError(
+                f"csv engine {csv_engine} is not one of {['inferred'] + CSV_ENGINES}"
+            )
         self.columns_to_extract = [
             "tpep_pickup_datetime",
             "tpep_dropoff_datetime",
             "passenger_count",
         ]
         self.year = year
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.output_format = output_format
+        self.fused_cleaning = fused_cleaning
+        self.csv_engine = csv_engine
+        self.compact = compact
+        self.month_results = {}
+        self.month_failures = {}
+        # month -> rule -> rows rejected by the fused cleaning
+        self.rejection_counts = {}
+        # month -> raw rows read, before cleaning
+        self.rows_read = {}
         self.months = [
             str(i).zfill(2)
             for i in range(start_month_of_report, end_month_of_report + 1)
@@ -102,20 +208,48 @@ class Data_processing:
             logger.debug(f"{temp_dataframe} columns were renamed correctly")
         return new_temp_dataframe
 
-    def read_csv_file(self, month: str) -> pd.DataFrame:
+    def raw_file_path(self, month: str) -> str:
+        """
+        Returns path of the extracted raw csv file of the month, or of its compressed copy (.csv.gz / .csv.zst)
+        if the blob was downloaded without decompressing.
+
+        param: month:str -> value of the month provided in two digits format eg. 01,02
+        """
+        return existing_file_path(
+            f"data/extracted_from_azure_raw/yellow_tripdata_{self.year}-{month}.csv"
+        )
+
+    def open_raw_file(self, month: str):
+        """
+        Returns path of the extracted raw csv file, or a binary file object decompressing it while it is read
+        if the file is kept compressed, so csv readers never need a decompressed copy on disk.
+
+        param: month:str -> value of the month provided in two digits format eg. 01,02
+        """
+        path = self.raw_file_path(month)
+        if compression_of_file(path) is None:
+            return path
+        return open_file_decompressed(path)
+
+    def read_csv_file(self, month: str, source=None) -> pd.DataFrame:
         """
         Reads the raw csv files and prepares them for cleaning. parses dates, selects only columns required (picup/dropoff datetime and passenger count)
 
         param: month:str -> value of the month provided in two digits format eg. 01,02
+        param: source -> file-like object to read instead of the extracted raw file (see raw_file_path)
 
         returns temp_dataframe -> pandas dataframe with selected columns.
         """
+        raw_source = source or self.open_raw_file(month)
         try:
-            temp_dataframe = pd.read_csv(
-                f"data/extracted_from_azure_raw/yellow_tripdata_{self.year}-{month}.csv",
-                usecols=self.columns_to_extract,
-                parse_dates=["tpep_pickup_datetime", "tpep_dropoff_datetime"],
-            )
+            if self.csv_engine == "inferred":
+                temp_dataframe = pd.read_csv(
+                    raw_source,
+                    usecols=self.columns_to_extract,
+                    parse_dates=["tpep_pickup_datetime", "tpep_dropoff_datetime"],
+                )
+            else:
+                temp_dataframe = read_raw_csv(raw_source, self.year, self.csv_engine)
             logger.debug("dataframe was successfully read to pandas")
         except ValueError:
             logger.exception(
@@ -123,9 +257,52 @@ class Data_processing:
             )
         else:
             logger.debug(f"{month}.csv was read in correctly")
+        finally:
+            if source is None and not isinstance(raw_source, str):
+                raw_source.close()
 
         return temp_dataframe
 
+    def read_csv_file_in_chunks(
+        self, month: str, source=None
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Reads the raw csv file in chunks of chunk_size rows, so the whole month never has to be held in memory.
+
+        param: month:str -> value of the month provided in two digits format eg. 01,02
+        param: source -> file-like object to read instead of the extracted raw file (see raw_file_path)
+
+        returns iterator of pandas dataframes with selected columns.
+        """
+        raw_source = source or self.open_raw_file(month)
+        try:
+            if self.csv_engine == "inferred":
+                chunks = pd.read_csv(
+                    raw_source,
+                    usecols=self.columns_to_extract,
+                    parse_dates=["tpep_pickup_datetime", "tpep_dropoff_datetime"],
+                    chunksize=self.chunk_size,
+                )
+            else:
+                chunks = read_raw_csv_in_chunks(
+                    raw_source,
+                    self.year,
+                    self.chunk_size,
+                    self.csv_engine,
+                )
+        except ValueError:
+            logger.exception(
+                f"problem opening dataframe in chunks, month value -> {month}"
+            )
+            raise
+        else:
+            logger.debug(f"{month}.csv is read in chunks of {self.chunk_size} rows")
+
+        if source is None and not isinstance(raw_source, str):
+            # compressed file opened here is closed when its last chunk was read
+            return _closing_chunks(chunks, raw_source)
+        return chunks
+
     def remove_outliers(self, temp_dataframe: pd.DataFrame, month: str) -> pd.DataFrame:
         """
         Removes monthly outliers. Checks whether the dates in pickup_datetime column are within the specific month.
@@ -200,10 +377,12 @@ class Data_processing:
             logger.debug("Trip duration column was created successfully")
             temp_dataframe = temp_dataframe[
                 (
-                    temp_dataframe.trip_duration_in_seconds > 5
+                    temp_dataframe.trip_duration_in_seconds
+                    > MIN_TRIP_DURATION_IN_SECONDS
                 )  # as 5 second trip migh be just a mistake
                 & (
-                    temp_dataframe.trip_duration_in_seconds < 43200
+                    temp_dataframe.trip_duration_in_seconds
+                    < MAX_TRIP_DURATION_IN_SECONDS
                 )  # 12 hours shifts is a common standard in ny taxies
             ].drop("trip_duration_in_seconds", axis=1)
             logger.debug("extremely short rides and extremely long rides trimmed")
@@ -215,9 +394,102 @@ class Data_processing:
             logger.debug("Trip duration outliers successfuly removed")
         return temp_dataframe
 
-    def save_cleaned_csv_file(self, month, dataframe: pd.DataFrame) -> None:
+    def last_day_of_month(self, month: str) -> str:
         """
-        Saves cleaned and transformed dataframe to transformed dataframe folder
+        Returns the last day remove_outliers keeps for the month (28 for february, 30 or 31 for others).
+
+        param: month -> two digit str representation of a month, eg. 01, 02
+        """
+        if int(month) == 2:
+            return "28"
+        if int(month) in [4, 6, 9, 11]:
+            return "30"
+        return "31"
+
+    def clean_dataframe_fused(
+        self, dataframe: pd.DataFrame, month: str
+    ) -> pd.DataFrame:
+        """
+        Applies the same rules as the separate cleaning steps, but evaluates them as one mask over the raw numpy arrays
+        and copies the surviving rows once. No temporary duration column is added.
+        Rows rejected by every rule are added to rejection_counts of the month.
+
+        param: dataframe -> pandas dataframe as read by read_csv_file
+        param: month -> two digit str representation of a month, eg. 01, 02
+
+        return:: cleaned pandas dataframe
+        """
+        pickup = dataframe.tpep_pickup_datetime.to_numpy()
+        dropoff = dataframe.tpep_dropoff_datetime.to_numpy()
+        passenger_count = dataframe.passenger_count.to_numpy(
+            dtype="float64", na_value=np.nan
+        )
+
+        rule_masks = [
+            ~np.isnan(passenger_count),
+            passenger_count >= 0,
+            (pickup >= np.datetime64(f"{self.year}-{month}-01"))
+            & (
+                pickup
+                <= np.datetime64(f"{self.year}-{month}-{self.last_day_of_month(month)}")
+            ),
+        ]
+        trip_duration = dropoff - pickup
+        rule_masks.append(
+            (trip_duration > np.timedelta64(MIN_TRIP_DURATION_IN_SECONDS, "s"))
+            & (trip_duration < np.timedelta64(MAX_TRIP_DURATION_IN_SECONDS, "s"))
+        )
+
+        kept = np.ones(len(dataframe), dtype=bool)
+        month_counts = self.rejection_counts.setdefault(
+            month, dict.fromkeys(CLEANING_RULES, 0)
+        )
+        for rule, rule_mask in zip(CLEANING_RULES, rule_masks):
+            month_counts[rule] += int(np.count_nonzero(kept & ~rule_mask))
+            kept &= rule_mask
+
+        cleaned_dataframe = dataframe[kept]
+        cleaned_dataframe.columns = [
+            column.replace("tpep_", "", 1) for column in cleaned_dataframe.columns
+        ]
+        logger.debug(
+            f"{self.year}-{month} fused cleaning kept {len(cleaned_dataframe)} of {len(dataframe)} rows"
+        )
+        return cleaned_dataframe
+
+    def transform_dataframe(self, dataframe: pd.DataFrame, month: str) -> pd.DataFrame:
+        """
+        Applies all cleaning steps to a dataframe. Works the same on a whole month and on a single chunk of it.
+
+        param: dataframe -> pandas dataframe as read by read_csv_file
+        param: month -> two digit str representation of a month, eg. 01, 02
+
+        return:: cleaned pandas dataframe
+        """
+        if self.fused_cleaning:
+            dataframe = self.clean_dataframe_fused(dataframe, month)
+        else:
+            dataframe = self.remove_negative_passenger_count(dataframe)
+            dataframe = self.rename_columns(dataframe)
+            dataframe = self.remove_outliers(dataframe, month)
+            dataframe = self.remove_extremely_short_and_long_rides(dataframe)
+        if self.compact:
+            dataframe = encode_compact_trips(dataframe)
+        return dataframe
+
+    def output_file_path(self, month: str) -> str:
+        """
+        Returns path of the transformed file of the month, extension depends on output_format.
+
+        param: month -> two digit str representation of a month, eg. 01, 02
+        """
+        return "data/transformed_data/" + transformed_file_name(
+            self.year, month, self.output_format
+        )
+
+    def save_cleaned_file(self, month, dataframe: pd.DataFrame) -> None:
+        """
+        Saves cleaned and transformed dataframe to transformed dataframe folder in output_format
 
         param: month -> two digit str representation of a month, eg. 01, 02
         param: dataframe -> pandas dataframe
@@ -225,42 +497,195 @@ class Data_processing:
         return:: None
         """
         try:
-            dataframe.to_csv(
-                f"data/transformed_data/clean_yellow_trip_data_{self.year}-"
-                + str(month)
-                + ".csv",
-                index=False,
-            )
+            with Transformed_data_writer(
+                self.output_file_path(month), self.output_format, compact=self.compact
+            ) as writer:
+                writer.write(dataframe)
         except ValueError:
-            logger.exception(f"There was a problem saving to csv {dataframe}")
+            logger.exception(f"There was a problem saving {dataframe}")
         else:
             logger.debug(f"{dataframe} was saved successfully")
 
-    def run(self):
+    def run_month_in_chunks(self, month: str) -> int:
         """
-        Function which iterates from start to end month applying all functions of the class.
+        Streams a single month through all cleaning steps chunk by chunk and appends every cleaned chunk to the output file.
+        Peak memory is set by chunk_size instead of the size of the monthly file.
 
-        param: None
+        param: month -> two digit str representation of a month, eg. 01, 02
 
-        return:: None
+        return:: number of rows saved
         """
-        try:
-            for month in self.months:
+        self.rows_read[month] = 0
+        with Transformed_data_writer(
+            self.output_file_path(month), self.output_format, compact=self.compact
+        ) as writer:
+            for chunk_number, chunk in enumerate(self.read_csv_file_in_chunks(month)):
+                self.rows_read[month] += len(chunk)
+                chunk = self.transform_dataframe(chunk, month)
+                writer.write(chunk)
+                logger.debug(
+                    f"{self.year}-{month} chunk {chunk_number} cleaned, {len(chunk)} rows saved"
+                )
+        return writer.rows_written
+
+    def transform_month(self, month: str, source=None) -> pd.DataFrame:
+        """
+        Reads and cleans a single month and returns it without saving, used when data is not staged on disk.
+        If chunk_size is set the source is read in chunks and only cleaned chunks are kept in memory.
+
+        param: month -> two digit str representation of a month, eg. 01, 02
+        param: source -> file-like object with raw csv data (eg. a blob stream), extracted raw file if None
+
+        return:: cleaned pandas dataframe
+        """
+        with pipeline_metrics.stage(
+            "transform_month", month_key=f"{self.year}-{month}"
+        ) as metrics:
+            if self.chunk_size:
+                self.rows_read[month] = 0
+                cleaned_chunks = []
+                for chunk in self.read_csv_file_in_chunks(month, source=source):
+                    self.rows_read[month] += len(chunk)
+                    cleaned_chunks.append(self.transform_dataframe(chunk, month))
+                dataframe = pd.concat(cleaned_chunks, ignore_index=True)
+            else:
+                dataframe = self.read_csv_file(month, source=source)
+                self.rows_read[month] = len(dataframe)
+                dataframe = self.transform_dataframe(dataframe, month)
+            metrics["rows_in"] = self.rows_read[month]
+            metrics["rows_out"] = len(dataframe)
+            metrics["memory_bytes"] = int(dataframe.memory_usage(deep=True).sum())
+        logger.info(f"{self.year}-{month} dataframe was cleaned in memory")
+        return dataframe
+
+    def process_month(self, month: str) -> int:
+        """
+        Reads, cleans and saves a single month. Exceptions are not caught here so that run() can report them per month.
+
+        param: month -> two digit str representation of a month, eg. 01, 02
+
+        return:: number of rows saved
+        """
+        with pipeline_metrics.stage(
+            "transform_month", month_key=f"{self.year}-{month}"
+        ) as metrics:
+            metrics["bytes"] = os.path.getsize(self.raw_file_path(month))
+            if self.chunk_size:
+                rows_saved = self.run_month_in_chunks(month)
+                logger.info(
+                    f"{self.year}-{month} dataframe was streamed in chunks, {rows_saved} rows cleaned and saved"
+                )
+            else:
                 dataframe = self.read_csv_file(month=month)
+                self.rows_read[month] = len(dataframe)
                 logger.info(f"{self.year}-{month} dataframe was successfully read in")
-                dataframe = self.remove_negative_passenger_count(dataframe)
-                dataframe = self.rename_columns(dataframe)
-                dataframe = self.remove_outliers(dataframe, month)
-                dataframe = self.remove_extremely_short_and_long_rides(dataframe)
-                self.save_cleaned_csv_file(month, dataframe)
+                dataframe = self.transform_dataframe(dataframe, month)
+                self.save_cleaned_file(month, dataframe)
                 logger.info(
                     f"{self.year}-{month} dataframe was successfully cleaned and saved"
                 )
+                rows_saved = len(dataframe)
+            metrics["rows_in"] = self.rows_read[month]
+            metrics["rows_out"] = rows_saved
+        return rows_saved
+
+    def log_rejection_counts(self, month: str) -> None:
+        if month in self.rejection_counts:
+            logger.info(
+                f"{self.year}-{month} rows rejected per rule: {self.rejection_counts[month]}"
+            )
+
+    def process_month_with_rejection_counts(self, month: str) -> tuple:
+        """
+        Runs process_month in a worker process and returns rejection counts and raw rows read of the month
+        with the rows saved, so they reach the parent process.
+        """
+        rows_saved = self.process_month(month)
+        return rows_saved, self.rejection_counts.get(month), self.rows_read.get(month)
+
+    def run_in_parallel(self, on_month_saved: Optional[Callable] = None) -> None:
+        """
+        Hands every month to a process pool of `workers` processes.
+        Workers send their log records back through a queue, so only this process writes to the log file.
+
+        param: on_month_saved -> see run()
+
+        return:: None
+        """
+        log_queue = multiprocessing.Queue()
+        listener = QueueListener(log_queue, _Parent_log_handler())
+        listener.start()
+        try:
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker_logging,
+                initargs=(log_queue,),
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        self.process_month_with_rejection_counts, month
+                    ): month
+                    for month in self.months
+                }
+                for future in as_completed(futures):
+                    month = futures[future]
+                    try:
+                        rows_saved, rejection_counts, rows_read = future.result()
+                        self.month_results[month] = rows_saved
+                        self.rows_read[month] = rows_read
+                        if rejection_counts is not None:
+                            self.rejection_counts[month] = rejection_counts
+                            self.log_rejection_counts(month)
+                        if on_month_saved is not None:
+                            on_month_saved(month, rows_saved)
+                    except Exception as error:
+                        self.month_failures[month] = repr(error)
+                        logger.exception(
+                            f"{self.year}-{month} failed in worker process"
+                        )
+        finally:
+            listener.stop()
+
+    def run(self, on_month_saved: Optional[Callable] = None):
+        """
+        Function which iterates from start to end month applying all functions of the class.
+        If chunk_size is set every month is streamed in chunks (see run_month_in_chunks).
+        If workers > 1 months are transformed in parallel processes (see run_in_parallel).
+        Rows saved per month end up in month_results, raw rows read in rows_read, errors per month in month_failures,
+        rows rejected per rule (fused_cleaning only) in rejection_counts.
+
+        param: on_month_saved -> called with month and rows saved as soon as a month is saved (eg. to checkpoint it),
+                                 in this process
+
+        return:: None
+        """
+        self.month_results = {}
+        self.month_failures = {}
+        self.rejection_counts = {}
+        self.rows_read = {}
+        try:
+            if self.workers > 1:
+                self.run_in_parallel(on_month_saved)
+            else:
+                for month in self.months:
+                    try:
+                        self.month_results[month] = self.process_month(month)
+                        self.log_rejection_counts(month)
+                        if on_month_saved is not None:
+                            on_month_saved(month, self.month_results[month])
+                    except Exception as error:
+                        self.month_failures[month] = repr(error)
+                        logger.exception(f"{self.year}-{month} failed")
         except ValueError:
             logger.exception(
                 "there was an error running run() command, check logs for debug level"
             )
         finally:
-            logger.info(
-                "ALL dataframes were successfuly transformed and saved. Congratz"
-            )
+            if self.month_failures:
+                logger.error(
+                    f"months {sorted(self.month_failures)} failed, {sorted(self.month_results)} were transformed"
+                )
+            else:
+                logger.info(
+                    "ALL dataframes were successfuly transformed and saved. Congratz"
+                )
@@ -1,10 +1,24 @@
-import textwrap
 import os
-from typing import Any, Tuple
-import pyodbc
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional, Tuple
+import numpy as np
 import pandas as pd
 import logging
 
+from src.compact_trips import decode_compact_trips, trip_month_keys
+from src.connection_pool import Connection_pool
+from src.data_processing import MAX_TRIP_DURATION_IN_SECONDS
+from src.file_formats import read_transformed_file
+from src.manifest import Run_manifest, month_key_of_file
+from src.metrics import pipeline_metrics
+from src.query_cache import Query_cache
+from src.sql_backend import create_sql_backend
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -25,7 +39,11 @@ logger.addHandler(stream_handler)
 
 class Database_interactions:
     """
-    Class which interacts with azure sql database
+    Class which interacts with azure sql database, or an embedded sqlite database (see sql_backend).
+
+    ::Parameters::
+    :: sql_backend : sql_server or sqlite, SQL_BACKEND env variable or sql_server if None
+    :: sqlite_path : database file of the sqlite backend, SQLITE_DATABASE_PATH env variable or data/yellow_taxi.sqlite if None
 
     ::Requirements (hidden in env file)::
     :: ODBC Driver 17
@@ -36,36 +54,96 @@ class Database_interactions:
     ::Functions::
     :: create_connection:-> creates connection to database
     :: close_connection:-> closes connection to database
+    :: connection:-> context manager lending a pooled connection and a cursor, used by all methods
+    :: close_pool:-> closes idle pooled connections
+    :: partition_boundaries:-> first days of months covered by partitioned schema
+    :: create_table_sql_statements:-> sql creating the table in heap or partitioned schema
     :: create_table:-> creates specific table for this task in sql database.
     :: truncate_table:-> clears all values in the table if the table is created.
+    :: dataframe_batches:-> splits dataframe into batches of rows pyodbc can bind
+    :: insert_dataframe:-> inserts dataframe in batches using an open cursor
+    :: bcp_authentication_arguments:-> login arguments of bcp, without the sql password
+    :: insert_dataframe_with_bcp:-> bulk loads dataframe with bcp utility
+    :: insert_dataframe_to_sql_db:-> inserts dataframe held in memory to sql database
+    :: create_rollup_tables_sql_statements:-> sql creating hourly and daily rollup tables
+    :: create_checkpoint_table_sql_statement:-> sql creating the table of load checkpoints
+    :: get_load_checkpoint:-> rows committed by an earlier load of a month
+    :: save_load_checkpoint:-> records rows committed for a month, without commiting
+    :: resume_offset:-> rows of a month to skip when its load is resumed
+    :: refresh_rollups:-> rebuilds rollups of a single month
+    :: rollup_query_ranges:-> splits period into rollup and raw parts
+    :: get_average_passenger_count_from_rollups:-> range average answered from rollups
+    :: delete_month:-> deletes rows of a single month
+    :: replace_month:-> replaces rows of a single month (partition switch for partitioned schema)
     :: insert_transformed_data_to_sql_db: -> inserts transformed data to sql database in azure
     :: get_average_passenger_count_between_two_dates:-> returns the average passenger count in specified time period.
+    :: query_average_passenger_count:-> runs the average passenger count query on an open cursor
+    :: bucket_ranges:-> splits a period into consecutive ranges of a fixed size
+    :: get_passenger_count_aggregates:-> returns average, count and sum of passenger count for many ranges at once
+    :: query_passenger_count_aggregates:-> runs the multi-range aggregate query on an open cursor
+    :: aggregate_query_parts:-> splits a range of the aggregate query into rollup and raw parts
+    :: query_rollup_totals:-> totals of rollup buckets in many ranges, from one ordered read
+    :: query_raw_totals:-> totals of raw rows in many ranges, from one grouped scan
 
 
     return:: None
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self, sql_backend: Optional[str] = None, sqlite_path: Optional[str] = None
+    ) -> None:
         self.driver = "{ODBC Driver 17 for SQL Server}"
         self.servername = "yellowtaxidata"
         self.database_name = "yellow_taxi_database_2021"
         self.table_name = "yellow_taxi_info_2021"
+        # "heap" or "partitioned" (monthly partitions on pickup_datetime, see create_table_sql_statements)
+        self.schema = "heap"
+        # "columnstore" or "rowstore" clustered index of the partitioned table
+        self.partitioned_index = "columnstore"
+        # months covered by the partition function
+        self.partition_first_month = "2021-01"
+        self.partition_last_month = "2021-12"
+        # keeps hourly and daily passenger_count rollups up to date while loading and answers range averages from them
+        self.rollups = True
+        self.hourly_rollup_table_name = f"{self.table_name}_hourly_rollup"
+        self.daily_rollup_table_name = f"{self.table_name}_daily_rollup"
+        # rows committed per month, written in the same transaction as the rows, so interrupted loads resume exactly
+        self.checkpoint_table_name = f"{self.table_name}_load_checkpoints"
 
         self.server = "yellowtaxidata.database.windows.net,1433"
         self.username = os.getenv("USERNAME")
         self.password = os.getenv("PASSWORD")
 
-        self.connection_string = textwrap.dedent(
-            f"""
-    Driver={self.driver};
-    Server={self.server};
-    Database={self.database_name};
-    Uid={self.username};
-    Pwd={self.password};
-    Encrypt=yes;
-    TrustServerCertificate=no;
-    Connection Timeout=30;
-"""
+        # rows sent per executemany call and number of calls between commits
+        self.batch_size = 50_000
+        self.commit_every_batches = 10
+        # pickup ranges per scan of the aggregate query, two parameters each (sql server accepts 2100 parameters)
+        self.raw_parts_per_query = 500
+        # "executemany" or "bcp" (falls back to executemany if bcp is not installed)
+        self.bulk_method = "executemany"
+        # login of bcp: "trusted" (-T, kerberos) or "azure_ad" (-G, azure active directory)
+        # the sql password is never passed to bcp, other processes could read it from the command line
+        self.bcp_authentication = "trusted"
+        # results of query methods, dropped whenever truncate or insert changes the data
+        self.query_cache = Query_cache(max_entries=256, ttl_seconds=300)
+
+        backend_name = sql_backend or os.getenv("SQL_BACKEND", "sql_server")
+        if backend_name == "sqlite":
+            settings = {"path": sqlite_path}
+        else:
+            settings = {
+                "server": self.server,
+                "database_name": self.database_name,
+                "username": self.username,
+                "password": self.password,
+                "driver": self.driver,
+            }
+        self.sql_backend = create_sql_backend(backend_name, **settings)
+        # connections are reused between calls, see connection()
+        self.connection_pool = Connection_pool(
+            self.sql_backend.connect,
+            max_size=4,
+            idle_timeout_seconds=300,
         )
 
     def create_connection(self) -> Tuple:
@@ -77,7 +155,7 @@ class Database_interactions:
         """
 
         try:
-            connection = pyodbc.connect(self.connection_string)
+            connection = self.sql_backend.connect()
             logger.debug("database connection established")
             cursor = connection.cursor()
             logger.debug("cursor set succeeded")
@@ -110,32 +188,147 @@ class Database_interactions:
         else:
             logger.info("The connection was not open")
 
-    def create_table(self):
+    @contextmanager
+    def connection(self) -> Iterator[Tuple]:
         """
-        Creates table "yellow_taxi_info_2021" in azure sql database.
+        Lends a pooled connection and a new cursor for the with block. The cursor is closed and the connection
+        goes back to the pool on exit, also when the block raises (uncommitted work is rolled back).
 
-        :Param:: None
+        return:: connection, cursor
+        """
+        with self.connection_pool.checkout() as connection:
+            cursor = connection.cursor()
+            try:
+                yield connection, cursor
+            finally:
+                cursor.close()
 
-        return:: None
+    def close_pool(self) -> None:
+        self.connection_pool.close_all()
+
+    def partition_boundaries(self) -> list:
+        """
+        Returns first day of every month from partition_first_month to the month after partition_last_month.
         """
+        first_month = pd.Timestamp(f"{self.partition_first_month}-01")
+        last_month = pd.Timestamp(f"{self.partition_last_month}-01")
+        return list(
+            pd.date_range(first_month, last_month + pd.offsets.MonthBegin(1), freq="MS")
+        )
 
-        try:
-            conn, cursor = self.create_connection()
-            logger.debug("connectio creating table was successfull")
+    def create_table_sql_statements(self, table_name: str) -> list:
+        """
+        Returns sql statements creating the trips table in the chosen schema.
+
+        heap:        plain table without indexes.
+        partitioned: table partitioned monthly on pickup_datetime (RANGE RIGHT on the first day of every month),
+                     with a clustered columnstore index (or clustered rowstore index on pickup/dropoff) aligned to the partitions.
+                     Partition function and scheme are shared by the table and its staging table used for partition switching.
+
+        :param: table_name:-> name of the table to create
 
-            sql_code = f"""
-                    CREATE TABLE {self.table_name} (
+        return:: list of sql statements
+        """
+        if self.schema != "partitioned":
+            return [
+                f"""
+                    CREATE TABLE {table_name} (
                     pickup_datetime DATETIME2,
                     dropoff_datetime DATETIME2,
-                    passenger_count INT,
+                    passenger_count INT
                     ); """
+            ]
+        if not self.sql_backend.supports_partitions:
+            raise ValueError(
+                f"partitioned schema is not supported by {self.sql_backend.name} backend"
+            )
 
-            cursor.execute(sql_code)
-            logger.debug("table was successfully created")
-            cursor.commit()
-            logger.debug("table was successfully commited to database")
-            self.close_connection(conn, cursor)
-            logger.debug("connection was terminated succesfuly")
+        partition_function = f"{self.table_name}_monthly_pf"
+        partition_scheme = f"{self.table_name}_monthly_ps"
+        boundaries = ", ".join(
+            f"'{boundary:%Y-%m-%d}'" for boundary in self.partition_boundaries()
+        )
+        if self.partitioned_index == "columnstore":
+            index_sql = f"CREATE CLUSTERED COLUMNSTORE INDEX {table_name}_cci ON {table_name} ON {partition_scheme} (pickup_datetime)"
+        else:
+            index_sql = f"CREATE CLUSTERED INDEX {table_name}_cix ON {table_name} (pickup_datetime, dropoff_datetime) ON {partition_scheme} (pickup_datetime)"
+        return [
+            f"""IF NOT EXISTS (SELECT * FROM sys.partition_functions WHERE name = '{partition_function}')
+                    CREATE PARTITION FUNCTION {partition_function} (DATETIME2)
+                    AS RANGE RIGHT FOR VALUES ({boundaries})""",
+            f"""IF NOT EXISTS (SELECT * FROM sys.partition_schemes WHERE name = '{partition_scheme}')
+                    CREATE PARTITION SCHEME {partition_scheme}
+                    AS PARTITION {partition_function} ALL TO ([PRIMARY])""",
+            f"""
+                    CREATE TABLE {table_name} (
+                    pickup_datetime DATETIME2 NOT NULL,
+                    dropoff_datetime DATETIME2,
+                    passenger_count INT
+                    ) ON {partition_scheme} (pickup_datetime); """,
+            index_sql,
+        ]
+
+    def create_rollup_tables_sql_statements(self) -> list:
+        """
+        Returns sql statements creating hourly and daily rollup tables if they do not exist.
+        Every row holds a pickup bucket, sum and count of non-null passenger_count and count of trips.
+        """
+        return [
+            self.sql_backend.create_table_if_missing_sql(
+                rollup_table_name,
+                """bucket_start DATETIME2 NOT NULL PRIMARY KEY,
+                    passenger_sum BIGINT NOT NULL,
+                    passenger_rows BIGINT NOT NULL,
+                    trip_count BIGINT NOT NULL""",
+            )
+            for rollup_table_name in [
+                self.hourly_rollup_table_name,
+                self.daily_rollup_table_name,
+            ]
+        ]
+
+    def create_checkpoint_table_sql_statement(self) -> str:
+        """
+        Returns sql creating the load checkpoint table if it does not exist. Every row holds a month,
+        fingerprint (blob etag) of the loaded data, rows committed so far and whether the month is complete.
+        """
+        return self.sql_backend.create_table_if_missing_sql(
+            self.checkpoint_table_name,
+            """month_key VARCHAR(7) NOT NULL PRIMARY KEY,
+                    fingerprint VARCHAR(256) NOT NULL,
+                    rows_committed BIGINT NOT NULL,
+                    completed BIT NOT NULL,
+                    updated_at DATETIME2 NOT NULL""",
+        )
+
+    def create_table(self):
+        """
+        Creates table "yellow_taxi_info_2021" in azure sql database, as a heap or partitioned table (see schema).
+        An existing table is kept as it is, rollup and checkpoint tables are created if they are missing.
+
+        :Param:: None
+
+        return:: None
+        """
+
+        try:
+            with self.connection() as (conn, cursor):
+                logger.debug("connectio creating table was successfull")
+
+                if self.rollups:
+                    for sql_code in self.create_rollup_tables_sql_statements():
+                        cursor.execute(sql_code)
+                cursor.execute(self.create_checkpoint_table_sql_statement())
+                # helper tables are kept even if the trips table already exists
+                cursor.commit()
+                if self.sql_backend.table_exists(cursor, self.table_name):
+                    logger.info(f"table {self.table_name} already exists")
+                    return
+                for sql_code in self.create_table_sql_statements(self.table_name):
+                    cursor.execute(sql_code)
+                logger.debug("table was successfully created")
+                cursor.commit()
+                logger.debug("table was successfully commited to database")
         except:
             logger.exception(
                 "there was an issue creating the table check if sql code is corect"
@@ -151,19 +344,30 @@ class Database_interactions:
 
         return:: None
         """
-        conn, cursor = self.create_connection()
-        logger.debug("connection was succesful before truncating table")
         try:
-            sql_code = f"TRUNCATE TABLE {self.table_name}"
-
-            cursor.execute(sql_code)
-            logger.debug("cursor execute truncate sql code")
+            with self.connection() as (conn, cursor):
+                logger.debug("connection was succesful before truncating table")
+                sql_code = self.sql_backend.truncate_table_sql(self.table_name)
 
-            cursor.commit()
-            logger.debug("table was successfuly truncated")
+                cursor.execute(sql_code)
+                logger.debug("cursor execute truncate sql code")
+                if self.rollups:
+                    for rollup_table_name in [
+                        self.hourly_rollup_table_name,
+                        self.daily_rollup_table_name,
+                    ]:
+                        cursor.execute(
+                            self.sql_backend.truncate_table_sql(rollup_table_name)
+                        )
+                    logger.debug("rollup tables truncated")
+                cursor.execute(self.create_checkpoint_table_sql_statement())
+                cursor.execute(
+                    self.sql_backend.truncate_table_sql(self.checkpoint_table_name)
+                )
 
-            self.close_connection(connection=conn, cursor=cursor)
-            logger.debug("connection was terminated successfuly")
+                cursor.commit()
+                self.query_cache.invalidate()
+                logger.debug("table was successfuly truncated")
         except:
             logger.exception(
                 f"there was an connection or value error truncating the {self.table_name}"
@@ -171,43 +375,553 @@ class Database_interactions:
         else:
             logger.info(f"{self.table_name} was successfully truncated")
 
-    def insert_transformed_data_to_sql_db(self) -> None:
+    def refresh_rollups(self, cursor: Any, month_key: str) -> None:
         """
-        Inserts transformed data from local extracted_from_azure_transformed folder to azure sql datbase.
+        Rebuilds hourly and daily rollups of a single month from raw rows and commits.
+        Hourly buckets are aggregated from raw rows, daily buckets from hourly ones.
 
-        :param: None
+        :param: cursor:-> cursor to sql database (from function create_connection)
+        :param: month_key:-> "year-month" to rebuild, eg. 2021-01
+        """
+        month_start = pd.Timestamp(f"{month_key}-01").to_pydatetime()
+        next_month_start = (
+            pd.Timestamp(f"{month_key}-01") + pd.offsets.MonthBegin(1)
+        ).to_pydatetime()
+        hour_bucket = self.sql_backend.hour_bucket_sql("pickup_datetime")
+        day_bucket = self.sql_backend.day_bucket_sql("bucket_start")
+        for rollup_table_name in [
+            self.hourly_rollup_table_name,
+            self.daily_rollup_table_name,
+        ]:
+            cursor.execute(
+                f"DELETE FROM {rollup_table_name} WHERE bucket_start >= ? AND bucket_start < ?",
+                month_start,
+                next_month_start,
+            )
+        cursor.execute(
+            f"""INSERT INTO {self.hourly_rollup_table_name} (bucket_start, passenger_sum, passenger_rows, trip_count)
+                SELECT {hour_bucket}, SUM(CAST(passenger_count AS BIGINT)), COUNT(passenger_count), COUNT(*)
+                FROM {self.table_name}
+                WHERE pickup_datetime >= ? AND pickup_datetime < ?
+                GROUP BY {hour_bucket}""",
+            month_start,
+            next_month_start,
+        )
+        cursor.execute(
+            f"""INSERT INTO {self.daily_rollup_table_name} (bucket_start, passenger_sum, passenger_rows, trip_count)
+                SELECT {day_bucket}, SUM(passenger_sum), SUM(passenger_rows), SUM(trip_count)
+                FROM {self.hourly_rollup_table_name}
+                WHERE bucket_start >= ? AND bucket_start < ?
+                GROUP BY {day_bucket}""",
+            month_start,
+            next_month_start,
+        )
+        cursor.commit()
+        logger.info(f"rollups of {month_key} refreshed")
 
-        return: None
+    def rollup_query_ranges(self, start_datetime, end_datetime) -> dict:
         """
-        conn, cursor = self.create_connection()
-        logger.debug("connection inserting data to sql was successful")
-        cursor.fast_executemany = True
-        try:
-            dirListing = os.listdir("data/extracted_from_azure_transformed/")
-            logger.debug("directory path described correctly")
+        Splits a period into parts answered by daily rollups, hourly rollups and raw rows.
+        Whole buckets are used only if they end at least MAX_TRIP_DURATION_IN_SECONDS before the end of the period:
+        every trip picked up in them has dropped off before the end, so the dropoff filter of the raw query holds for all of them.
+        Partial buckets at the edges and the last 12 hours are read from raw rows with the full filter.
+
+        :param: start_datetime:-> beginning of the period
+        :param: end_datetime:-> end of the period
+
+        return:: dict of (start, end) half-open ranges: "daily", "hourly_head", "hourly_tail", "raw_head", and "raw_tail" (closed at the end)
+        """
+        start = pd.Timestamp(start_datetime)
+        end = pd.Timestamp(end_datetime)
+        last_safe_pickup = end - pd.Timedelta(seconds=MAX_TRIP_DURATION_IN_SECONDS)
+        hour_start = start.ceil("h")
+        hour_end = last_safe_pickup.floor("h")
+        if hour_start >= hour_end:
+            # period too short for whole buckets, everything comes from raw rows
+            hour_start = hour_end = start
+        day_start = min(hour_start.ceil("D"), hour_end)
+        day_end = max(hour_end.floor("D"), day_start)
+        return {
+            "daily": (day_start, day_end),
+            "hourly_head": (hour_start, day_start),
+            "hourly_tail": (day_end, hour_end),
+            "raw_head": (start, hour_start),
+            "raw_tail": (hour_end, end),
+        }
+
+    def get_average_passenger_count_from_rollups(
+        self, cursor: Any, start_datetime_of_period: str, end_datetime_of_period: str
+    ) -> Optional[float]:
+        """
+        Returns the same average as the raw query, reading whole buckets from rollups and only the edges from raw rows.
+
+        :param: cursor:-> cursor to sql database (from function create_connection)
+        :param: start_datetime_of_period:-> beginning of period. eg. 2021-01-02 00:21:34
+        :param: end_datetime_of_period:-> end of period. eg. 2021-06-24 04:12:22
+
+        return:: average passenger count, None if there are no trips
+        """
+        ranges = {
+            part: (range_start.to_pydatetime(), range_end.to_pydatetime())
+            for part, (range_start, range_end) in self.rollup_query_ranges(
+                start_datetime_of_period, end_datetime_of_period
+            ).items()
+        }
+        sql_code = f"""SELECT SUM(passenger_sum), SUM(passenger_rows) FROM (
+                SELECT passenger_sum, passenger_rows FROM {self.daily_rollup_table_name}
+                    WHERE bucket_start >= ? AND bucket_start < ?
+                UNION ALL
+                SELECT passenger_sum, passenger_rows FROM {self.hourly_rollup_table_name}
+                    WHERE (bucket_start >= ? AND bucket_start < ?) OR (bucket_start >= ? AND bucket_start < ?)
+                UNION ALL
+                SELECT SUM(CAST(passenger_count AS BIGINT)), COUNT(passenger_count) FROM {self.table_name}
+                    WHERE ((pickup_datetime >= ? AND pickup_datetime < ?) OR (pickup_datetime >= ? AND pickup_datetime <= ?))
+                        AND dropoff_datetime <= ?
+            ) AS parts"""
+        passenger_sum, passenger_rows = cursor.execute(
+            sql_code,
+            *ranges["daily"],
+            *ranges["hourly_head"],
+            *ranges["hourly_tail"],
+            *ranges["raw_head"],
+            *ranges["raw_tail"],
+            ranges["raw_tail"][1],
+        ).fetchone()
+        if not passenger_rows:
+            return None
+        return float(passenger_sum) / passenger_rows
+
+    def get_load_checkpoint(self, cursor: Any, month_key: str) -> Optional[dict]:
+        row = cursor.execute(
+            f"SELECT fingerprint, rows_committed, completed FROM {self.checkpoint_table_name} WHERE month_key = ?",
+            month_key,
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "fingerprint": row[0],
+            "rows_committed": int(row[1]),
+            "completed": bool(row[2]),
+        }
+
+    def save_load_checkpoint(
+        self,
+        cursor: Any,
+        month_key: str,
+        fingerprint: str,
+        rows_committed: int,
+        completed: bool = False,
+    ) -> None:
+        """
+        Records rows committed for a month using an open cursor, without commiting,
+        so the checkpoint is committed in the same transaction as the rows it counts.
+
+        :param: cursor:-> cursor to sql database (from function connection)
+        :param: month_key:-> "year-month" of the data, eg. 2021-01
+        :param: fingerprint:-> etag of the transformed blob being loaded
+        :param: rows_committed:-> rows of the month in the target table after the next commit
+        :param: completed:-> True when the whole month is loaded
+        """
+        cursor.execute(
+            f"DELETE FROM {self.checkpoint_table_name} WHERE month_key = ?", month_key
+        )
+        cursor.execute(
+            f"INSERT INTO {self.checkpoint_table_name} VALUES (?, ?, ?, ?, ?)",
+            month_key,
+            fingerprint,
+            rows_committed,
+            completed,
+            datetime.utcnow(),
+        )
+
+    def resume_offset(
+        self,
+        cursor: Any,
+        month_key: str,
+        fingerprint: str,
+        table_name: Optional[str] = None,
+    ) -> Optional[int]:
+        """
+        Returns how many rows of the month were already committed by an interrupted load of the same data,
+        0 if the month has to be loaded from the start, None if it is completely loaded.
+
+        :param: cursor:-> cursor to sql database (from function connection)
+        :param: month_key:-> "year-month" of the data, eg. 2021-01
+        :param: fingerprint:-> etag of the transformed blob being loaded
+        :param: table_name:-> staging table holding the committed rows, checked to still hold exactly them
+        """
+        checkpoint = self.get_load_checkpoint(cursor, month_key)
+        if checkpoint is None or checkpoint["fingerprint"] != fingerprint:
+            return 0
+        if checkpoint["completed"]:
+            return None
+        if table_name is not None:
+            staged_rows = cursor.execute(
+                f"SELECT COUNT_BIG(*) FROM {table_name}"
+            ).fetchone()[0]
+            if staged_rows != checkpoint["rows_committed"]:
+                logger.info(f"{table_name} holds other rows, {month_key} starts again")
+                return 0
+        return checkpoint["rows_committed"]
+
+    def delete_month(self, cursor: Any, month_key: str) -> None:
+        """
+        Deletes rows of a single month (by pickup_datetime) using an open cursor, without commiting.
+        Used by incremental runs to reload only the months which changed.
 
-            sql_code = f"INSERT INTO {self.table_name} VALUES (?,?,?)"
+        :param: cursor:-> cursor to sql database (from function create_connection)
+        :param: month_key:-> "year-month" of the rows to delete, eg. 2021-01
+        """
+        month_start = pd.Timestamp(f"{month_key}-01")
+        next_month_start = month_start + pd.offsets.MonthBegin(1)
+        cursor.execute(
+            f"DELETE FROM {self.table_name} WHERE pickup_datetime >= ? AND pickup_datetime < ?",
+            month_start.to_pydatetime(),
+            next_month_start.to_pydatetime(),
+        )
+        logger.info(f"{cursor.rowcount} rows of {month_key} deleted before reload")
+
+    def replace_month(
+        self,
+        cursor: Any,
+        month_key: str,
+        dataframe: pd.DataFrame,
+        name: str,
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        """
+        Replaces all rows of a single month with the dataframe.
+        Heap tables delete the month and insert it. Without a fingerprint the delete and insert are one transaction
+        (committed at the end), with a fingerprint rows are committed every commit_every_batches batches, so a failure
+        leaves the month deleted and partly loaded until a resumed load of the same data completes it.
+        bcp loads commit batches on their own connection and are never atomic.
+        Partitioned tables load the month to a staging table and switch its partition in,
+        so other months are not touched and the old rows are removed by a metadata-only partition truncate.
+        With a fingerprint the load is checkpointed every commit (see save_load_checkpoint): a load of the same data
+        interrupted before goes on after the rows it committed, a completely loaded month is skipped.
+
+        :param: cursor:-> cursor to sql database (from function create_connection)
+        :param: month_key:-> "year-month" of the data, eg. 2021-01
+        :param: dataframe:-> transformed pandas dataframe of the month
+        :param: name:-> name of the data used in logs, eg. file name
+        :param: fingerprint:-> etag of the transformed blob, the load is not checkpointed if None
+
+        return:: None
+        """
+        staging_table_name = f"{self.table_name}_staging"
+        offset = 0
+        if fingerprint is not None:
+            offset = self.resume_offset(
+                cursor,
+                month_key,
+                fingerprint,
+                table_name=staging_table_name if self.schema == "partitioned" else None,
+            )
+            if offset is None:
+                logger.info(f"{month_key} was already loaded, skipped")
+                return
+            if offset:
+                logger.info(f"{month_key} load resumed after {offset} committed rows")
+        checkpoint = (month_key, fingerprint, offset) if fingerprint else None
+
+        if self.schema != "partitioned":
+            if not offset:
+                self.delete_month(cursor, month_key)
+            # without a checkpoint a partly loaded month could not be resumed, delete and insert commit together
+            self.insert_dataframe(
+                cursor,
+                dataframe.iloc[offset:],
+                name,
+                checkpoint=checkpoint,
+                intermediate_commits=checkpoint is not None,
+            )
+            if checkpoint is not None:
+                self.save_load_checkpoint(
+                    cursor, month_key, fingerprint, len(dataframe), completed=True
+                )
+                cursor.commit()
+            return
 
-            for i in range(1, len(dirListing) + 1):
-                df = pd.read_csv(
-                    "data/extracted_from_azure_transformed/clean_yellow_trip_data_2021-0"
-                    + str(i)
-                    + ".csv"
+        if cursor.tables(table=staging_table_name).fetchone() is None:
+            # partition function and scheme already exist, only the table and index are created
+            for sql_code in self.create_table_sql_statements(staging_table_name)[2:]:
+                cursor.execute(sql_code)
+        if not offset:
+            cursor.execute(f"TRUNCATE TABLE {staging_table_name}")
+        self.insert_dataframe(
+            cursor,
+            dataframe.iloc[offset:],
+            name,
+            table_name=staging_table_name,
+            checkpoint=checkpoint,
+        )
+
+        partition_number = cursor.execute(
+            f"SELECT $PARTITION.{self.table_name}_monthly_pf(?)",
+            pd.Timestamp(f"{month_key}-01").to_pydatetime(),
+        ).fetchval()
+        cursor.execute(
+            f"TRUNCATE TABLE {self.table_name} WITH (PARTITIONS ({partition_number}))"
+        )
+        cursor.execute(
+            f"ALTER TABLE {staging_table_name} SWITCH PARTITION {partition_number} TO {self.table_name} PARTITION {partition_number}"
+        )
+        if checkpoint is not None:
+            self.save_load_checkpoint(
+                cursor, month_key, fingerprint, len(dataframe), completed=True
+            )
+        cursor.commit()
+        logger.info(f"{month_key} switched in as partition {partition_number}")
+
+    def dataframe_batches(self, dataframe: pd.DataFrame) -> Iterator[list]:
+        """
+        Yields rows of the dataframe as lists of (pickup, dropoff, passenger_count) tuples, batch_size rows at a time.
+        Only one batch of python objects exists at once, instead of one python list per row of the whole month.
+
+        :param: dataframe:-> transformed pandas dataframe, compact ones are decoded one batch at a time
+
+        return:: iterator of lists of tuples pyodbc can bind
+        """
+        for start in range(0, len(dataframe), self.batch_size):
+            batch = decode_compact_trips(
+                dataframe.iloc[start : start + self.batch_size]
+            )
+            passenger_count = batch.passenger_count.astype("Int64").to_numpy(
+                dtype=object, na_value=None
+            )
+            yield list(
+                zip(
+                    batch.pickup_datetime.dt.to_pydatetime(),
+                    batch.dropoff_datetime.dt.to_pydatetime(),
+                    passenger_count,
                 )
-                logger.debug(f"dataframe 2021-0" + str(i) + "was read succesfully")
-                cursor.executemany(sql_code, df.values.tolist())
-                logger.debug(
-                    "cursor succesfully executed sql code and read data from dataframe"
+            )
+
+    def insert_dataframe(
+        self,
+        cursor: Any,
+        dataframe: pd.DataFrame,
+        name: str,
+        table_name: Optional[str] = None,
+        checkpoint: Optional[tuple] = None,
+        intermediate_commits: bool = True,
+    ) -> None:
+        """
+        Inserts transformed dataframe using an open cursor in batches of batch_size rows with typed parameters.
+        Commits every commit_every_batches batches and at the end. Uses bcp instead if bulk_method is "bcp"
+        (sql server backend only).
+
+        :param: cursor:-> cursor to sql database (from function create_connection)
+        :param: dataframe:-> transformed pandas dataframe
+        :param: name:-> name of the data used in logs, eg. file name
+        :param: table_name:-> table to insert to, table_name of the class if None
+        :param: checkpoint:-> (month_key, fingerprint, rows already committed), rows committed so far are saved
+                              with every commit (see save_load_checkpoint). bcp commits batches on its own connection,
+                              so its loads are checkpointed only when complete.
+        :param: intermediate_commits:-> False commits only at the end, together with earlier uncommitted changes
+
+        return:: None
+        """
+        table_name = table_name or self.table_name
+        started = time.perf_counter()
+        if (
+            self.bulk_method == "bcp"
+            and self.sql_backend.supports_bcp
+            and shutil.which("bcp")
+        ):
+            # bcp uses its own connection, pending changes (eg. delete_month) are commited first
+            cursor.commit()
+            self.insert_dataframe_with_bcp(dataframe, name, table_name)
+            if checkpoint is not None:
+                month_key, fingerprint, rows_before = checkpoint
+                self.save_load_checkpoint(
+                    cursor, month_key, fingerprint, rows_before + len(dataframe)
                 )
                 cursor.commit()
-                logger.debug("sql code was successfuly commited")
-                logger.info(
-                    "dataframe 2021-0"
-                    + str(i)
-                    + "successfuly commited to azure sql database"
+        else:
+            if self.bulk_method == "bcp":
+                logger.warning(
+                    f"bcp can not be used with {self.sql_backend.name} backend or was not found, executemany is used"
                 )
+            sql_code = f"INSERT INTO {table_name} VALUES (?,?,?)"
+            rows_sent = 0
+            for batch_number, rows in enumerate(self.dataframe_batches(dataframe), 1):
+                self.sql_backend.prepare_batch(cursor)
+                cursor.executemany(sql_code, rows)
+                rows_sent += len(rows)
+                if (
+                    intermediate_commits
+                    and batch_number % self.commit_every_batches == 0
+                ):
+                    self.checkpoint_rows(cursor, checkpoint, rows_sent)
+                    cursor.commit()
+                    logger.debug(f"{batch_number} batches of {name} commited")
+            self.checkpoint_rows(cursor, checkpoint, rows_sent)
+            cursor.commit()
+        logger.debug("sql code was successfuly commited")
+
+        seconds = time.perf_counter() - started
+        logger.info(
+            f"dataframe {name} successfuly commited to azure sql database, "
+            f"{len(dataframe)} rows in {seconds:.1f}s ({len(dataframe) / max(seconds, 1e-9):.0f} rows/s)"
+        )
 
-            self.close_connection(conn, cursor)
+    def checkpoint_rows(
+        self, cursor: Any, checkpoint: Optional[tuple], rows_sent: int
+    ) -> None:
+        if checkpoint is not None:
+            month_key, fingerprint, rows_before = checkpoint
+            self.save_load_checkpoint(
+                cursor, month_key, fingerprint, rows_before + rows_sent
+            )
+
+    def bcp_authentication_arguments(self) -> list:
+        if self.bcp_authentication == "trusted":
+            return ["-T"]
+        if self.bcp_authentication == "azure_ad":
+            return ["-G"]
+        raise ValueError(
+            f"bcp authentication {self.bcp_authentication} is not one of ['trusted', 'azure_ad']"
+        )
+
+    def insert_dataframe_with_bcp(
+        self, dataframe: pd.DataFrame, name: str, table_name: str
+    ) -> None:
+        """
+        Bulk loads dataframe with the bcp utility (mssql-tools, see odbcDrivers.sh) through a temporary tab separated file.
+        bcp logs in with bcp_authentication, a failed load raises CalledProcessError without the command line.
+
+        :param: dataframe:-> transformed or compact pandas dataframe
+        :param: name:-> name of the data used in logs, eg. file name
+        :param: table_name:-> table to load to
+
+        return:: None
+        """
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            data_file_path = os.path.join(temporary_directory, "bcp_data.tsv")
+            decode_compact_trips(dataframe)[
+                ["pickup_datetime", "dropoff_datetime", "passenger_count"]
+            ].astype({"passenger_count": "Int64"}).to_csv(
+                data_file_path,
+                sep="\t",
+                header=False,
+                index=False,
+                date_format="%Y-%m-%d %H:%M:%S",
+            )
+            try:
+                subprocess.run(
+                    [
+                        "bcp",
+                        f"{self.database_name}.dbo.{table_name}",
+                        "in",
+                        data_file_path,
+                        "-c",
+                        "-S",
+                        self.server,
+                        *self.bcp_authentication_arguments(),
+                        "-b",
+                        str(self.batch_size * self.commit_every_batches),
+                    ],
+                    check=True,
+                    capture_output=True,
+                )
+            except subprocess.CalledProcessError as error:
+                # the error is logged, arguments (server, user) are left out of it and of its traceback
+                raise subprocess.CalledProcessError(
+                    error.returncode,
+                    ["bcp", "<arguments redacted>"],
+                    output=error.output,
+                    stderr=error.stderr,
+                ) from None
+        logger.debug(f"{name} was loaded with bcp")
+
+    def insert_dataframe_to_sql_db(
+        self,
+        dataframe: pd.DataFrame,
+        name: str,
+        replace_month_key: Optional[str] = None,
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        """
+        Inserts transformed dataframe held in memory to azure sql database, used when data is not staged in local files.
+
+        :param: dataframe:-> transformed pandas dataframe
+        :param: name:-> name of the data used in logs, eg. 2021-01
+        :param: replace_month_key:-> rows of this month ("year-month") are replaced by the dataframe (see replace_month)
+        :param: fingerprint:-> etag of the transformed blob, checkpoints the month replacement (see replace_month)
+
+        return:: None
+        """
+        try:
+            with pipeline_metrics.stage(
+                "sql_load", month_key=name, rows_in=len(dataframe)
+            ), self.connection() as (conn, cursor):
+                if replace_month_key is not None:
+                    self.replace_month(
+                        cursor, replace_month_key, dataframe, name, fingerprint
+                    )
+                else:
+                    self.insert_dataframe(cursor, dataframe, name)
+                if self.rollups:
+                    for month_key in trip_month_keys(dataframe):
+                        self.refresh_rollups(cursor, month_key)
+        finally:
+            self.query_cache.invalidate()
+
+    def insert_transformed_data_to_sql_db(
+        self, manifest: Optional[Run_manifest] = None
+    ) -> None:
+        """
+        Inserts transformed data from local extracted_from_azure_transformed folder to azure sql datbase.
+        Files can be in any format supported by file_formats (csv, parquet, arrow).
+        With a manifest (incremental runs) existing rows of every loaded month are replaced, other months are not touched.
+        Such loads are checkpointed every commit, so a run interrupted in the middle of a month goes on after the rows
+        it committed and months already loaded are skipped.
+
+        :param: manifest:-> run manifest for incremental runs
+
+        return: None
+        """
+        try:
+            with self.connection() as (conn, cursor):
+                logger.debug("connection inserting data to sql was successful")
+                local_path = "data/extracted_from_azure_transformed"
+                dirListing = sorted(os.listdir(local_path))
+                logger.debug("directory path described correctly")
+
+                for file_name in dirListing:
+                    file_path = os.path.join(local_path, file_name)
+                    month_key = month_key_of_file(file_name)
+                    fingerprint = None
+                    if manifest is not None:
+                        extracted = manifest.get("transformed_extract", month_key)
+                        fingerprint = extracted["fingerprint"] if extracted else None
+                        if fingerprint is not None and manifest.is_unchanged(
+                            "sql_load", month_key, fingerprint
+                        ):
+                            logger.info(f"{file_name} was already loaded, skipped")
+                            continue
+                    with pipeline_metrics.stage(
+                        "sql_load",
+                        month_key=month_key,
+                        bytes=os.path.getsize(file_path),
+                    ) as metrics:
+                        # compact files stay compact until they are sent in batches
+                        df = read_transformed_file(file_path, compact=None)
+                        logger.debug(f"dataframe {file_name} was read succesfully")
+                        metrics["rows_in"] = len(df)
+                        if manifest is None:
+                            self.insert_dataframe(cursor, df, file_name)
+                        else:
+                            self.replace_month(
+                                cursor, month_key, df, file_name, fingerprint
+                            )
+                        if self.rollups:
+                            self.refresh_rollups(cursor, month_key)
+                    if manifest is None:
+                        continue
+
+                    manifest.record("sql_load", month_key, fingerprint, rows=len(df))
         except ConnectionError or ValueError:
             logger.exception(
                 "there is connection or value problem inserting transformed data to sql"
@@ -220,39 +934,391 @@ class Database_interactions:
             logger.info(
                 "all dataframes were successfully moved to azure sql database and extracted transformed data removed from local file"
             )
+        finally:
+            # months committed before a failure changed the data as well
+            self.query_cache.invalidate()
 
     def get_average_passenger_count_between_two_dates(
         self, start_datetime_of_period: str, end_datetime_of_period: str
     ):
         """
         Connects to azure sql database and retreives average passenger count between two dates.
+        pickup_datetime <= end does not change the result (cleaned rides drop off after pickup),
+        it lets partitioned and indexed tables skip data after the period.
+        With rollups whole hours / days are read from rollup tables and only the edges from raw rows (same result).
+        Results are cached per normalised period until the data changes (see query_cache).
 
         :param: start_datetime_of_period:-> string datetime value of beginning of period. eg. 2021-01-02 00:21:34
         :param: end_datetime_of_period:-> string datime value of the end of period. eg. 2021-06-24 04:12:22
 
         return:: average passenger count between two dates.
         """
-        conn, cursor = self.create_connection()
-        logger.debug("connection was successfull to sql database")
+        cache_key = (
+            "average_passenger_count",
+            self.table_name,
+            pd.Timestamp(start_datetime_of_period),
+            pd.Timestamp(end_datetime_of_period),
+        )
+        generation = self.query_cache.generation
+        hit, average = self.query_cache.get(cache_key)
+        if hit:
+            logger.info(
+                f"average customer number in defined perdiod is {average} (cached)"
+            )
+            return average
+
+        average = None
         try:
-            sql_code = f"""SELECT avg(cast(passenger_count as float)) 
-                            FROM {self.table_name} AS a 
-                                WHERE a.pickup_datetime >= '{start_datetime_of_period}' 
-                                    and
-                                        a.dropoff_datetime <= '{end_datetime_of_period}' ;
-                                    """
-            cursor.execute(sql_code)
+            with pipeline_metrics.stage(
+                "average_query", rollups=self.rollups
+            ), self.connection() as (conn, cursor):
+                logger.debug("connection was successfull to sql database")
+                average = self.query_average_passenger_count(
+                    cursor, start_datetime_of_period, end_datetime_of_period
+                )
             logger.info(
                 "sql code executed successfully to retreive average customer number in time period"
             )
-            records = cursor.fetchall()
-            logger.debug("records were fetched successfully")
-
-            self.close_connection(conn, cursor)
-            logger.info("connection was closed successfully")
+            self.query_cache.put(cache_key, average, generation)
         except ConnectionError or ValueError:
             logger.exception("connection or sql code failed. check code")
         finally:
-            logger.info(
-                f"average customer number in defined perdiod is {records[0][0]}"
+            logger.info(f"average customer number in defined perdiod is {average}")
+        return average
+
+    def query_average_passenger_count(
+        self, cursor: Any, start_datetime_of_period: str, end_datetime_of_period: str
+    ) -> Optional[float]:
+        """
+        Runs the average passenger count query on an open cursor, from rollups if they are enabled.
+
+        :param: cursor:-> cursor to sql database (from function connection)
+        :param: start_datetime_of_period:-> beginning of period. eg. 2021-01-02 00:21:34
+        :param: end_datetime_of_period:-> end of period. eg. 2021-06-24 04:12:22
+
+        return:: average passenger count, None if there are no trips
+        """
+        if self.rollups:
+            return self.get_average_passenger_count_from_rollups(
+                cursor, start_datetime_of_period, end_datetime_of_period
             )
+        sql_code = f"""SELECT avg(cast(passenger_count as float)) 
+                    FROM {self.table_name} AS a 
+                        WHERE a.pickup_datetime >= '{start_datetime_of_period}' 
+                            and
+                                a.dropoff_datetime <= '{end_datetime_of_period}'
+                            and
+                                a.pickup_datetime <= '{end_datetime_of_period}' ;
+                            """
+        cursor.execute(sql_code)
+        records = cursor.fetchall()
+        logger.debug("records were fetched successfully")
+        return records[0][0]
+
+    def bucket_ranges(
+        self, start_datetime_of_period: str, end_datetime_of_period: str, bucket
+    ) -> list:
+        """
+        Splits a period into consecutive ranges of bucket size starting at the beginning of the period,
+        the last range ends at the end of the period. Ranges are closed like the period of the average query,
+        so every range ends one microsecond before the next one starts and no trip is counted twice.
+
+        :param: start_datetime_of_period:-> beginning of period. eg. 2021-01-02 00:21:34
+        :param: end_datetime_of_period:-> end of period. eg. 2021-06-24 04:12:22
+        :param: bucket:-> size of the ranges, eg. "1h", "1D", "7D" or a pandas Timedelta
+
+        return:: list of (start, end) timestamps
+        """
+        start = pd.Timestamp(start_datetime_of_period)
+        end = pd.Timestamp(end_datetime_of_period)
+        size = pd.Timedelta(bucket)
+        if size <= pd.Timedelta(0):
+            raise ValueError(f"bucket {bucket} must be a positive duration")
+        starts = [
+            range_start
+            for range_start in pd.date_range(start, end, freq=size)
+            if range_start < end
+        ] or [start]
+        ends = [
+            range_start - pd.Timedelta(microseconds=1) for range_start in starts[1:]
+        ] + [end]
+        return list(zip(starts, ends))
+
+    def get_passenger_count_aggregates(
+        self,
+        ranges: Optional[list] = None,
+        start_datetime_of_period: Optional[str] = None,
+        end_datetime_of_period: Optional[str] = None,
+        bucket=None,
+    ) -> pd.DataFrame:
+        """
+        Returns passenger count aggregates of many ranges, computed together on one pooled connection
+        (see query_passenger_count_aggregates). Every range uses the filter of the average query
+        (pickup in the range, dropoff before its end).
+        Results are cached per list of ranges until the data changes (see query_cache).
+
+        :param: ranges:-> list of (start, end) datetimes, eg. [("2021-01-01 00:00:00", "2021-01-07 23:59:59"), ...]
+        :param: start_datetime_of_period:-> beginning of period split into buckets, used if ranges is None
+        :param: end_datetime_of_period:-> end of period split into buckets, used if ranges is None
+        :param: bucket:-> size of the buckets (see bucket_ranges), eg. "1D"
+
+        return:: pandas dataframe with a row per range in the given order: start_datetime, end_datetime,
+                 average_passenger_count (NaN without trips), passenger_sum, passenger_rows (trips with
+                 a passenger count) and trip_count
+        """
+        if ranges is None:
+            if (
+                bucket is None
+                or start_datetime_of_period is None
+                or end_datetime_of_period is None
+            ):
+                raise ValueError("pass ranges, or a period and a bucket size")
+            ranges = self.bucket_ranges(
+                start_datetime_of_period, end_datetime_of_period, bucket
+            )
+        ranges = [
+            (pd.Timestamp(range_start), pd.Timestamp(range_end))
+            for range_start, range_end in ranges
+        ]
+        cache_key = ("passenger_count_aggregates", self.table_name, tuple(ranges))
+        generation = self.query_cache.generation
+        hit, aggregates = self.query_cache.get(cache_key)
+        if hit:
+            logger.info(f"aggregates of {len(ranges)} ranges retreived (cached)")
+            return aggregates.copy()
+
+        with pipeline_metrics.stage(
+            "aggregate_query", ranges=len(ranges)
+        ), self.connection() as (conn, cursor):
+            aggregates = self.query_passenger_count_aggregates(cursor, ranges)
+        self.query_cache.put(cache_key, aggregates, generation)
+        logger.info(f"aggregates of {len(ranges)} ranges retreived")
+        return aggregates.copy()
+
+    def query_passenger_count_aggregates(
+        self, cursor: Any, ranges: list
+    ) -> pd.DataFrame:
+        """
+        Answers all ranges with one ordered read of each rollup table and one grouped scan of raw rows,
+        instead of joining the ranges against the trips table. Whole buckets come from rollups if they are enabled.
+
+        :param: cursor:-> cursor to sql database (from function connection)
+        :param: ranges:-> list of (start, end) pandas timestamps
+
+        return:: pandas dataframe, see get_passenger_count_aggregates
+        """
+        parts = [
+            self.aggregate_query_parts(range_start, range_end)
+            for range_start, range_end in ranges
+        ]
+        totals = self.query_raw_totals(
+            cursor,
+            [range_parts["raw"] for range_parts in parts],
+            [range_end for _, range_end in ranges],
+        )
+        if self.rollups:
+            totals += self.query_rollup_totals(
+                cursor,
+                self.daily_rollup_table_name,
+                [range_parts["daily"] for range_parts in parts],
+            )
+            totals += self.query_rollup_totals(
+                cursor,
+                self.hourly_rollup_table_name,
+                [range_parts["hourly"] for range_parts in parts],
+            )
+
+        aggregates = pd.DataFrame(
+            {
+                "start_datetime": [range_start for range_start, _ in ranges],
+                "end_datetime": [range_end for _, range_end in ranges],
+                "passenger_sum": pd.Series(totals[:, 0], dtype="int64"),
+                "passenger_rows": pd.Series(totals[:, 1], dtype="int64"),
+                "trip_count": pd.Series(totals[:, 2], dtype="int64"),
+            }
+        )
+        aggregates.insert(
+            2,
+            "average_passenger_count",
+            aggregates.passenger_sum
+            / aggregates.passenger_rows.where(aggregates.passenger_rows > 0),
+        )
+        return aggregates
+
+    def aggregate_query_parts(self, range_start, range_end) -> dict:
+        """
+        Splits a range of the aggregate query like rollup_query_ranges, into half-open parts:
+        the closed end of the range becomes the end of its last raw part, one microsecond later.
+        Without rollups the whole range is read from raw rows.
+
+        :param: range_start:-> beginning of the range, pandas timestamp
+        :param: range_end:-> end of the range, pandas timestamp
+
+        return:: dict of lists of (start, end) parts: "daily", "hourly" and "raw", empty parts left out
+        """
+        after_end = range_end + pd.Timedelta(microseconds=1)
+        if self.rollups:
+            query_ranges = self.rollup_query_ranges(range_start, range_end)
+            parts = {
+                "daily": [query_ranges["daily"]],
+                "hourly": [query_ranges["hourly_head"], query_ranges["hourly_tail"]],
+                "raw": [
+                    query_ranges["raw_head"],
+                    (query_ranges["raw_tail"][0], after_end),
+                ],
+            }
+        else:
+            parts = {"daily": [], "hourly": [], "raw": [(range_start, after_end)]}
+        return {
+            name: [
+                (part_start, part_end)
+                for part_start, part_end in name_parts
+                if part_start < part_end
+            ]
+            for name, name_parts in parts.items()
+        }
+
+    def query_rollup_totals(
+        self, cursor: Any, rollup_table_name: str, parts: list
+    ) -> np.ndarray:
+        """
+        Sums passenger_sum, passenger_rows and trip_count of the rollup buckets in the parts of every range.
+        Buckets between the first and the last part are read once in order and parts are answered from prefix sums.
+
+        :param: cursor:-> cursor to sql database (from function connection)
+        :param: rollup_table_name:-> hourly or daily rollup table
+        :param: parts:-> list of half-open (start, end) parts per range, aligned to the buckets of the table
+
+        return:: array with a row of totals per range
+        """
+        totals = np.zeros((len(parts), 3), dtype="int64")
+        all_parts = [part for range_parts in parts for part in range_parts]
+        if not all_parts:
+            return totals
+        rows = cursor.execute(
+            f"""SELECT bucket_start, passenger_sum, passenger_rows, trip_count FROM {rollup_table_name}
+                WHERE bucket_start >= ? AND bucket_start < ?
+                ORDER BY bucket_start""",
+            min(part_start for part_start, _ in all_parts).to_pydatetime(),
+            max(part_end for _, part_end in all_parts).to_pydatetime(),
+        ).fetchall()
+        # sqlite returns buckets as text
+        bucket_starts = pd.DatetimeIndex(pd.to_datetime([row[0] for row in rows]))
+        prefix_sums = np.zeros((len(rows) + 1, 3), dtype="int64")
+        if rows:
+            prefix_sums[1:] = np.cumsum(
+                [[value or 0 for value in row[1:]] for row in rows], axis=0
+            )
+        for range_id, range_parts in enumerate(parts):
+            for part_start, part_end in range_parts:
+                first, last = bucket_starts.searchsorted([part_start, part_end])
+                totals[range_id] += prefix_sums[last] - prefix_sums[first]
+        return totals
+
+    def query_raw_totals(
+        self, cursor: Any, parts: list, range_ends: list
+    ) -> np.ndarray:
+        """
+        Sums passenger counts of raw rows picked up in the parts of every range and dropped off before its end.
+        Part edges and range ends split time into segments, sent in one batch to a temporary table.
+        Rows picked up in any part are scanned once in pickup order and grouped by the segments of their
+        pickup and dropoff (an index seek in the segment table per row, no join against the ranges).
+        Every range then adds up the groups picked up in its parts and dropped off before its end.
+
+        :param: cursor:-> cursor to sql database (from function connection)
+        :param: parts:-> list of half-open (start, end) raw parts per range
+        :param: range_ends:-> closed end of every range
+
+        return:: array with a row of totals per range
+        """
+        totals = np.zeros((len(parts), 3), dtype="int64")
+        # overlapping and adjacent parts are merged, so every row is read once
+        scanned_parts = []
+        for part_start, part_end in sorted(
+            part for range_parts in parts for part in range_parts
+        ):
+            if scanned_parts and part_start <= scanned_parts[-1][1]:
+                scanned_parts[-1] = (
+                    scanned_parts[-1][0],
+                    max(scanned_parts[-1][1], part_end),
+                )
+            else:
+                scanned_parts.append((part_start, part_end))
+        if not scanned_parts:
+            return totals
+
+        after_ends = [
+            range_end + pd.Timedelta(microseconds=1) for range_end in range_ends
+        ]
+        segment_starts = sorted(
+            {edge for range_parts in parts for part in range_parts for edge in part}
+            | set(after_ends)
+        )
+        segment_ids = {
+            segment_start: segment_id
+            for segment_id, segment_start in enumerate(segment_starts)
+        }
+        segments_table_name = self.sql_backend.temporary_table_name(
+            f"{self.table_name}_query_segments"
+        )
+        # the connection goes back to the pool, a table left by a failed query is dropped first
+        cursor.execute(f"DROP TABLE IF EXISTS {segments_table_name}")
+        cursor.execute(
+            self.sql_backend.create_temporary_table_sql(
+                segments_table_name, "segment_start DATETIME2 NOT NULL PRIMARY KEY"
+            )
+        )
+        # pickup segment id -> list of (dropoff segment id, totals)
+        groups = {}
+        try:
+            self.sql_backend.prepare_batch(cursor, ("datetime",))
+            cursor.executemany(
+                f"INSERT INTO {segments_table_name} VALUES (?)",
+                [(segment_start.to_pydatetime(),) for segment_start in segment_starts],
+            )
+            for first_part in range(0, len(scanned_parts), self.raw_parts_per_query):
+                batch = scanned_parts[
+                    first_part : first_part + self.raw_parts_per_query
+                ]
+                pickup_filter = " OR ".join(
+                    ["(a.pickup_datetime >= ? AND a.pickup_datetime < ?)"] * len(batch)
+                )
+                sql_code = f"""SELECT pickup_segment, dropoff_segment,
+                        SUM(CAST(passenger_count AS BIGINT)), COUNT(passenger_count), COUNT(*)
+                    FROM (
+                        SELECT a.passenger_count,
+                            (SELECT MAX(s.segment_start) FROM {segments_table_name} AS s
+                                WHERE s.segment_start <= a.pickup_datetime) AS pickup_segment,
+                            (SELECT MAX(s.segment_start) FROM {segments_table_name} AS s
+                                WHERE s.segment_start <= a.dropoff_datetime) AS dropoff_segment
+                        FROM {self.table_name} AS a
+                        WHERE ({pickup_filter}) AND a.dropoff_datetime < ?
+                    ) AS trips
+                    GROUP BY pickup_segment, dropoff_segment"""
+                parameters = [
+                    edge.to_pydatetime() for part in batch for edge in part
+                ] + [max(after_ends).to_pydatetime()]
+                for pickup_segment, dropoff_segment, *row_totals in cursor.execute(
+                    sql_code, *parameters
+                ).fetchall():
+                    # dropoff before the first segment (not after pickup) passes every dropoff filter
+                    dropoff_id = (
+                        -1
+                        if dropoff_segment is None
+                        else segment_ids[pd.Timestamp(dropoff_segment)]
+                    )
+                    groups.setdefault(
+                        segment_ids[pd.Timestamp(pickup_segment)], []
+                    ).append((dropoff_id, [value or 0 for value in row_totals]))
+        finally:
+            cursor.execute(f"DROP TABLE {segments_table_name}")
+            cursor.commit()
+
+        for range_id, (range_parts, after_end) in enumerate(zip(parts, after_ends)):
+            end_id = segment_ids[after_end]
+            for part_start, part_end in range_parts:
+                for pickup_id in range(segment_ids[part_start], segment_ids[part_end]):
+                    for dropoff_id, row_totals in groups.get(pickup_id, []):
+                        if dropoff_id < end_id:
+                            totals[range_id] += row_totals
+        return totals
@@ -0,0 +1,295 @@
+import io
+import logging
+import os
+from typing import Optional
+
+import pandas as pd
+
+from src.compact_trips import (
+    decode_compact_trips,
+    encode_compact_trips,
+    is_compact,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # csv still works without pyarrow
+    pa = None
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+# delay=True: worker processes started with "spawn" re-import this module and must not truncate the log
+file_handler = logging.FileHandler("logs/file_formats.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+# output format -> file extension of the transformed data
+FILE_EXTENSIONS = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+}
+
+DATETIME_COLUMNS = ["pickup_datetime", "dropoff_datetime"]
+TRANSFORMED_COLUMNS = DATETIME_COLUMNS + ["passenger_count"]
+
+# compression used when none is given. csv is kept plain text.
+DEFAULT_COMPRESSION = {
+    "csv": None,
+    "parquet": "zstd",
+    "arrow": "zstd",
+}
+
+
+def transformed_schema():
+    """
+    Fixed arrow schema of transformed data. Every chunk is cast to it, so chunks with and without NaN
+    end up with the same column types in one file.
+    """
+    return pa.schema(
+        [
+            ("pickup_datetime", pa.timestamp("ns")),
+            ("dropoff_datetime", pa.timestamp("ns")),
+            ("passenger_count", pa.int32()),
+        ]
+    )
+
+
+def compact_schema():
+    """
+    Arrow schema of transformed data in compact offset encoding (see compact_trips). The month is stored as plain text,
+    it is the same for every row of a monthly file and compresses to almost nothing.
+    """
+    return pa.schema(
+        [
+            ("month", pa.string()),
+            ("pickup_offset", pa.int32()),
+            ("dropoff_offset", pa.int32()),
+            ("passenger_count", pa.uint8()),
+        ]
+    )
+
+
+def to_compact_offsets(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns dataframe in compact offset encoding, whatever layout it comes in.
+    """
+    if "pickup_offset" in dataframe.columns:
+        return dataframe
+    return encode_compact_trips(decode_compact_trips(dataframe))
+
+
+def transformed_file_name(year, month: str, output_format: str = "csv") -> str:
+    """
+    Returns the file name of a transformed month, eg. clean_yellow_trip_data_2021-01.parquet
+
+    :param year:-> year of the data.
+    :param month:-> two digit str representation of a month, eg. 01, 02
+    :param output_format:-> one of FILE_EXTENSIONS keys.
+    """
+    return f"clean_yellow_trip_data_{year}-{month}{FILE_EXTENSIONS[output_format]}"
+
+
+def output_format_of_file(path: str) -> str:
+    """
+    Returns output format of the file judging by its extension.
+    """
+    extension = os.path.splitext(path)[1]
+    for output_format, format_extension in FILE_EXTENSIONS.items():
+        if extension == format_extension:
+            return output_format
+    raise ValueError(f"{path} is not a known transformed data format")
+
+
+def _check_output_format(output_format: str) -> None:
+    if output_format not in FILE_EXTENSIONS:
+        raise ValueError(
+            f"output format {output_format} is not one of {list(FILE_EXTENSIONS)}"
+        )
+    if output_format != "csv" and pa is None:
+        raise ValueError(f"pyarrow is required to use {output_format} output format")
+
+
+class Transformed_data_writer:
+    """
+    Writes transformed dataframes to a single file in the chosen format. Dataframes can be written
+    one by one (eg. chunks of a month), every write appends to the same file.
+
+    ::Parameters::
+    :: path         : file path or binary file-like object (eg. io.BytesIO) to write to
+    :: output_format: csv, parquet or arrow
+    :: compression  : codec of the file (zstd for parquet/arrow, none for csv by default)
+    :: compact      : parquet/arrow files store compact offsets instead of datetimes (see compact_trips), csv is always plain
+
+    Dataframes can be written in transformed or compact layout, they are converted to the layout of the file.
+    Files given by path are written to "<path>.part" and renamed when closed, so an interrupted write
+    never leaves a truncated file under the real name.
+
+    ::Functions::
+    :: write : -> appends dataframe to the file
+    :: close : -> finishes the file
+    :: abort : -> drops the unfinished file
+
+    Can be used as a context manager, the file is dropped if the block raises.
+    """
+
+    def __init__(
+        self,
+        path,
+        output_format: str = "csv",
+        compression: Optional[str] = None,
+        compact: bool = False,
+    ) -> None:
+        _check_output_format(output_format)
+        self.target_path = path if isinstance(path, str) else None
+        self.path = path + ".part" if isinstance(path, str) else path
+        self.output_format = output_format
+        self.compression = compression or DEFAULT_COMPRESSION[output_format]
+        self.compact = compact and output_format != "csv"
+        self.rows_written = 0
+        self._writer = None
+        self._csv_header_written = False
+
+    def write(self, dataframe: pd.DataFrame) -> None:
+        """
+        Appends dataframe to the file.
+
+        :param dataframe:-> transformed or compact pandas dataframe
+        """
+        if self.compact:
+            dataframe = to_compact_offsets(dataframe)
+        else:
+            dataframe = decode_compact_trips(dataframe)
+        if self.output_format == "csv" and not isinstance(self.path, str):
+            self.path.write(
+                dataframe.to_csv(
+                    index=False, header=not self._csv_header_written
+                ).encode()
+            )
+            self._csv_header_written = True
+        elif self.output_format == "csv":
+            dataframe.to_csv(
+                self.path,
+                index=False,
+                mode="a" if self._csv_header_written else "w",
+                header=not self._csv_header_written,
+                compression=self.compression,
+            )
+            self._csv_header_written = True
+        else:
+            schema = self.schema()
+            if self.compact:
+                dataframe = dataframe.astype({"month": str})
+            table = pa.Table.from_pandas(dataframe, schema=schema, preserve_index=False)
+            if self._writer is None:
+                self._writer = self._open_arrow_writer(schema)
+            self._writer.write_table(table)
+        self.rows_written += len(dataframe)
+
+    def schema(self):
+        return compact_schema() if self.compact else transformed_schema()
+
+    def _open_arrow_writer(self, schema):
+        if self.output_format == "parquet":
+            return pa.parquet.ParquetWriter(
+                self.path, schema, compression=self.compression
+            )
+        return pa.ipc.new_file(
+            self.path,
+            schema,
+            options=pa.ipc.IpcWriteOptions(compression=self.compression),
+        )
+
+    def close(self) -> None:
+        """
+        Finishes the file. A file is created even if nothing was written.
+        """
+        if self.output_format == "csv":
+            if not self._csv_header_written:
+                self.write(pd.DataFrame(columns=TRANSFORMED_COLUMNS))
+        else:
+            if self._writer is None:
+                self._writer = self._open_arrow_writer(self.schema())
+            self._writer.close()
+        if self.target_path is not None:
+            os.replace(self.path, self.target_path)
+        logger.debug(
+            f"{self.rows_written} rows written to {self.target_path or self.path}"
+        )
+
+    def abort(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        if self.target_path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        logger.debug(f"unfinished {self.target_path or self.path} was dropped")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def read_transformed_file(path: str, compact: Optional[bool] = False) -> pd.DataFrame:
+    """
+    Reads transformed data file of any supported format, in plain or compact layout.
+
+    :param path:-> path of csv, parquet or arrow file.
+    :param compact:-> False returns datetime64 columns, True compact offsets (see compact_trips), None the layout of the file
+
+    return:: pandas dataframe
+    """
+    output_format = output_format_of_file(path)
+    _check_output_format(output_format)
+    if output_format == "csv":
+        dataframe = pd.read_csv(path, parse_dates=DATETIME_COLUMNS)
+    elif output_format == "parquet":
+        dataframe = pa.parquet.read_table(path).to_pandas()
+    else:
+        with pa.memory_map(path) as source:
+            dataframe = pa.ipc.open_file(source).read_all().to_pandas()
+
+    if is_compact(dataframe):
+        dataframe = dataframe.astype({"month": "category"})
+        dataframe["passenger_count"] = dataframe.passenger_count.astype("UInt8")
+    if compact:
+        return to_compact_offsets(dataframe)
+    if compact is None:
+        return dataframe
+    return decode_compact_trips(dataframe)
+
+
+def dataframe_to_bytes(
+    dataframe: pd.DataFrame, output_format: str = "csv", compact: bool = False
+) -> bytes:
+    """
+    Serialises transformed dataframe in memory, used to upload it without saving a local file.
+
+    :param dataframe:-> transformed or compact pandas dataframe
+    :param output_format:-> csv, parquet or arrow
+    :param compact:-> stores compact offsets in parquet / arrow (see Transformed_data_writer)
+
+    return:: file content as bytes
+    """
+    buffer = io.BytesIO()
+    with Transformed_data_writer(buffer, output_format, compact=compact) as writer:
+        writer.write(dataframe)
+    return buffer.getvalue()
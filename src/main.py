@@ -1,9 +1,16 @@
+import cProfile
+import io
 import logging
+import os
+import pstats
 from os import error
 
 from src.ETL import ETL
 from src.data_processing import Data_processing
 from src.database import Database_interactions
+from src.manifest import Run_manifest
+from src.metrics import pipeline_metrics
+from src.stage_scheduler import SKIP_ITEM, Stage_scheduler
 
 etl = ETL()
 # data_processing = Data_processing(1,7,2021)
@@ -31,7 +38,16 @@ class Perform_the_assesment_task:
     Class which performs all required spets to implement ETL, upload data to azure sql database and return result of the average passenger count in specific period. (it can be adjusted in the code)
 
     ::Functions::
-    :: go:: runs all the steps in order.
+    :: prepare_sql_table:: creates or clears sql table.
+    :: run_staged_pipeline:: runs steps one after another through local data folders.
+    :: run_in_memory_pipeline:: runs steps month by month without local data folders.
+    :: run_pipelined_pipeline:: runs steps of different months at the same time, without local data folders.
+    :: check_in_memory_options:: rejects options only the staged pipeline supports.
+    :: is_month_loaded:: checks manifest whether a raw month is already in sql.
+    :: go:: runs all the steps in order, logs a table of stage metrics at the end (see src/metrics.py).
+    :: run_all_steps:: steps run by go, under cProfile if profile is True.
+    :: save_profile:: saves profiler stats and logs the slowest functions.
+    :: resume:: continues an interrupted run from its checkpoints.
 
     ::Parameters::
     :: None::
@@ -48,38 +64,305 @@ class Perform_the_assesment_task:
         self.year = 2021
         self.period_start_date = "2021-02-14 00:00:00"
         self.period_end_date = "2021-07-12 23:21:12"
+        # rows per chunk when transforming, None loads whole months into memory
+        self.chunk_size = None
+        # number of processes transforming months in parallel, staged pipeline only (see check_in_memory_options)
+        self.workers = 1
+        # format of transformed files moved between stages: csv, parquet or arrow
+        self.output_format = "csv"
+        # True cleans every month with one combined mask and logs rows rejected per rule
+        self.fused_cleaning = False
+        # reader of raw csv files: inferred (pandas type inference), typed (explicit schema) or pyarrow
+        self.csv_engine = "inferred"
+        # True keeps cleaned months as compact frames and stores parquet / arrow files in compact layout
+        self.compact = False
+        # True saves data to local folders between steps, False moves transformed data from memory to blob storage and sql
+        self.staging = True
+        # True overlaps months: while one month is loaded to sql the next one is uploaded and transformed (see src/stage_scheduler.py)
+        self.pipelined = False
+        # months waiting between two pipelined stages, bounds memory held by transformed dataframes
+        self.queue_size = 1
+        # True skips months which did not change since the last run (see src/manifest.py), False rebuilds everything
+        self.incremental = False
+        self.manifest_path = "data/run_manifest.json"
+        # True runs go under cProfile, stats are saved to profile_path (open with snakeviz or pstats)
+        # with SQL_BACKEND=sqlite and STORAGE_BACKEND=local the whole run is profiled without azure
+        self.profile = False
+        self.profile_path = "logs/profile.prof"
+        # functions listed in the log, sorted by cumulative time
+        self.profile_top = 30
 
-    def go(self):
+    def prepare_sql_table(self, manifest=None):
+        """
+        Creates sql table, or clears it if it already exists.
+        Incremental runs (with a manifest) keep existing rows, changed months are replaced while loading.
+        """
+        if manifest is not None:
+            database_interactions.create_table()
+            logger.info(">>> SQL TABLE KEPT, ONLY CHANGED MONTHS WILL BE RELOADED <<<")
+            return
         try:
-            etl.upload_raw_data_to_azure(
-                start_month=self.start_month, end_month=self.end_month
-            )
-            logger.info(">>> RAW DATA UPLOADED TO AZURE BLOB STORAGE <<<")
-            etl.extract_raw_taxi_data_from_azure()
-            logger.info(">>> RAW DATA EXTRACTED FROM AZURE BLOB STORAGE <<<")
-            etl.transform_raw_data(
-                start_month=self.start_month, end_month=self.end_month, year=2021
+            database_interactions.create_table()
+            logger.info(">> SQL TABLE CREATED <<<")
+        except:
+            logger.info(">>> SQL TABLE WILL BE CLEARED <<<")
+        else:
+            database_interactions.truncate_table()
+            logger.info(">>> SQL TABLE WAS CLEARED")
+
+    def run_staged_pipeline(self, manifest=None):
+        """
+        Runs every step for all months before the next step, saving intermediate data to local data folders.
+        """
+        etl.upload_raw_data_to_azure(
+            start_month=self.start_month, end_month=self.end_month, manifest=manifest
+        )
+        logger.info(">>> RAW DATA UPLOADED TO AZURE BLOB STORAGE <<<")
+        etl.extract_raw_taxi_data_from_azure(manifest=manifest)
+        logger.info(">>> RAW DATA EXTRACTED FROM AZURE BLOB STORAGE <<<")
+        etl.transform_raw_data(
+            start_month=self.start_month,
+            end_month=self.end_month,
+            year=2021,
+            chunk_size=self.chunk_size,
+            workers=self.workers,
+            output_format=self.output_format,
+            manifest=manifest,
+            fused_cleaning=self.fused_cleaning,
+            csv_engine=self.csv_engine,
+            compact=self.compact,
+        )
+        logger.info(">>> RAW DATA SUCCESSFULLY TRANSFORMED <<<")
+        etl.upload_transformed_data_to_azure(
+            start_month=self.start_month,
+            end_month=self.end_month,
+            year=2021,
+            output_format=self.output_format,
+            manifest=manifest,
+        )
+        logger.info(">>> TRANSFORMED DATA SUCCESSFULLY UPLOADED TO AZURE BLOB STORAGE")
+        etl.extract_transformed_taxi_data_from_azure(manifest=manifest)
+        logger.info(">>> TRANSFORMED DATA SUCCESSFULLY EXTRACTED FROM DATABASE <<<")
+
+        self.prepare_sql_table(manifest)
+        database_interactions.insert_transformed_data_to_sql_db(manifest=manifest)
+        logger.info(">>> ALL TRANSFORMED DATA MOVED TO SQL DATABASE <<<")
+
+    def run_in_memory_pipeline(self, manifest=None):
+        """
+        Streams every raw month from azure blob storage through Data_processing, then uploads the transformed
+        dataframe and inserts it to sql straight from memory. Nothing is written to local data folders,
+        only raw files from data/raw_data are read.
+        """
+        self.check_in_memory_options()
+        etl.upload_raw_data_to_azure(
+            start_month=self.start_month, end_month=self.end_month, manifest=manifest
+        )
+        logger.info(">>> RAW DATA UPLOADED TO AZURE BLOB STORAGE <<<")
+        self.prepare_sql_table(manifest)
+
+        data_processing = Data_processing(
+            self.start_month,
+            self.end_month,
+            self.year,
+            chunk_size=self.chunk_size,
+            output_format=self.output_format,
+            fused_cleaning=self.fused_cleaning,
+            csv_engine=self.csv_engine,
+            compact=self.compact,
+        )
+        for month in data_processing.months:
+            month_key = f"{self.year}-{month}"
+            raw_blob_name = f"yellow_tripdata_{self.year}-{month}.csv"
+            if manifest is not None:
+                raw_etag = etl.get_blob_etag("raw-yellow-taxi-data", raw_blob_name)
+                if self.is_month_loaded(manifest, month_key, raw_etag):
+                    logger.info(f">>> {month_key} DID NOT CHANGE, SKIPPED <<<")
+                    continue
+
+            raw_stream = etl.open_blob_stream("raw-yellow-taxi-data", raw_blob_name)
+            dataframe = data_processing.transform_month(month, source=raw_stream)
+            transformed_etag = etl.upload_transformed_dataframe_to_azure(
+                dataframe,
+                self.year,
+                month,
+                output_format=self.output_format,
+                manifest=manifest,
+                compact=self.compact,
             )
-            logger.info(">>> RAW DATA SUCCESSFULLY TRANSFORMED <<<")
-            etl.upload_transformed_data_to_azure(
-                start_month=self.start_month, end_month=self.end_month, year=2021
+            database_interactions.insert_dataframe_to_sql_db(
+                dataframe,
+                month_key,
+                replace_month_key=month_key if manifest is not None else None,
+                fingerprint=self.transformed_fingerprint(manifest, month_key),
             )
+            if manifest is not None:
+                manifest.record("transform", month_key, raw_etag, rows=len(dataframe))
+                manifest.record(
+                    "sql_load", month_key, transformed_etag, rows=len(dataframe)
+                )
             logger.info(
-                ">>> TRANSFORMED DATA SUCCESSFULLY UPLOADED TO AZURE BLOB STORAGE"
+                f">>> {self.year}-{month} TRANSFORMED, UPLOADED AND MOVED TO SQL DATABASE IN MEMORY <<<"
             )
-            etl.extract_transformed_taxi_data_from_azure()
-            logger.info(">>> TRANSFORMED DATA SUCCESSFULLY EXTRACTED FROM DATABASE <<<")
-
-            try:
-                database_interactions.create_table()
-                logger.info(">> SQL TABLE CREATED <<<")
-            except:
-                logger.info(">>> SQL TABLE WILL BE CLEARED <<<")
-            else:
-                database_interactions.truncate_table()
-                logger.info(">>> SQL TABLE WAS CLEARED")
-            database_interactions.insert_transformed_data_to_sql_db()
-            logger.info(">>> ALL TRANSFORMED DATA MOVED TO SQL DATABASE <<<")
+
+    def run_pipelined_pipeline(self, manifest=None):
+        """
+        Runs the in-memory pipeline with every step in its own thread, connected by queues of queue_size months:
+        raw upload -> transform (streamed from blob storage) -> transformed upload -> sql load.
+        While month N is loaded to sql, month N+1 is uploaded and month N+2 transformed,
+        so the run takes about as long as the slowest step instead of the sum of all steps.
+        """
+        self.check_in_memory_options()
+        self.prepare_sql_table(manifest)
+        data_processing = Data_processing(
+            self.start_month,
+            self.end_month,
+            self.year,
+            chunk_size=self.chunk_size,
+            output_format=self.output_format,
+            fused_cleaning=self.fused_cleaning,
+            csv_engine=self.csv_engine,
+            compact=self.compact,
+        )
+
+        def upload_raw(month, _):
+            return etl.upload_raw_month_to_azure(self.year, month, manifest=manifest)
+
+        def transform(month, raw_etag):
+            month_key = f"{self.year}-{month}"
+            if manifest is not None and self.is_month_loaded(
+                manifest, month_key, raw_etag
+            ):
+                logger.info(f">>> {month_key} DID NOT CHANGE, SKIPPED <<<")
+                return SKIP_ITEM
+            raw_stream = etl.open_blob_stream(
+                "raw-yellow-taxi-data", f"yellow_tripdata_{self.year}-{month}.csv"
+            )
+            return raw_etag, data_processing.transform_month(month, source=raw_stream)
+
+        def upload_transformed(month, transformed):
+            raw_etag, dataframe = transformed
+            transformed_etag = etl.upload_transformed_dataframe_to_azure(
+                dataframe,
+                self.year,
+                month,
+                output_format=self.output_format,
+                manifest=manifest,
+                compact=self.compact,
+            )
+            return raw_etag, transformed_etag, dataframe
+
+        def load(month, uploaded):
+            raw_etag, transformed_etag, dataframe = uploaded
+            month_key = f"{self.year}-{month}"
+            database_interactions.insert_dataframe_to_sql_db(
+                dataframe,
+                month_key,
+                replace_month_key=month_key if manifest is not None else None,
+                fingerprint=self.transformed_fingerprint(manifest, month_key),
+            )
+            if manifest is not None:
+                manifest.record("transform", month_key, raw_etag, rows=len(dataframe))
+                manifest.record(
+                    "sql_load", month_key, transformed_etag, rows=len(dataframe)
+                )
+            logger.info(f">>> {month_key} MOVED TO SQL DATABASE IN PIPELINE <<<")
+            return len(dataframe)
+
+        scheduler = Stage_scheduler(
+            [
+                ("raw_upload", upload_raw),
+                ("transform", transform),
+                ("transformed_upload", upload_transformed),
+                ("sql_load", load),
+            ],
+            queue_size=self.queue_size,
+        )
+        scheduler.run(data_processing.months)
+        if scheduler.failures:
+            raise ValueError(f"months failed in pipelined run: {scheduler.failures}")
+
+    def check_in_memory_options(self):
+        """
+        In-memory and pipelined runs transform months one at a time in this process, from streams of raw blobs,
+        and upload them in output_format. Transforming in worker processes needs the local files of the staged pipeline.
+        """
+        if self.workers > 1:
+            raise ValueError(
+                "workers > 1 is supported by the staged pipeline only, set staging = True and pipelined = False or workers = 1"
+            )
+
+    def transformed_fingerprint(self, manifest, month_key: str):
+        """
+        Returns sha256 of the transformed month uploaded from memory, which checkpoints its sql load
+        (the same data transformed again after an interruption has the same hash).
+        """
+        if manifest is None:
+            return None
+        uploaded = manifest.get("transformed_upload", month_key)
+        return uploaded["fingerprint"] if uploaded else None
+
+    def is_month_loaded(self, manifest, month_key: str, raw_etag: str) -> bool:
+        """
+        True if this version of the raw month was transformed and its transformed blob is loaded to sql.
+        """
+        uploaded = manifest.get("transformed_upload", month_key)
+        loaded = manifest.get("sql_load", month_key)
+        return (
+            manifest.is_unchanged("transform", month_key, raw_etag)
+            and uploaded is not None
+            and loaded is not None
+            and loaded["fingerprint"] == uploaded["etag"]
+        )
+
+    def resume(self):
+        """
+        Continues an interrupted run. Every stage checkpoints months in the manifest as soon as they are done
+        and sql loads checkpoint committed rows in the database (see Database_interactions.replace_month),
+        so months finished by the interrupted run are skipped and a month interrupted while loading to sql
+        goes on after the rows it committed. The table is not cleared.
+        Only runs with incremental = True leave checkpoints, without a manifest everything is run again.
+        """
+        if not os.path.exists(self.manifest_path):
+            logger.warning(
+                f"there is no manifest at {self.manifest_path}, nothing to resume from"
+            )
+        self.incremental = True
+        self.go()
+
+    def go(self):
+        if not self.profile:
+            self.run_all_steps()
+            return
+        # worker processes (workers > 1) are not profiled, only the main process
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(self.run_all_steps)
+        finally:
+            self.save_profile(profiler)
+
+    def save_profile(self, profiler: cProfile.Profile) -> None:
+        os.makedirs(os.path.dirname(self.profile_path) or ".", exist_ok=True)
+        profiler.dump_stats(self.profile_path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(
+            self.profile_top
+        )
+        logger.info(f"profile saved to {self.profile_path}\n{report.getvalue()}")
+
+    def run_all_steps(self):
+        pipeline_metrics.start_run()
+        try:
+            manifest = Run_manifest(self.manifest_path) if self.incremental else None
+            with pipeline_metrics.stage(
+                "pipeline", staging=self.staging, incremental=self.incremental
+            ):
+                if self.pipelined:
+                    self.run_pipelined_pipeline(manifest)
+                elif self.staging:
+                    self.run_staged_pipeline(manifest)
+                else:
+                    self.run_in_memory_pipeline(manifest)
 
             database_interactions.get_average_passenger_count_between_two_dates(
                 start_datetime_of_period=self.period_start_date,
@@ -90,3 +373,6 @@ class Perform_the_assesment_task:
             logger.exception("There is something wrong. check the logs!")
         else:
             logger.info(">>>>> yay. all went well! <<<<<<<<")
+        finally:
+            database_interactions.close_pool()
+            pipeline_metrics.log_summary()
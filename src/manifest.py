@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/manifest.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+def file_sha256(path: str, chunk_size: int = 8 * 1024 * 1024) -> str:
+    """
+    Returns sha256 hex digest of the file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def month_key_of_file(file_name: str) -> str:
+    """
+    Returns "year-month" part of raw or transformed file name, eg. yellow_tripdata_2021-01.csv -> 2021-01
+    """
+    match = re.search(r"(\d{4})-(\d{2})", file_name)
+    if match is None:
+        raise ValueError(f"{file_name} has no year-month in its name")
+    return match.group(0)
+
+
+class Run_manifest:
+    """
+    Records what every stage of the pipeline last did to every month, so unchanged months can be skipped.
+    Kept as a json file: stage -> month ("2021-01") -> fingerprint (content hash or blob etag of the stage input),
+    row count, etag of the stage output and time of the record.
+
+    ::Stages::
+    :: raw_upload        : fingerprint is sha256 of the local raw file, etag of the raw blob
+    :: raw_extract       : fingerprint is etag of the downloaded raw blob
+    :: transform         : fingerprint is etag of the raw blob that was transformed, rows saved
+    :: transformed_upload: fingerprint is sha256 of the transformed file, etag of the transformed blob
+    :: transformed_extract: fingerprint is etag of the downloaded transformed blob
+    :: sql_load          : fingerprint is etag of the transformed blob loaded to sql, rows inserted
+
+    ::Parameters::
+    :: path : json file of the manifest
+
+    ::Functions::
+    :: get          : -> returns recorded entry of a stage and month
+    :: is_unchanged : -> True if stage already ran for the month with the same fingerprint
+    :: record       : -> records a stage for a month and saves the manifest
+    :: forget       : -> removes a stage record of a month, so the stage runs again
+    """
+
+    def __init__(self, path: str = "data/run_manifest.json") -> None:
+        self.path = path
+        self.stages = {}
+        # stages of the pipelined run record months from several threads
+        self._lock = threading.RLock()
+        if os.path.exists(path):
+            with open(path) as file:
+                self.stages = json.load(file)
+            logger.info(f"manifest loaded from {path}")
+
+    def save(self) -> None:
+        """
+        Writes manifest to a temporary file and renames it, so a crash never leaves a half written manifest.
+        """
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as file:
+                json.dump(self.stages, file, indent=2, sort_keys=True)
+            os.replace(temporary_path, self.path)
+
+    def get(self, stage: str, month_key: str) -> Optional[dict]:
+        return self.stages.get(stage, {}).get(month_key)
+
+    def is_unchanged(self, stage: str, month_key: str, fingerprint: str) -> bool:
+        entry = self.get(stage, month_key)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def record(
+        self,
+        stage: str,
+        month_key: str,
+        fingerprint: str,
+        rows: Optional[int] = None,
+        etag: Optional[str] = None,
+    ) -> None:
+        """
+        Records that stage ran for the month and saves the manifest.
+
+        :param stage:-> name of the stage, see class docstring
+        :param month_key:-> "year-month", eg. 2021-01
+        :param fingerprint:-> content hash or etag of the stage input
+        :param rows:-> number of rows produced by the stage
+        :param etag:-> etag of the blob written by the stage
+        """
+        with self._lock:
+            self.stages.setdefault(stage, {})[month_key] = {
+                "fingerprint": fingerprint,
+                "rows": rows,
+                "etag": etag,
+                "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            }
+            self.save()
+        logger.debug(f"{stage} recorded for {month_key}")
+
+    def forget(self, stage: str, month_key: str) -> None:
+        with self._lock:
+            if self.stages.get(stage, {}).pop(month_key, None) is not None:
+                self.save()
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on windows, peak rss is left out there
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+# delay=True: worker processes started with "spawn" re-import this module and must not truncate the log
+file_handler = logging.FileHandler("logs/metrics.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+# worker processes inherit the run id through the environment, so their records belong to the same run
+RUN_ID_VARIABLE = "PIPELINE_RUN_ID"
+
+SUMMARY_COLUMNS = [
+    "stage",
+    "calls",
+    "failed",
+    "wall_seconds",
+    "rows_in",
+    "rows_out",
+    "bytes",
+    "rows_per_second",
+    "mb_per_second",
+    "peak_rss_mb",
+]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Returns the highest resident memory of this process or of any finished child process so far, in MB.
+    """
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # linux reports kilobytes, macos bytes
+    peak_bytes = peak if sys.platform == "darwin" else peak * 1024
+    return round(peak_bytes / 1024 ** 2, 1)
+
+
+class Pipeline_metrics:
+    """
+    Records wall time, rows in / out, bytes, peak rss and throughput of pipeline stages.
+    Every finished stage is appended as one json line to path, worker processes append to the same file.
+
+    ::Parameters::
+    :: path   : json lines file the records are appended to
+    :: run_id : id shared by records of one run, taken from PIPELINE_RUN_ID or generated if None
+
+    ::Functions::
+    :: start_run     : -> starts a new run id, records of earlier runs are left out of the summary
+    :: stage         : -> context manager timing a stage, fields set on the yielded record are saved with it
+    :: run_records   : -> records of the current run from all processes
+    :: summary       : -> dataframe with totals per stage
+    :: summary_table : -> summary formatted as a text table
+    :: log_summary   : -> logs the summary table
+
+    return:: None
+    """
+
+    def __init__(
+        self, path: str = "logs/metrics.jsonl", run_id: Optional[str] = None
+    ) -> None:
+        self.path = path
+        self.run_id = run_id or os.environ.setdefault(
+            RUN_ID_VARIABLE, uuid.uuid4().hex[:12]
+        )
+        self._lock = threading.Lock()
+
+    def start_run(self) -> str:
+        self.run_id = uuid.uuid4().hex[:12]
+        os.environ[RUN_ID_VARIABLE] = self.run_id
+        return self.run_id
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # one write per record, appends of different processes do not interleave
+            with open(self.path, "a") as file:
+                file.write(line)
+
+    @contextmanager
+    def stage(self, stage: str, **fields) -> Iterator[dict]:
+        """
+        Times the with block as stage. rows_in, rows_out and bytes can be passed as fields
+        or set on the yielded record inside the block, throughput is derived from them.
+        Failed stages are recorded with status "failed" and the exception is raised again.
+
+        :param stage:-> name of the stage, eg. raw_upload
+        :param fields:-> extra values saved with the record, eg. month_key="2021-01"
+        """
+        record = dict(fields)
+        started_at = time.time()
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield record
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            wall_seconds = time.perf_counter() - started
+            rows = record.get("rows_out", record.get("rows_in"))
+            record.update(
+                {
+                    "run_id": self.run_id,
+                    "stage": stage,
+                    "status": status,
+                    "pid": os.getpid(),
+                    "started_at": started_at,
+                    "wall_seconds": round(wall_seconds, 6),
+                    "rows_per_second": round(rows / wall_seconds)
+                    if rows is not None and wall_seconds
+                    else None,
+                    "mb_per_second": round(
+                        record["bytes"] / 1024 ** 2 / wall_seconds, 3
+                    )
+                    if record.get("bytes") is not None and wall_seconds
+                    else None,
+                    "peak_rss_mb": peak_rss_mb(),
+                }
+            )
+            try:
+                self.write(record)
+            except OSError:
+                logger.warning(f"metrics of {stage} were not saved", exc_info=True)
+            logger.debug(f"{stage} finished in {wall_seconds:.3f}s: {record}")
+
+    def run_records(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("run_id") == self.run_id:
+                    records.append(record)
+        return records
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Sums wall time, rows and bytes of every stage of the current run, in the order stages first started.
+        Stages run inside other stages (eg. transform_month in transform) are counted in both.
+
+        return:: pandas dataframe with SUMMARY_COLUMNS
+        """
+        records = pd.DataFrame(self.run_records())
+        if records.empty:
+            return pd.DataFrame(columns=SUMMARY_COLUMNS)
+        for column in ["rows_in", "rows_out", "bytes", "peak_rss_mb"]:
+            if column not in records.columns:
+                records[column] = None
+            records[column] = pd.to_numeric(records[column])
+        records["failed"] = records.status == "failed"
+        summary = records.groupby("stage", sort=False).agg(
+            started_at=("started_at", "min"),
+            calls=("stage", "size"),
+            failed=("failed", "sum"),
+            wall_seconds=("wall_seconds", "sum"),
+            rows_in=("rows_in", lambda values: values.sum(min_count=1)),
+            rows_out=("rows_out", lambda values: values.sum(min_count=1)),
+            bytes=("bytes", lambda values: values.sum(min_count=1)),
+            peak_rss_mb=("peak_rss_mb", "max"),
+        )
+        summary = summary.sort_values("started_at").reset_index()
+        rows = summary.rows_out.fillna(summary.rows_in)
+        summary["rows_per_second"] = (rows / summary.wall_seconds).round()
+        summary["mb_per_second"] = (
+            summary.bytes / 1024 ** 2 / summary.wall_seconds
+        ).round(3)
+        summary["wall_seconds"] = summary.wall_seconds.round(3)
+        for column in ["rows_in", "rows_out", "bytes", "rows_per_second"]:
+            summary[column] = summary[column].astype("Int64")
+        return summary[SUMMARY_COLUMNS]
+
+    def summary_table(self) -> str:
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            summary = self.summary().astype(object)
+            return summary.where(summary.notna(), "-").to_string(index=False)
+
+    def log_summary(self) -> None:
+        logger.info(f"stage metrics of run {self.run_id}:\n{self.summary_table()}")
+
+
+pipeline_metrics = Pipeline_metrics()
@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/query_cache.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+class Query_cache:
+    """
+    In-process cache of query results with LRU and TTL eviction.
+
+    Results are stored together with the load generation they were computed in. Every change of the data
+    (truncate, insert) calls invalidate, which bumps the generation and drops all results, so a query which
+    started before the change can not store a stale result after it.
+
+    ::Parameters::
+    :: max_entries : results kept, least recently used are evicted first
+    :: ttl_seconds : results older than this are not used (None keeps them until evicted or invalidated)
+
+    ::Functions::
+    :: get        : -> returns (True, result) on a hit, (False, None) on a miss
+    :: put        : -> stores a result computed in the given generation
+    :: invalidate : -> drops all results and starts a new load generation
+    :: metrics    : -> hits, misses, evictions, expirations, invalidations and hit rate
+    """
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: Optional[float] = 300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                stored_at, result = entry
+                if (
+                    self.ttl_seconds is None
+                    or time.monotonic() - stored_at < self.ttl_seconds
+                ):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, result
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key: Hashable, result: Any, generation: int) -> None:
+        """
+        Stores result of a query. Ignored if the data changed since the query started.
+
+        :param key:-> normalised query parameters
+        :param result:-> query result
+        :param generation:-> value of generation when the query started
+        """
+        with self._lock:
+            if generation != self.generation or self.max_entries <= 0:
+                return
+            self.entries[key] = (time.monotonic(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+            self.invalidations += 1
+        logger.debug(f"query cache invalidated, load generation {self.generation}")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "generation": self.generation,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
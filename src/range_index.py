@@ -0,0 +1,208 @@
+import logging
+import os
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.compact_trips import decode_compact_trips
+from src.file_formats import read_transformed_file
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/range_index.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+def _prefix_sums(values: np.ndarray) -> np.ndarray:
+    """
+    Returns prefix sums with a leading 0, so sum of values[i:j] is prefix[j] - prefix[i].
+    """
+    prefix = np.zeros(len(values) + 1, dtype=values.dtype)
+    np.cumsum(values, out=prefix[1:])
+    return prefix
+
+
+def _to_nanoseconds(value) -> int:
+    return pd.Timestamp(value).value
+
+
+class Range_query_index:
+    """
+    Local index over transformed trips answering average passenger count between two datetimes without sql server.
+    Same semantics as Database_interactions.get_average_passenger_count_between_two_dates:
+    pickup_datetime >= start and dropoff_datetime <= end (and pickup_datetime <= end).
+
+    Trips are kept twice, sorted by pickup and sorted by dropoff, with prefix sums of passenger_count
+    and of rows with passenger_count. Every query is a few binary searches:
+
+        trips(pickup >= start, dropoff <= end) = trips(dropoff <= end) - trips(pickup < start, dropoff <= end)
+
+    Every trip picked up before end - max_duration has dropped off by end, so the second term is a prefix of the
+    pickup order plus the trips picked up in [end - max_duration, start), which is empty when the period is longer
+    than the longest trip (max 12 hours in transformed data).
+
+    ::Parameters::
+    :: pickup_datetime : datetime64 array
+    :: dropoff_datetime: datetime64 array, never before pickup
+    :: passenger_count : array of passenger counts, NaN is not counted (as AVG in sql)
+
+    ::Functions::
+    :: from_dataframe  : -> builds the index from a transformed dataframe
+    :: from_files      : -> builds the index from transformed files (csv, parquet or arrow)
+    :: load            : -> loads an index saved with save
+    :: save            : -> saves the index to a .npz file
+    :: aggregate       : -> passenger sum, rows with passenger count and trips in the period
+    :: get_average_passenger_count_between_two_dates : -> average passenger count in the period
+    """
+
+    def __init__(self, pickup_datetime, dropoff_datetime, passenger_count) -> None:
+        pickup = np.asarray(pickup_datetime, dtype="datetime64[ns]").view("int64")
+        dropoff = np.asarray(dropoff_datetime, dtype="datetime64[ns]").view("int64")
+        passenger_count = np.asarray(passenger_count, dtype="float64")
+        if len(pickup) and (dropoff < pickup).any():
+            raise ValueError(
+                "dropoff_datetime before pickup_datetime, index needs transformed data"
+            )
+
+        has_passenger_count = ~np.isnan(passenger_count)
+        passengers = np.where(has_passenger_count, passenger_count, 0).astype("int64")
+
+        pickup_order = np.argsort(pickup, kind="stable")
+        dropoff_order = np.argsort(dropoff, kind="stable")
+        self.pickup = pickup[pickup_order]
+        self.dropoff_by_pickup = dropoff[pickup_order]
+        self.passengers_by_pickup = passengers[pickup_order]
+        self.has_passenger_count_by_pickup = has_passenger_count[pickup_order]
+        self.pickup_passenger_sum = _prefix_sums(self.passengers_by_pickup)
+        self.pickup_passenger_rows = _prefix_sums(
+            self.has_passenger_count_by_pickup.astype("int64")
+        )
+        self.dropoff = dropoff[dropoff_order]
+        self.dropoff_passenger_sum = _prefix_sums(passengers[dropoff_order])
+        self.dropoff_passenger_rows = _prefix_sums(
+            has_passenger_count[dropoff_order].astype("int64")
+        )
+        self.max_duration = int((dropoff - pickup).max()) if len(pickup) else 0
+
+    @classmethod
+    def from_dataframe(cls, dataframe: pd.DataFrame) -> "Range_query_index":
+        dataframe = decode_compact_trips(dataframe)
+        return cls(
+            dataframe.pickup_datetime.to_numpy(),
+            dataframe.dropoff_datetime.to_numpy(),
+            dataframe.passenger_count.to_numpy(dtype="float64", na_value=np.nan),
+        )
+
+    @classmethod
+    def from_files(cls, paths: Iterable[str]) -> "Range_query_index":
+        """
+        Builds the index from transformed files, eg. the output of Data_processing.
+
+        :param paths:-> paths of csv, parquet or arrow transformed files
+        """
+        dataframes = [read_transformed_file(path) for path in paths]
+        index = cls.from_dataframe(pd.concat(dataframes, ignore_index=True))
+        logger.info(f"index of {len(index)} trips built from {len(dataframes)} files")
+        return index
+
+    def save(self, path: str = "data/range_index.npz") -> None:
+        """
+        Writes the index to a temporary file and renames it, so a crash never leaves a half written index.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            np.savez(
+                file,
+                pickup_datetime=self.pickup.view("datetime64[ns]"),
+                dropoff_datetime=self.dropoff_by_pickup.view("datetime64[ns]"),
+                passenger_count=np.where(
+                    self.has_passenger_count_by_pickup,
+                    self.passengers_by_pickup,
+                    np.nan,
+                ),
+            )
+        os.replace(temporary_path, path)
+        logger.info(f"index of {len(self)} trips saved to {path}")
+
+    @classmethod
+    def load(cls, path: str = "data/range_index.npz") -> "Range_query_index":
+        """
+        Loads an index saved with save. Trips are stored once in pickup order, sums are rebuilt on load.
+        """
+        with np.load(path) as arrays:
+            index = cls(
+                arrays["pickup_datetime"],
+                arrays["dropoff_datetime"],
+                arrays["passenger_count"],
+            )
+        logger.info(f"index of {len(index)} trips loaded from {path}")
+        return index
+
+    def __len__(self) -> int:
+        return len(self.pickup)
+
+    def aggregate(self, start_datetime, end_datetime) -> Tuple[int, int, int]:
+        """
+        Returns passenger sum, rows with passenger count and number of trips with
+        pickup_datetime >= start_datetime and dropoff_datetime <= end_datetime.
+
+        :param start_datetime:-> beginning of the period, eg. 2021-01-02 00:21:34
+        :param end_datetime:-> end of the period, eg. 2021-06-24 04:12:22
+        """
+        start = _to_nanoseconds(start_datetime)
+        end = _to_nanoseconds(end_datetime)
+        if end < start:
+            return 0, 0, 0
+
+        dropped_off = np.searchsorted(self.dropoff, end, side="right")
+        passenger_sum = self.dropoff_passenger_sum[dropped_off]
+        passenger_rows = self.dropoff_passenger_rows[dropped_off]
+        trips = dropped_off
+
+        # trips picked up before start which dropped off by end
+        surely_dropped_off = min(start, end - self.max_duration)
+        before = np.searchsorted(self.pickup, surely_dropped_off, side="left")
+        passenger_sum -= self.pickup_passenger_sum[before]
+        passenger_rows -= self.pickup_passenger_rows[before]
+        trips -= before
+        picked_up = np.searchsorted(self.pickup, start, side="left")
+        if before < picked_up:
+            dropped_off_by_end = self.dropoff_by_pickup[before:picked_up] <= end
+            passenger_sum -= self.passengers_by_pickup[before:picked_up][
+                dropped_off_by_end
+            ].sum()
+            passenger_rows -= self.has_passenger_count_by_pickup[before:picked_up][
+                dropped_off_by_end
+            ].sum()
+            trips -= dropped_off_by_end.sum()
+        return int(passenger_sum), int(passenger_rows), int(trips)
+
+    def get_average_passenger_count_between_two_dates(
+        self, start_datetime_of_period, end_datetime_of_period
+    ) -> Optional[float]:
+        """
+        Returns average passenger count of trips in the period, None if there are none.
+
+        :param start_datetime_of_period:-> beginning of period. eg. 2021-01-02 00:21:34
+        :param end_datetime_of_period:-> end of period. eg. 2021-06-24 04:12:22
+        """
+        passenger_sum, passenger_rows, _ = self.aggregate(
+            start_datetime_of_period, end_datetime_of_period
+        )
+        average = passenger_sum / passenger_rows if passenger_rows else None
+        logger.info(f"average customer number in defined perdiod is {average}")
+        return average
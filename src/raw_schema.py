@@ -0,0 +1,214 @@
+import logging
+from typing import Iterator, Optional
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv
+except ImportError:  # typed pandas reading still works without pyarrow
+    pa = None
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+# delay=True: worker processes started with "spawn" re-import this module and must not truncate the log
+file_handler = logging.FileHandler("logs/raw_schema.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+# readers of raw csv files using RAW_SCHEMAS:
+# typed   - pandas with explicit dtypes and a fixed datetime format
+# pyarrow - multithreaded pyarrow csv reader with the same schema
+CSV_ENGINES = ["typed", "pyarrow"]
+
+# names the cleaning steps expect, whatever the raw file calls the columns
+CANONICAL_COLUMNS = [
+    "tpep_pickup_datetime",
+    "tpep_dropoff_datetime",
+    "passenger_count",
+]
+
+# yellow taxi csv layouts, keyed by the first year they were published in.
+# columns maps raw column name -> canonical name, in CANONICAL_COLUMNS order.
+RAW_SCHEMAS = {
+    2009: {
+        "columns": {
+            "Trip_Pickup_DateTime": "tpep_pickup_datetime",
+            "Trip_Dropoff_DateTime": "tpep_dropoff_datetime",
+            "Passenger_Count": "passenger_count",
+        },
+        "datetime_format": "%Y-%m-%d %H:%M:%S",
+        "passenger_count_dtype": "Int16",
+    },
+    2010: {
+        "columns": {
+            "pickup_datetime": "tpep_pickup_datetime",
+            "dropoff_datetime": "tpep_dropoff_datetime",
+            "passenger_count": "passenger_count",
+        },
+        "datetime_format": "%Y-%m-%d %H:%M:%S",
+        "passenger_count_dtype": "Int16",
+    },
+    2015: {
+        "columns": {
+            "tpep_pickup_datetime": "tpep_pickup_datetime",
+            "tpep_dropoff_datetime": "tpep_dropoff_datetime",
+            "passenger_count": "passenger_count",
+        },
+        "datetime_format": "%Y-%m-%d %H:%M:%S",
+        "passenger_count_dtype": "Int16",
+    },
+}
+
+
+def raw_schema_of_year(year) -> dict:
+    """
+    Returns the schema of raw files of the year: the latest variant published in or before it.
+
+    :param year:-> year of the data, eg. 2021
+    """
+    variants = [variant for variant in RAW_SCHEMAS if variant <= int(year)]
+    if not variants:
+        raise ValueError(f"there is no raw schema for {year}")
+    return RAW_SCHEMAS[max(variants)]
+
+
+def _datetime_columns(schema: dict) -> list:
+    return list(schema["columns"])[:2]
+
+
+def _passenger_count_column(schema: dict) -> str:
+    return list(schema["columns"])[2]
+
+
+def _check_csv_engine(csv_engine: str) -> None:
+    if csv_engine not in CSV_ENGINES:
+        raise ValueError(f"csv engine {csv_engine} is not one of {CSV_ENGINES}")
+    if csv_engine == "pyarrow" and pa is None:
+        raise ValueError("pyarrow is required to use pyarrow csv engine")
+
+
+def _finish_dataframe(dataframe: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    """
+    Renames raw columns to canonical names and gives every column its schema type.
+    """
+    columns = {}
+    for raw_column in _datetime_columns(schema):
+        column = dataframe[raw_column]
+        if not pd.api.types.is_datetime64_any_dtype(column):
+            column = pd.to_datetime(
+                column, format=schema["datetime_format"], errors="coerce"
+            )
+        columns[schema["columns"][raw_column]] = column.astype("datetime64[ns]")
+    passenger_count_column = _passenger_count_column(schema)
+    columns["passenger_count"] = dataframe[passenger_count_column].astype(
+        schema["passenger_count_dtype"]
+    )
+    return pd.DataFrame(columns)
+
+
+def _read_with_pandas(source, schema: dict, chunk_size: Optional[int]):
+    # datetimes are read as plain strings and parsed with the fixed format, which skips format inference
+    dtypes = {column: object for column in _datetime_columns(schema)}
+    dtypes[_passenger_count_column(schema)] = schema["passenger_count_dtype"]
+    return pd.read_csv(
+        source,
+        usecols=list(schema["columns"]),
+        dtype=dtypes,
+        chunksize=chunk_size,
+    )
+
+
+def _pyarrow_options(schema: dict):
+    column_types = {column: pa.timestamp("s") for column in _datetime_columns(schema)}
+    # passenger count is read as float, some files write it as 1.0
+    column_types[_passenger_count_column(schema)] = pa.float64()
+    read_options = pa.csv.ReadOptions(use_threads=True)
+    convert_options = pa.csv.ConvertOptions(
+        column_types=column_types,
+        include_columns=list(schema["columns"]),
+        timestamp_parsers=[schema["datetime_format"]],
+    )
+    return read_options, convert_options
+
+
+def _read_with_pyarrow_in_chunks(
+    source, schema: dict, chunk_size: int
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams record batches of the pyarrow reader and regroups them into chunks of exactly chunk_size rows.
+    """
+    read_options, convert_options = _pyarrow_options(schema)
+    reader = pa.csv.open_csv(
+        source, read_options=read_options, convert_options=convert_options
+    )
+    batches = []
+    buffered_rows = 0
+    for batch in reader:
+        batches.append(batch)
+        buffered_rows += batch.num_rows
+        while buffered_rows >= chunk_size:
+            table = pa.Table.from_batches(batches)
+            yield _finish_dataframe(table.slice(0, chunk_size).to_pandas(), schema)
+            rest = table.slice(chunk_size)
+            batches = rest.to_batches()
+            buffered_rows = rest.num_rows
+    if buffered_rows:
+        yield _finish_dataframe(pa.Table.from_batches(batches).to_pandas(), schema)
+
+
+def read_raw_csv(source, year, csv_engine: str = "typed") -> pd.DataFrame:
+    """
+    Reads a whole raw csv file with the schema of the year.
+
+    :param source:-> path or binary file-like object of a raw csv file
+    :param year:-> year of the data, selects the schema variant
+    :param csv_engine:-> typed or pyarrow
+
+    return:: pandas dataframe with canonical columns, datetime64 dates and nullable integer passenger_count
+    """
+    _check_csv_engine(csv_engine)
+    schema = raw_schema_of_year(year)
+    logger.debug(f"raw csv of {year} read with {csv_engine} engine")
+    if csv_engine == "pyarrow":
+        read_options, convert_options = _pyarrow_options(schema)
+        table = pa.csv.read_csv(
+            source, read_options=read_options, convert_options=convert_options
+        )
+        return _finish_dataframe(table.to_pandas(), schema)
+    return _finish_dataframe(_read_with_pandas(source, schema, None), schema)
+
+
+def read_raw_csv_in_chunks(
+    source, year, chunk_size: int, csv_engine: str = "typed"
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads a raw csv file with the schema of the year in chunks of chunk_size rows.
+
+    :param source:-> path or binary file-like object of a raw csv file
+    :param year:-> year of the data, selects the schema variant
+    :param chunk_size:-> rows per chunk
+    :param csv_engine:-> typed or pyarrow
+
+    return:: iterator of pandas dataframes with canonical columns
+    """
+    _check_csv_engine(csv_engine)
+    schema = raw_schema_of_year(year)
+    if csv_engine == "pyarrow":
+        return _read_with_pyarrow_in_chunks(source, schema, chunk_size)
+    return (
+        _finish_dataframe(chunk, schema)
+        for chunk in _read_with_pandas(source, schema, chunk_size)
+    )
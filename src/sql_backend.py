@@ -0,0 +1,288 @@
+import logging
+import os
+import sqlite3
+import textwrap
+from datetime import datetime
+from typing import Any, Optional
+
+import pandas as pd
+
+try:
+    import pyodbc
+except ImportError:  # only the sql server backend needs pyodbc
+    pyodbc = None
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/sql_backend.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+# names accepted by create_sql_backend and the SQL_BACKEND env variable
+SQL_BACKENDS = ["sql_server", "sqlite"]
+
+# column types of a batch of trips: pickup_datetime, dropoff_datetime, passenger_count
+TRIP_COLUMN_TYPES = ("datetime", "datetime", "integer")
+
+# sqlite keeps datetimes as text, "2021-01-02 00:21:34" sorts and compares like the datetime
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_adapter(pd.Timestamp, lambda value: value.isoformat(" "))
+
+
+class Sql_backend:
+    """
+    Database used by Database_interactions: opens connections and provides the sql that differs between engines.
+    Connections have pyodbc cursors (execute(sql, *params) returning the cursor, commit(), fetchval()).
+
+    ::Functions::
+    :: connect                      : -> opens a new connection
+    :: create_table_if_missing_sql  : -> sql creating a table only if it does not exist
+    :: table_exists                 : -> whether a table exists, checked with an open cursor
+    :: truncate_table_sql           : -> sql removing all rows of a table
+    :: temporary_table_name         : -> name of a table visible only to the connection creating it
+    :: create_temporary_table_sql   : -> sql creating such a table, it is dropped with the connection
+    :: hour_bucket_sql              : -> sql expression of the hour a datetime column falls in
+    :: day_bucket_sql               : -> sql expression of the day a datetime column falls in
+    :: prepare_batch                : -> sets up a cursor before executemany of a batch of rows (trips by default)
+
+    supports_partitions / supports_bcp tell whether the partitioned schema and bcp loads can be used.
+    """
+
+    name = None
+    supports_partitions = False
+    supports_bcp = False
+
+    def connect(self) -> Any:
+        raise NotImplementedError
+
+    def create_table_if_missing_sql(self, table_name: str, columns_sql: str) -> str:
+        raise NotImplementedError
+
+    def table_exists(self, cursor: Any, table_name: str) -> bool:
+        raise NotImplementedError
+
+    def truncate_table_sql(self, table_name: str) -> str:
+        return f"TRUNCATE TABLE {table_name}"
+
+    def temporary_table_name(self, name: str) -> str:
+        return name
+
+    def create_temporary_table_sql(self, table_name: str, columns_sql: str) -> str:
+        raise NotImplementedError
+
+    def hour_bucket_sql(self, column: str) -> str:
+        raise NotImplementedError
+
+    def day_bucket_sql(self, column: str) -> str:
+        raise NotImplementedError
+
+    def prepare_batch(
+        self, cursor: Any, column_types: tuple = TRIP_COLUMN_TYPES
+    ) -> None:
+        pass
+
+
+class Sql_server_backend(Sql_backend):
+    """
+    Azure sql database (or any sql server) through pyodbc.
+
+    ::Parameters::
+    :: server        : host and port, eg. yellowtaxidata.database.windows.net,1433
+    :: database_name : name of the database
+    :: username      : sql login
+    :: password      : password of the login
+    :: driver        : odbc driver, see odbcDrivers.sh
+    """
+
+    name = "sql_server"
+    supports_partitions = True
+    supports_bcp = True
+
+    def __init__(
+        self,
+        server: str,
+        database_name: str,
+        username: Optional[str],
+        password: Optional[str],
+        driver: str = "{ODBC Driver 17 for SQL Server}",
+    ) -> None:
+        if pyodbc is None:
+            raise ValueError("pyodbc is required to use sql server")
+        self.connection_string = textwrap.dedent(
+            f"""
+    Driver={driver};
+    Server={server};
+    Database={database_name};
+    Uid={username};
+    Pwd={password};
+    Encrypt=yes;
+    TrustServerCertificate=no;
+    Connection Timeout=30;
+"""
+        )
+
+    def connect(self) -> Any:
+        return pyodbc.connect(self.connection_string)
+
+    def create_table_if_missing_sql(self, table_name: str, columns_sql: str) -> str:
+        return f"""IF OBJECT_ID('{table_name}') IS NULL
+                    CREATE TABLE {table_name} ({columns_sql}); """
+
+    def table_exists(self, cursor: Any, table_name: str) -> bool:
+        return cursor.execute("SELECT OBJECT_ID(?)", table_name).fetchval() is not None
+
+    def temporary_table_name(self, name: str) -> str:
+        return f"#{name}"
+
+    def create_temporary_table_sql(self, table_name: str, columns_sql: str) -> str:
+        return f"CREATE TABLE {table_name} ({columns_sql})"
+
+    def hour_bucket_sql(self, column: str) -> str:
+        return f"DATEADD(hour, DATEDIFF(hour, '2000-01-01', {column}), CAST('2000-01-01' AS DATETIME2))"
+
+    def day_bucket_sql(self, column: str) -> str:
+        return f"CAST(CAST({column} AS DATE) AS DATETIME2)"
+
+    def prepare_batch(
+        self, cursor: Any, column_types: tuple = TRIP_COLUMN_TYPES
+    ) -> None:
+        # rows are bound as typed arrays and sent in one round trip per batch
+        input_sizes = {
+            "datetime": (pyodbc.SQL_TYPE_TIMESTAMP, 27, 7),
+            "integer": (pyodbc.SQL_INTEGER, 0, 0),
+        }
+        cursor.fast_executemany = True
+        cursor.setinputsizes([input_sizes[column_type] for column_type in column_types])
+
+
+class Sqlite_cursor:
+    """
+    sqlite3 cursor with the part of the pyodbc cursor interface Database_interactions uses.
+    """
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    def execute(self, sql: str, *params) -> "Sqlite_cursor":
+        self.cursor.execute(sql, params)
+        return self
+
+    def executemany(self, sql: str, rows) -> "Sqlite_cursor":
+        self.cursor.executemany(sql, rows)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self) -> list:
+        return self.cursor.fetchall()
+
+    def fetchval(self):
+        row = self.cursor.fetchone()
+        return None if row is None else row[0]
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.cursor.close()
+
+
+class Sqlite_connection:
+    """
+    sqlite3 connection returning Sqlite_cursor cursors. Connections may be used by any thread,
+    the connection pool lends each of them to one thread at a time.
+    """
+
+    def __init__(self, path: str) -> None:
+        # waits for the write lock of other connections instead of failing at once
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+
+    def cursor(self) -> Sqlite_cursor:
+        return Sqlite_cursor(self.connection)
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def rollback(self) -> None:
+        self.connection.rollback()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class Sqlite_backend(Sql_backend):
+    """
+    Embedded sqlite database in a local file, runs the whole pipeline and its queries without a database server.
+    Datetimes are stored as "YYYY-MM-DD HH:MM:SS" text, so range filters compare them in time order.
+
+    ::Parameters::
+    :: path : database file, SQLITE_DATABASE_PATH env variable or data/yellow_taxi.sqlite if None.
+              Every connection to ":memory:" is a separate database, use a file when connections are pooled.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or os.getenv("SQLITE_DATABASE_PATH", "data/yellow_taxi.sqlite")
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+    def connect(self) -> Sqlite_connection:
+        return Sqlite_connection(self.path)
+
+    def create_table_if_missing_sql(self, table_name: str, columns_sql: str) -> str:
+        return f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_sql})"
+
+    def table_exists(self, cursor: Any, table_name: str) -> bool:
+        return (
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+                table_name,
+            ).fetchone()
+            is not None
+        )
+
+    def truncate_table_sql(self, table_name: str) -> str:
+        return f"DELETE FROM {table_name}"
+
+    def create_temporary_table_sql(self, table_name: str, columns_sql: str) -> str:
+        return f"CREATE TEMP TABLE {table_name} ({columns_sql})"
+
+    def hour_bucket_sql(self, column: str) -> str:
+        return f"strftime('%Y-%m-%d %H:00:00', {column})"
+
+    def day_bucket_sql(self, column: str) -> str:
+        return f"strftime('%Y-%m-%d 00:00:00', {column})"
+
+
+def create_sql_backend(name: Optional[str] = None, **settings) -> Sql_backend:
+    """
+    Returns the sql backend selected by name, or by the SQL_BACKEND env variable (sql_server if not set).
+
+    :param name:-> sql_server or sqlite
+    :param settings:-> keyword arguments of the backend, eg. server for sql_server or path for sqlite
+    """
+    name = name or os.getenv("SQL_BACKEND", "sql_server")
+    if name == "sql_server":
+        return Sql_server_backend(**settings)
+    if name == "sqlite":
+        return Sqlite_backend(**settings)
+    raise ValueError(f"sql backend {name} is not one of {SQL_BACKENDS}")
@@ -0,0 +1,204 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/stage_scheduler.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+# returned by a stage function when the item needs no further stages (eg. the month did not change)
+SKIP_ITEM = object()
+
+# put into a stage queue once per worker when no more items come
+_END_OF_ITEMS = object()
+
+
+class Stage_scheduler:
+    """
+    Runs items (eg. months) through a chain of stages, every stage in its own threads, so different items are in
+    different stages at the same time: while month N is loaded to sql, month N+1 is uploaded and month N+2 transformed.
+    Stages are connected by bounded queues, a stage waits when the next one is behind (backpressure),
+    so at most queue_size items are held between two stages. Runtime approaches the slowest stage instead of the sum of all.
+
+    ::Parameters::
+    :: stages     : list of (name, function) or (name, function, workers). function(key, value) gets the item key and
+                    the output of the previous stage (None in the first stage) and returns the input of the next stage,
+                    or SKIP_ITEM to stop the item there.
+    :: queue_size : items waiting between two stages
+
+    ::Functions::
+    :: run       : -> runs keys through all stages, returns key -> output of the last stage
+    :: log_stats : -> logs busy, waiting and blocked time of every stage
+
+    Items failing in a stage are kept in failures (key -> stage and error) and do not reach later stages,
+    other items go on. Skipped items are listed in skipped.
+
+    return:: None
+    """
+
+    def __init__(self, stages: list, queue_size: int = 1) -> None:
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1")
+        self.stages = [
+            (stage[0], stage[1], stage[2] if len(stage) > 2 else 1) for stage in stages
+        ]
+        self.queue_size = queue_size
+        self.results = {}
+        self.failures = {}
+        self.skipped = []
+        self.stage_stats = {}
+        self.wall_seconds = 0.0
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._running_workers = []
+
+    def _add_time(self, stage: str, kind: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_stats[stage][kind] += seconds
+
+    def _finish_worker(self, index: int, queues: list) -> None:
+        """
+        Counts down workers of the stage, the last one tells workers of the next stage that no more items come.
+        """
+        with self._lock:
+            self._running_workers[index] -= 1
+            last_worker = self._running_workers[index] == 0
+        if last_worker and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1][2]):
+                queues[index + 1].put(_END_OF_ITEMS)
+
+    def _work(self, index: int, queues: list) -> None:
+        name, function, _ = self.stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            waiting_since = time.perf_counter()
+            item = inbox.get()
+            self._add_time(name, "waiting_seconds", time.perf_counter() - waiting_since)
+            if item is _END_OF_ITEMS:
+                self._finish_worker(index, queues)
+                return
+            if self._cancelled.is_set():
+                # drains the queue, so stages blocked on a full queue can finish as well
+                continue
+
+            key, value = item
+            started = time.perf_counter()
+            try:
+                output = function(key, value)
+            except Exception as error:
+                with self._lock:
+                    self.failures[key] = {"stage": name, "error": repr(error)}
+                logger.exception(f"{key} failed in stage {name}")
+                continue
+            finally:
+                self._add_time(name, "busy_seconds", time.perf_counter() - started)
+            with self._lock:
+                self.stage_stats[name]["items"] += 1
+
+            if output is SKIP_ITEM:
+                with self._lock:
+                    self.skipped.append(key)
+                logger.info(f"{key} skipped after stage {name}")
+            elif outbox is None:
+                with self._lock:
+                    self.results[key] = output
+                logger.info(f"{key} went through all stages")
+            else:
+                blocked_since = time.perf_counter()
+                outbox.put((key, output))
+                self._add_time(
+                    name, "blocked_seconds", time.perf_counter() - blocked_since
+                )
+
+    def run(self, keys: Iterable) -> Dict[Any, Any]:
+        """
+        Runs every key through all stages and waits until all are done.
+
+        :param keys:-> item keys in the order they enter the first stage, eg. months ["01", "02"]
+
+        return:: key -> output of the last stage, for items which went through all stages
+        """
+        self.results = {}
+        self.failures = {}
+        self.skipped = []
+        self.stage_stats = {
+            name: {
+                "items": 0,
+                "busy_seconds": 0.0,
+                "waiting_seconds": 0.0,
+                "blocked_seconds": 0.0,
+            }
+            for name, _, _ in self.stages
+        }
+        self._cancelled.clear()
+        self._running_workers = [workers for _, _, workers in self.stages]
+
+        # every key is known upfront, only queues between stages are bounded
+        queues = [queue.Queue()] + [
+            queue.Queue(maxsize=self.queue_size) for _ in self.stages[1:]
+        ]
+        for key in keys:
+            queues[0].put((key, None))
+        for _ in range(self.stages[0][2]):
+            queues[0].put(_END_OF_ITEMS)
+
+        threads = [
+            threading.Thread(
+                target=self._work,
+                args=(index, queues),
+                name=f"{name}-{worker}",
+                daemon=True,
+            )
+            for index, (name, _, workers) in enumerate(self.stages)
+            for worker in range(workers)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                # joined with a timeout, so KeyboardInterrupt reaches this thread
+                while thread.is_alive():
+                    thread.join(0.5)
+        except BaseException:
+            logger.warning("scheduler interrupted, items in progress are finished")
+            self._cancelled.set()
+            raise
+        self.wall_seconds = time.perf_counter() - started
+        self.log_stats()
+        return self.results
+
+    def log_stats(self) -> None:
+        for name, stats in self.stage_stats.items():
+            logger.info(
+                f"stage {name}: {stats['items']} items, busy {stats['busy_seconds']:.2f}s, "
+                f"waiting for input {stats['waiting_seconds']:.2f}s, blocked by next stage {stats['blocked_seconds']:.2f}s"
+            )
+        busiest = max(
+            self.stage_stats,
+            key=lambda name: self.stage_stats[name]["busy_seconds"],
+            default=None,
+        )
+        if busiest is not None:
+            logger.info(
+                f"all stages took {self.wall_seconds:.2f}s, slowest stage {busiest} was busy "
+                f"{self.stage_stats[busiest]['busy_seconds']:.2f}s, sum of all stages "
+                f"{sum(stats['busy_seconds'] for stats in self.stage_stats.values()):.2f}s"
+            )
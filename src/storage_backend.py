@@ -0,0 +1,491 @@
+import io
+import logging
+import os
+import shutil
+from datetime import datetime
+from typing import List, Optional
+
+try:
+    from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+    from azure.storage.blob import BlobServiceClient, ContentSettings
+except ImportError:  # only the azure backend needs the azure sdk
+    BlobServiceClient = None
+
+from src.blob_transfer import Blob_chunk_stream
+from src.block_upload import Block_uploader
+from src.compression import (
+    Compressing_reader,
+    Decompressing_writer,
+    check_compression,
+    compress_bytes,
+    compressed_file_path,
+    compression_of_encoding,
+    open_decompressed,
+)
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s:%(levelname)s:%(name)s:%(funcName)s:%(message)s"
+)
+
+file_handler = logging.FileHandler("logs/storage_backend.log", "w", delay=True)
+file_handler.setLevel(logging.INFO)
+file_handler.setFormatter(formatter)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(stream_handler)
+
+
+# names accepted by create_storage_backend and the STORAGE_BACKEND env variable
+STORAGE_BACKENDS = ["azure", "local"]
+
+
+class Blob_info:
+    """
+    Blob as listed by a storage backend.
+
+    ::Parameters::
+    :: name             : name of the blob in its container
+    :: etag             : version of the blob, changes whenever the blob is written
+    :: size             : bytes stored
+    :: content_encoding : gzip / zstd if the blob is stored compressed, None otherwise
+    """
+
+    def __init__(
+        self, name: str, etag: str, size: int, content_encoding: Optional[str] = None
+    ) -> None:
+        self.name = name
+        self.etag = etag
+        self.size = size
+        self.content_encoding = content_encoding
+
+
+class Storage_backend:
+    """
+    Blob storage used by ETL. Every method works on a container and a blob name, implementations decide where data lives.
+
+    ::Functions::
+    :: create_container : -> creates container, does nothing if it exists
+    :: delete_container : -> deletes container with all its blobs
+    :: list_blobs       : -> Blob_info of every blob in a container
+    :: upload_file      : -> stores a local file as a blob, returns properties with etag
+    :: upload_data      : -> stores bytes as a blob, returns properties with etag
+    :: open_blob_stream : -> opens blob as a binary stream
+    :: download_file    : -> saves a blob to a local folder
+    :: local_file_name  : -> name of a downloaded blob on disk
+    :: get_blob_etag    : -> etag of a blob, None if it does not exist
+    :: blob_exists      : -> True if the blob exists
+    :: delete_blob      : -> deletes a blob
+    """
+
+    def create_container(self, container_name: str) -> None:
+        raise NotImplementedError
+
+    def delete_container(self, container_name: str) -> None:
+        raise NotImplementedError
+
+    def list_blobs(self, container_name: str) -> List[Blob_info]:
+        raise NotImplementedError
+
+    def upload_file(self, container_name: str, file_path: str, blob_name: str) -> dict:
+        raise NotImplementedError
+
+    def upload_data(self, container_name: str, data: bytes, blob_name: str) -> dict:
+        raise NotImplementedError
+
+    def open_blob_stream(self, container_name: str, blob_name: str):
+        raise NotImplementedError
+
+    def download_file(
+        self, container_name: str, blob: Blob_info, local_blob_path: str
+    ) -> None:
+        raise NotImplementedError
+
+    def local_file_name(self, container_name: str, blob: Blob_info) -> str:
+        return blob.name
+
+    def get_blob_etag(self, container_name: str, blob_name: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def blob_exists(self, container_name: str, blob_name: str) -> bool:
+        return self.get_blob_etag(container_name, blob_name) is not None
+
+    def delete_blob(self, container_name: str, blob_name: str) -> None:
+        raise NotImplementedError
+
+
+class Azure_storage_backend(Storage_backend):
+    """
+    Azure blob storage (or a local Azurite emulator).
+
+    ::Parameters::
+    :: connection_string : azure storage connection string, AZURE_STORAGE_CONNECTION_STRING env variable is used if None.
+                           "UseDevelopmentStorage=true" connects to a local Azurite emulator.
+    :: max_concurrency   : connections used for a single large blob
+    :: download_chunk_size: bytes requested per GET when streaming a blob to disk
+    :: compression       : gzip or zstd compresses csv blobs while they are uploaded and sets their content-encoding,
+                           None uploads plain files. Parquet / arrow files are compressed internally and sent as they are.
+    :: compression_level : gzip (1-9) or zstd (1-22) level, default of the codec if None
+    :: keep_downloads_compressed: raw blobs with a content-encoding are saved as .csv.gz / .csv.zst
+                           and read compressed by Data_processing, instead of being decompressed while downloading
+    :: block_upload      : uploads files as blocks of block_size staged in parallel and journaled in data/upload_journal,
+                           a failed or interrupted upload resumes with the missing blocks only (see block_upload)
+    :: block_size        : bytes of a local file per block
+
+    ::Functions::
+    :: compresses          : -> whether a blob is compressed on upload
+    :: content_settings    : -> content type and encoding of an uploaded blob
+    :: open_blob_download  : -> starts a blob download, compressed blobs are fetched as stored
+    :: keep_compressed     : -> whether downloads of the container are saved compressed
+    :: write_blob_stream   : -> streams a started download to disk
+    """
+
+    def __init__(
+        self,
+        connection_string: Optional[str] = None,
+        max_concurrency: int = 4,
+        download_chunk_size: int = 4 * 1024 * 1024,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+        keep_downloads_compressed: bool = False,
+        block_upload: bool = False,
+        block_size: int = 8 * 1024 * 1024,
+    ) -> None:
+        if BlobServiceClient is None:
+            raise ValueError("azure-storage-blob is required to use azure storage")
+        check_compression(compression)
+        self.connection = connection_string or os.getenv(
+            "AZURE_STORAGE_CONNECTION_STRING"
+        )
+        # the first GET of a download is max_single_get_size (32MB by default), limit it as well
+        # so memory used by a download is about download_chunk_size * max_concurrency
+        self.blob_service_client = BlobServiceClient.from_connection_string(
+            self.connection,
+            max_single_get_size=download_chunk_size,
+            max_chunk_get_size=download_chunk_size,
+        )
+        self.max_concurrency = max_concurrency
+        self.compression = compression
+        self.compression_level = compression_level
+        self.keep_downloads_compressed = keep_downloads_compressed
+        self.block_upload = block_upload
+        self.block_uploader = Block_uploader(
+            block_size=block_size,
+            max_concurrency=max_concurrency,
+            compression_level=compression_level,
+        )
+
+    def create_container(self, container_name: str) -> None:
+        try:
+            self.blob_service_client.create_container(container_name)
+            logger.debug(f"container {container_name} created")
+        except ResourceExistsError:
+            logger.debug(f"container {container_name} already exists")
+
+    def delete_container(self, container_name: str) -> None:
+        self.blob_service_client.get_container_client(
+            container=container_name
+        ).delete_container()
+
+    def list_blobs(self, container_name: str) -> List[Blob_info]:
+        container_client = self.blob_service_client.get_container_client(container_name)
+        return [
+            Blob_info(
+                blob.name,
+                blob.etag,
+                blob.size,
+                blob.content_settings.content_encoding,
+            )
+            for blob in container_client.list_blobs()
+        ]
+
+    def compresses(self, blob_name: str) -> bool:
+        return self.compression is not None and blob_name.endswith(".csv")
+
+    def content_settings(self, blob_name: str):
+        """
+        Returns content settings of a compressed csv blob, so downloads know how to decompress it. None for plain blobs.
+        """
+        if not self.compresses(blob_name):
+            return None
+        return ContentSettings(
+            content_type="text/csv", content_encoding=self.compression
+        )
+
+    def upload_file(self, container_name: str, file_path: str, blob_name: str) -> dict:
+        """
+        Large files are sent over max_concurrency connections.
+        With compression set, csv files are compressed chunk by chunk while they are sent, no compressed copy is written.
+        With block_upload the file is sent in journaled blocks, a retry stages only blocks missing on the server.
+        """
+        blob_client = self.blob_service_client.get_blob_client(
+            container=container_name, blob=blob_name
+        )
+        if self.block_upload:
+            return self.block_uploader.upload(
+                blob_client,
+                file_path,
+                compression=self.compression if self.compresses(blob_name) else None,
+                content_settings=self.content_settings(blob_name),
+            )
+        with open(file_path, "rb") as data:
+            if self.compresses(blob_name):
+                data = Compressing_reader(
+                    data, self.compression, self.compression_level
+                )
+            return blob_client.upload_blob(
+                data,
+                overwrite=True,
+                max_concurrency=self.max_concurrency,
+                content_settings=self.content_settings(blob_name),
+            )
+
+    def upload_data(self, container_name: str, data: bytes, blob_name: str) -> dict:
+        blob_client = self.blob_service_client.get_blob_client(
+            container=container_name, blob=blob_name
+        )
+        if self.compresses(blob_name):
+            data = compress_bytes(data, self.compression, self.compression_level)
+        return blob_client.upload_blob(
+            data,
+            overwrite=True,
+            max_concurrency=self.max_concurrency,
+            content_settings=self.content_settings(blob_name),
+        )
+
+    def open_blob_download(
+        self, blob_client, compression: Optional[str], max_concurrency: int = 1
+    ):
+        """
+        Starts download of a blob. Compressed blobs are requested as stored (decompress=False),
+        so the sdk does not decode the content-encoding of every chunk on its own and data is decompressed once here.
+        """
+        if compression is None:
+            return blob_client.download_blob(max_concurrency=max_concurrency)
+        return blob_client.download_blob(
+            max_concurrency=max_concurrency, decompress=False
+        )
+
+    def open_blob_stream(self, container_name: str, blob_name: str):
+        """
+        Data is downloaded chunk by chunk while the stream is read, compressed blobs are decompressed while they are read.
+        """
+        blob_client = self.blob_service_client.get_blob_client(
+            container=container_name, blob=blob_name
+        )
+        compression = compression_of_encoding(
+            blob_client.get_blob_properties().content_settings.content_encoding
+        )
+        blob_stream = self.open_blob_download(blob_client, compression)
+        return open_decompressed(
+            io.BufferedReader(Blob_chunk_stream(blob_stream.chunks())), compression
+        )
+
+    def keep_compressed(self, container_name: str) -> bool:
+        # only raw files are read compressed, the sql loader reads transformed files as they are
+        return (
+            self.keep_downloads_compressed and container_name == "raw-yellow-taxi-data"
+        )
+
+    def local_file_name(self, container_name: str, blob: Blob_info) -> str:
+        """
+        Returns name of the downloaded blob on disk, with .gz / .zst added if it is kept compressed.
+        """
+        if not self.keep_compressed(container_name):
+            return blob.name
+        return compressed_file_path(
+            blob.name, compression_of_encoding(blob.content_encoding)
+        )
+
+    def download_file(
+        self, container_name: str, blob: Blob_info, local_blob_path: str
+    ) -> None:
+        """
+        Large blobs are read over max_concurrency connections, blobs decompressed while downloading over one
+        (the decompressor needs chunks in order).
+        The blob is streamed to disk in download_chunk_size pieces, never held in memory as a whole.
+        """
+        blob_client = self.blob_service_client.get_blob_client(
+            container=container_name, blob=blob.name
+        )
+        compression = compression_of_encoding(blob.content_encoding)
+        decompression = None if self.keep_compressed(container_name) else compression
+        blob_stream = self.open_blob_download(
+            blob_client,
+            compression,
+            self.max_concurrency if decompression is None else 1,
+        )
+        self.write_blob_stream(
+            blob_stream,
+            os.path.join(local_blob_path, self.local_file_name(container_name, blob)),
+            compression=decompression,
+        )
+
+    def write_blob_stream(
+        self, blob_stream, download_file_path: str, compression: Optional[str] = None
+    ) -> None:
+        """
+        Writes a blob download straight to disk as chunks arrive.
+        Data goes to a ".part" file first, which is renamed when the download is complete,
+        so an interrupted download never leaves a truncated file under the real name.
+
+        :param blob_stream:-> StorageStreamDownloader returned by download_blob.
+        :param download_file_path:-> path of the local file
+        :param compression:-> gzip / zstd decompresses chunks as they arrive, None writes them as they are
+
+        return:: None
+        """
+        partial_file_path = download_file_path + ".part"
+        try:
+            with open(partial_file_path, "wb") as file:
+                if compression is None:
+                    blob_stream.readinto(file)
+                else:
+                    # readinto needs a seekable target, chunks() hands the decompressor chunks in order
+                    writer = Decompressing_writer(file, compression)
+                    for chunk in blob_stream.chunks():
+                        writer.write(chunk)
+                    writer.finish()
+            os.replace(partial_file_path, download_file_path)
+        except:
+            if os.path.exists(partial_file_path):
+                os.remove(partial_file_path)
+            raise
+
+    def get_blob_etag(self, container_name: str, blob_name: str) -> Optional[str]:
+        blob_client = self.blob_service_client.get_blob_client(
+            container=container_name, blob=blob_name
+        )
+        try:
+            return blob_client.get_blob_properties().etag
+        except ResourceNotFoundError:
+            return None
+
+    def blob_exists(self, container_name: str, blob_name: str) -> bool:
+        return (
+            self.blob_service_client.get_container_client(container_name)
+            .get_blob_client(blob_name)
+            .exists()
+        )
+
+    def delete_blob(self, container_name: str, blob_name: str) -> None:
+        self.blob_service_client.get_container_client(
+            container=container_name
+        ).delete_blob(blob_name)
+
+
+class Local_storage_backend(Storage_backend):
+    """
+    Blob storage in a local folder, a container is a sub folder and a blob a file in it. Used for local runs,
+    development and benchmarks without network. Files are hardlinked in and out of storage instead of copied,
+    so a transfer takes the same time for any file size. Across file systems (where hardlinks fail) files are copied
+    with shutil, which uses zero-copy sendfile on linux.
+    Stored files must not be changed in place, every writer of the pipeline writes a new file and renames it.
+
+    ::Parameters::
+    :: root : folder of the containers, LOCAL_STORAGE_PATH env variable or data/blob_storage if None
+
+    ::Functions::
+    :: blob_path : -> path of a blob in storage
+    :: link      : -> hardlinks (or copies) a file to a new path, renamed into place when complete
+    """
+
+    def __init__(self, root: Optional[str] = None) -> None:
+        self.root = root or os.getenv("LOCAL_STORAGE_PATH", "data/blob_storage")
+
+    def blob_path(self, container_name: str, blob_name: str) -> str:
+        return os.path.join(self.root, container_name, blob_name)
+
+    def link(self, source_path: str, target_path: str) -> None:
+        partial_file_path = target_path + ".part"
+        if os.path.exists(partial_file_path):
+            os.remove(partial_file_path)
+        try:
+            os.link(source_path, partial_file_path)
+        except OSError:
+            shutil.copyfile(source_path, partial_file_path)
+        os.replace(partial_file_path, target_path)
+
+    def properties(self, path: str) -> dict:
+        status = os.stat(path)
+        return {
+            # a new file (new inode) or a changed size / mtime is a new version
+            "etag": f'"{status.st_ino:x}-{status.st_mtime_ns:x}-{status.st_size:x}"',
+            "last_modified": datetime.fromtimestamp(status.st_mtime),
+        }
+
+    def create_container(self, container_name: str) -> None:
+        os.makedirs(os.path.join(self.root, container_name), exist_ok=True)
+
+    def delete_container(self, container_name: str) -> None:
+        shutil.rmtree(os.path.join(self.root, container_name))
+
+    def list_blobs(self, container_name: str) -> List[Blob_info]:
+        container_path = os.path.join(self.root, container_name)
+        if not os.path.isdir(container_path):
+            raise ValueError(f"container {container_name} does not exist")
+        blobs = []
+        for blob_name in sorted(os.listdir(container_path)):
+            if blob_name.endswith(".part"):
+                continue
+            path = os.path.join(container_path, blob_name)
+            blobs.append(
+                Blob_info(
+                    blob_name, self.properties(path)["etag"], os.path.getsize(path)
+                )
+            )
+        return blobs
+
+    def upload_file(self, container_name: str, file_path: str, blob_name: str) -> dict:
+        self.create_container(container_name)
+        target_path = self.blob_path(container_name, blob_name)
+        self.link(file_path, target_path)
+        return self.properties(target_path)
+
+    def upload_data(self, container_name: str, data: bytes, blob_name: str) -> dict:
+        self.create_container(container_name)
+        target_path = self.blob_path(container_name, blob_name)
+        with open(target_path + ".part", "wb") as file:
+            file.write(data)
+        os.replace(target_path + ".part", target_path)
+        return self.properties(target_path)
+
+    def open_blob_stream(self, container_name: str, blob_name: str):
+        return open(self.blob_path(container_name, blob_name), "rb")
+
+    def download_file(
+        self, container_name: str, blob: Blob_info, local_blob_path: str
+    ) -> None:
+        self.link(
+            self.blob_path(container_name, blob.name),
+            os.path.join(local_blob_path, blob.name),
+        )
+
+    def get_blob_etag(self, container_name: str, blob_name: str) -> Optional[str]:
+        path = self.blob_path(container_name, blob_name)
+        if not os.path.exists(path):
+            return None
+        return self.properties(path)["etag"]
+
+    def delete_blob(self, container_name: str, blob_name: str) -> None:
+        os.remove(self.blob_path(container_name, blob_name))
+
+
+def create_storage_backend(name: Optional[str] = None, **settings) -> Storage_backend:
+    """
+    Returns the storage backend selected by name, or by the STORAGE_BACKEND env variable (azure if not set).
+
+    :param name:-> azure or local
+    :param settings:-> keyword arguments of the backend, eg. connection_string for azure or root for local
+    """
+    name = name or os.getenv("STORAGE_BACKEND", "azure")
+    if name == "azure":
+        return Azure_storage_backend(**settings)
+    if name == "local":
+        return Local_storage_backend(**settings)
+    raise ValueError(f"storage backend {name} is not one of {STORAGE_BACKENDS}")
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+
+# columns of 2021 yellow taxi csv files, in file order
+RAW_COLUMNS = [
+    "VendorID",
+    "tpep_pickup_datetime",
+    "tpep_dropoff_datetime",
+    "passenger_count",
+    "trip_distance",
+    "RatecodeID",
+    "store_and_fwd_flag",
+    "PULocationID",
+    "DOLocationID",
+    "payment_type",
+    "fare_amount",
+    "extra",
+    "mta_tax",
+    "tip_amount",
+    "tolls_amount",
+    "improvement_surcharge",
+    "total_amount",
+    "congestion_surcharge",
+]
+
+# share of rows broken in the ways the cleaning steps look for
+DEFAULT_DIRTY_SHARES = {
+    "negative_passenger_count": 0.002,
+    "missing_passenger_count": 0.03,
+    "out_of_month_pickup": 0.001,
+    "very_short_ride": 0.01,
+    "very_long_ride": 0.002,
+    "dropoff_before_pickup": 0.0005,
+}
+
+
+def synthetic_month(
+    year: int,
+    month: int,
+    rows: int,
+    seed: int = 0,
+    dirty_shares: dict = None,
+) -> pd.DataFrame:
+    """
+    Returns a raw yellow taxi month with realistic columns and distributions. The same arguments always give the same data.
+
+    Pickups follow a daily demand curve, rides last minutes (lognormal), most trips carry 1 passenger.
+    A share of rows is broken like the real files: negative or missing passenger counts, pickups outside of the month,
+    rides shorter than 5 seconds or longer than 12 hours and dropoffs before pickups.
+
+    :param year:-> year of the month
+    :param month:-> month number, 1-12
+    :param rows:-> number of trips
+    :param seed:-> seed of the random generator (mixed with year and month)
+    :param dirty_shares:-> share of rows broken per kind, DEFAULT_DIRTY_SHARES if None
+
+    return:: pandas dataframe with RAW_COLUMNS
+    """
+    dirty_shares = DEFAULT_DIRTY_SHARES if dirty_shares is None else dirty_shares
+    generator = np.random.default_rng([seed, year, month])
+    month_start = np.datetime64(f"{year}-{month:02d}-01T00:00:00", "s")
+    next_month_start = (month_start.astype("datetime64[M]") + 1).astype("datetime64[s]")
+    days_in_month = int((next_month_start - month_start) // np.timedelta64(1, "D"))
+
+    # busy evenings, quiet nights
+    hour_weights = np.array(
+        [3, 2, 1.5, 1, 1, 1.5, 3, 5, 6, 6, 6, 6]  # 00:00 - 11:00
+        + [6.5, 6.5, 7, 7, 7, 7.5, 8, 7.5, 7, 6, 5, 4]  # 12:00 - 23:00
+    )
+    hours = generator.choice(24, size=rows, p=hour_weights / hour_weights.sum())
+    days = generator.integers(0, days_in_month, size=rows)
+    seconds_in_hour = generator.integers(0, 3600, size=rows)
+    pickup_seconds = days * 86400 + hours * 3600 + seconds_in_hour
+    duration_seconds = np.clip(
+        generator.lognormal(mean=6.6, sigma=0.6, size=rows), 30, 4 * 3600
+    ).astype("int64")
+    passenger_count = generator.choice(
+        [0, 1, 2, 3, 4, 5, 6],
+        size=rows,
+        p=[0.02, 0.7, 0.14, 0.04, 0.02, 0.05, 0.03],
+    ).astype("float64")
+
+    def dirty_rows(kind: str) -> np.ndarray:
+        return generator.random(rows) < dirty_shares.get(kind, 0)
+
+    passenger_count[dirty_rows("negative_passenger_count")] = -1
+    passenger_count[dirty_rows("missing_passenger_count")] = np.nan
+    out_of_month = dirty_rows("out_of_month_pickup")
+    pickup_seconds[out_of_month] += (
+        generator.choice([-400, 400], size=out_of_month.sum()) * 86400
+    )
+    very_short = dirty_rows("very_short_ride")
+    duration_seconds[very_short] = generator.integers(0, 5, size=very_short.sum())
+    very_long = dirty_rows("very_long_ride")
+    duration_seconds[very_long] = generator.integers(
+        12 * 3600, 30 * 3600, size=very_long.sum()
+    )
+    dropoff_before_pickup = dirty_rows("dropoff_before_pickup")
+    duration_seconds[dropoff_before_pickup] = -generator.integers(
+        1, 3600, size=dropoff_before_pickup.sum()
+    )
+
+    pickup = month_start + pickup_seconds.astype("timedelta64[s]")
+    dropoff = pickup + duration_seconds.astype("timedelta64[s]")
+    trip_distance = np.round(
+        np.maximum(duration_seconds, 0) / 3600 * generator.uniform(5, 20, rows), 2
+    )
+    fare_amount = np.round(
+        2.5 + trip_distance * 2.5 + np.maximum(duration_seconds, 0) / 120, 2
+    )
+    tip_amount = np.round(fare_amount * generator.choice([0, 0.15, 0.2, 0.25], rows), 2)
+    missing_vendor = np.isnan(passenger_count) & (generator.random(rows) < 0.9)
+
+    dataframe = pd.DataFrame(
+        {
+            "VendorID": np.where(
+                missing_vendor, np.nan, generator.choice([1, 2], rows)
+            ),
+            "tpep_pickup_datetime": pickup,
+            "tpep_dropoff_datetime": dropoff,
+            "passenger_count": passenger_count,
+            "trip_distance": trip_distance,
+            "RatecodeID": np.where(missing_vendor, np.nan, 1.0),
+            "store_and_fwd_flag": np.where(missing_vendor, None, "N"),
+            "PULocationID": generator.integers(1, 266, rows),
+            "DOLocationID": generator.integers(1, 266, rows),
+            "payment_type": np.where(
+                missing_vendor, np.nan, generator.choice([1, 2], rows)
+            ),
+            "fare_amount": fare_amount,
+            "extra": generator.choice([0.0, 0.5, 1.0], rows),
+            "mta_tax": 0.5,
+            "tip_amount": tip_amount,
+            "tolls_amount": 0.0,
+            "improvement_surcharge": 0.3,
+            "total_amount": np.round(fare_amount + tip_amount + 0.8, 2),
+            "congestion_surcharge": 2.5,
+        },
+        columns=RAW_COLUMNS,
+    )
+    return dataframe
+
+
+def write_synthetic_month(
+    path: str, year: int, month: int, rows: int, seed: int = 0
+) -> None:
+    """
+    Writes a synthetic raw month as csv, formatted like the TLC files (eg. 2021-01-01 00:30:10, 1.0).
+
+    :param path:-> csv file to write, eg. data/raw_data/yellow_tripdata_2021-01.csv
+    """
+    synthetic_month(year, month, rows, seed=seed).to_csv(
+        path, index=False, date_format="%Y-%m-%d %H:%M:%S"
+    )
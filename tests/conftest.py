@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# src is imported as a package from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# modules of src open their log files in logs/ of the working directory when they are imported,
+# tests import them in a temporary folder so log files of the repository are left alone
+os.chdir(tempfile.mkdtemp(prefix="yellow_taxi_tests_"))
+os.makedirs("logs")
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Runs a test in its own folder with logs/ and data/, relative paths of the pipeline point there.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "data").mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def trips():
+    """
+    Cleaned trips of February 2021: dropoff after pickup, most rides shorter than an hour, some up to 12 hours.
+    """
+    generator = np.random.default_rng(2021)
+    rows = 5000
+    pickup = pd.Timestamp("2021-02-01") + pd.to_timedelta(
+        generator.integers(0, 28 * 24 * 3600, rows), unit="s"
+    )
+    duration = np.where(
+        generator.random(rows) < 0.05,
+        generator.integers(3600, 12 * 3600, rows),
+        generator.integers(60, 3600, rows),
+    )
+    return pd.DataFrame(
+        {
+            "pickup_datetime": pickup,
+            "dropoff_datetime": pickup + pd.to_timedelta(duration, unit="s"),
+            "passenger_count": generator.integers(0, 7, rows),
+        }
+    )
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.database import Database_interactions
+
+
+@pytest.fixture
+def database(workdir, trips):
+    database = Database_interactions(
+        sql_backend="sqlite", sqlite_path=str(workdir / "data" / "trips.sqlite")
+    )
+    database.create_table()
+    database.insert_dataframe_to_sql_db(trips, "2021-02")
+    return database
+
+
+def expected_totals(trips: pd.DataFrame, start, end) -> tuple:
+    in_range = (
+        (trips.pickup_datetime >= start)
+        & (trips.pickup_datetime <= end)
+        & (trips.dropoff_datetime <= end)
+    )
+    passenger_count = trips.passenger_count[in_range]
+    return int(passenger_count.sum()), int(passenger_count.count()), int(in_range.sum())
+
+
+def random_ranges(count: int, seed: int) -> list:
+    """
+    Overlapping ranges of minutes to weeks around February, some reversed or outside of the data.
+    """
+    generator = np.random.default_rng(seed)
+    ranges = []
+    for _ in range(count):
+        start = pd.Timestamp("2021-01-30") + pd.Timedelta(
+            seconds=int(generator.integers(0, 32 * 24 * 3600))
+        )
+        length = generator.choice([2 * 3600, 5 * 24 * 3600, 30 * 24 * 3600])
+        end = start + pd.Timedelta(seconds=int(generator.integers(-3600, length)))
+        ranges.append((start, end))
+    return ranges
+
+
+@pytest.mark.parametrize("rollups", [True, False])
+def test_aggregates_match_the_trips(database, trips, rollups):
+    database.rollups = rollups
+    # several scans of raw rows
+    database.raw_parts_per_query = 7
+    ranges = random_ranges(120, seed=int(rollups)) + [
+        (pd.Timestamp("2021-02-01"), pd.Timestamp("2021-03-01")),
+        (pd.Timestamp("2030-01-01"), pd.Timestamp("2030-01-02")),
+    ]
+
+    aggregates = database.get_passenger_count_aggregates(ranges)
+
+    assert len(aggregates) == len(ranges)
+    for row, (start, end) in zip(aggregates.itertuples(), ranges):
+        assert (row.start_datetime, row.end_datetime) == (start, end)
+        assert (
+            row.passenger_sum,
+            row.passenger_rows,
+            row.trip_count,
+        ) == expected_totals(trips, start, end)
+        if row.passenger_rows:
+            assert row.average_passenger_count == pytest.approx(
+                row.passenger_sum / row.passenger_rows
+            )
+        else:
+            assert np.isnan(row.average_passenger_count)
+
+
+def test_buckets_match_the_average_query(database):
+    aggregates = database.get_passenger_count_aggregates(
+        start_datetime_of_period="2021-02-03 00:00:00",
+        end_datetime_of_period="2021-02-20 12:00:00",
+        bucket="1D",
+    )
+
+    assert len(aggregates) == 18
+    assert aggregates.end_datetime.iloc[-1] == pd.Timestamp("2021-02-20 12:00:00")
+    for row in aggregates.itertuples():
+        with database.connection() as (conn, cursor):
+            average = database.query_average_passenger_count(
+                cursor, str(row.start_datetime), str(row.end_datetime)
+            )
+        assert row.average_passenger_count == pytest.approx(average)
+
+
+def test_bucket_ranges_do_not_overlap(database):
+    ranges = database.bucket_ranges("2021-02-01 00:00:00", "2021-02-01 02:30:00", "1h")
+
+    assert ranges == [
+        (
+            pd.Timestamp("2021-02-01 00:00:00"),
+            pd.Timestamp("2021-02-01 00:59:59.999999"),
+        ),
+        (
+            pd.Timestamp("2021-02-01 01:00:00"),
+            pd.Timestamp("2021-02-01 01:59:59.999999"),
+        ),
+        (pd.Timestamp("2021-02-01 02:00:00"), pd.Timestamp("2021-02-01 02:30:00")),
+    ]
+    with pytest.raises(ValueError):
+        database.bucket_ranges("2021-02-01", "2021-02-02", "0h")
+
+
+def test_hourly_buckets_count_every_trip_once(database, trips):
+    aggregates = database.get_passenger_count_aggregates(
+        start_datetime_of_period="2021-01-31 00:00:00",
+        end_datetime_of_period="2021-03-02 00:00:00",
+        bucket="1h",
+    )
+
+    # a trip counts in the hour of its pickup if it dropped off within that hour
+    same_hour = trips.pickup_datetime.dt.floor("h") == trips.dropoff_datetime.dt.floor(
+        "h"
+    )
+    assert aggregates.trip_count.sum() == same_hour.sum()
+
+
+def test_results_are_cached_until_data_changes(database, trips):
+    ranges = [("2021-02-01 00:00:00", "2021-02-07 23:59:59")]
+
+    first = database.get_passenger_count_aggregates(ranges)
+    second = database.get_passenger_count_aggregates(ranges)
+    database.insert_dataframe_to_sql_db(trips.iloc[:100], "2021-02")
+    third = database.get_passenger_count_aggregates(ranges)
+
+    assert second.equals(first)
+    assert database.query_cache.metrics()["hits"] == 1
+    assert third.trip_count.iloc[0] > first.trip_count.iloc[0]
+
+
+def test_missing_ranges_are_rejected(database):
+    assert database.get_passenger_count_aggregates([]).empty
+    with pytest.raises(ValueError):
+        database.get_passenger_count_aggregates(
+            start_datetime_of_period="2021-02-01 00:00:00"
+        )
@@ -0,0 +1,187 @@
+import gzip
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("azure.storage.blob")
+
+from src.compression import compress_bytes
+from src.storage_backend import Azure_storage_backend, Blob_info
+
+
+class Fake_download:
+    """
+    Started download of the azure sdk. readinto writes ranges over max_concurrency connections,
+    so it needs a seekable target then; chunks yields the blob in order.
+    """
+
+    def __init__(self, data: bytes, max_concurrency: int, fail_at=None) -> None:
+        self.data = data
+        self.max_concurrency = max_concurrency
+        self.fail_at = fail_at
+        self.chunk_size = 7
+
+    def chunks(self):
+        for start in range(0, len(self.data), self.chunk_size):
+            if self.fail_at is not None and start >= self.fail_at:
+                raise ConnectionError("connection reset by peer")
+            yield self.data[start : start + self.chunk_size]
+
+    def readinto(self, stream) -> int:
+        if self.max_concurrency > 1 and not stream.seekable():
+            raise ValueError("Target stream handle must be seekable.")
+        for chunk in self.chunks():
+            stream.write(chunk)
+        return len(self.data)
+
+
+class Fake_blob_client:
+    def __init__(self, service, blob_name: str) -> None:
+        self.service = service
+        self.blob_name = blob_name
+
+    def upload_blob(self, data, overwrite, max_concurrency, content_settings):
+        self.service.blobs[self.blob_name] = (
+            data if isinstance(data, bytes) else data.read()
+        )
+        self.service.content_encodings[self.blob_name] = (
+            content_settings.content_encoding if content_settings else None
+        )
+        return {"etag": f'"{len(self.service.blobs)}"'}
+
+    def get_blob_properties(self):
+        return SimpleNamespace(
+            content_settings=SimpleNamespace(
+                content_encoding=self.service.content_encodings.get(self.blob_name)
+            )
+        )
+
+    def download_blob(self, max_concurrency: int = 1, decompress: bool = True):
+        self.service.downloads.append(
+            {"max_concurrency": max_concurrency, "decompress": decompress}
+        )
+        return Fake_download(
+            self.service.blobs[self.blob_name], max_concurrency, self.service.fail_at
+        )
+
+
+class Fake_blob_service:
+    """
+    Blob service client holding blobs of one container in memory.
+    """
+
+    def __init__(self, blobs: dict, fail_at=None) -> None:
+        self.blobs = blobs
+        self.content_encodings = {}
+        self.fail_at = fail_at
+        self.downloads = []
+
+    def get_blob_client(self, container: str, blob: str) -> Fake_blob_client:
+        return Fake_blob_client(self, blob)
+
+
+def azure_backend(blobs: dict, fail_at=None, **settings) -> Azure_storage_backend:
+    backend = Azure_storage_backend(
+        connection_string="UseDevelopmentStorage=true", max_concurrency=4, **settings
+    )
+    backend.blob_service_client = Fake_blob_service(blobs, fail_at)
+    return backend
+
+
+RAW_CSV = b"pickup_datetime,dropoff_datetime,passenger_count\n" + (
+    b"2021-01-01 00:30:10,2021-01-01 00:45:10,1.0\n" * 500
+)
+
+
+def test_download_is_written_to_disk_over_many_connections(tmp_path):
+    backend = azure_backend({"yellow_tripdata_2021-01.csv": RAW_CSV})
+
+    backend.download_file(
+        "raw-yellow-taxi-data",
+        Blob_info("yellow_tripdata_2021-01.csv", '"1"', len(RAW_CSV)),
+        str(tmp_path),
+    )
+
+    assert (tmp_path / "yellow_tripdata_2021-01.csv").read_bytes() == RAW_CSV
+    assert os.listdir(tmp_path) == ["yellow_tripdata_2021-01.csv"]
+    assert backend.blob_service_client.downloads == [
+        {"max_concurrency": 4, "decompress": True}
+    ]
+
+
+def test_interrupted_download_keeps_the_complete_file(tmp_path):
+    (tmp_path / "yellow_tripdata_2021-01.csv").write_bytes(b"earlier version")
+    backend = azure_backend({"yellow_tripdata_2021-01.csv": RAW_CSV}, fail_at=100)
+
+    with pytest.raises(ConnectionError):
+        backend.download_file(
+            "raw-yellow-taxi-data",
+            Blob_info("yellow_tripdata_2021-01.csv", '"2"', len(RAW_CSV)),
+            str(tmp_path),
+        )
+
+    assert (tmp_path / "yellow_tripdata_2021-01.csv").read_bytes() == b"earlier version"
+    assert os.listdir(tmp_path) == ["yellow_tripdata_2021-01.csv"]
+
+
+def test_compressed_upload_and_download_round_trip(tmp_path):
+    backend = azure_backend({}, compression="gzip")
+    raw_path = tmp_path / "yellow_tripdata_2021-01.csv"
+    raw_path.write_bytes(RAW_CSV)
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+
+    backend.upload_file("raw-yellow-taxi-data", str(raw_path), raw_path.name)
+    stored = backend.blob_service_client.blobs[raw_path.name]
+    backend.download_file(
+        "raw-yellow-taxi-data",
+        Blob_info(raw_path.name, '"1"', len(stored), "gzip"),
+        str(downloads),
+    )
+
+    assert gzip.decompress(stored) == RAW_CSV
+    assert len(stored) < len(RAW_CSV)
+    assert (downloads / raw_path.name).read_bytes() == RAW_CSV
+    # chunks are decompressed in order over one connection, the sdk does not decode them
+    assert backend.blob_service_client.downloads == [
+        {"max_concurrency": 1, "decompress": False}
+    ]
+    with backend.open_blob_stream("raw-yellow-taxi-data", raw_path.name) as stream:
+        assert stream.read() == RAW_CSV
+
+
+def test_block_compressed_blob_is_decompressed_while_downloading(tmp_path):
+    # a gzip member per block, chunks of the download end inside and between members
+    compressed = b"".join(
+        compress_bytes(RAW_CSV[start : start + 1000], "gzip")
+        for start in range(0, len(RAW_CSV), 1000)
+    )
+    backend = azure_backend({"yellow_tripdata_2021-01.csv": compressed})
+
+    backend.download_file(
+        "raw-yellow-taxi-data",
+        Blob_info("yellow_tripdata_2021-01.csv", '"1"', len(compressed), "gzip"),
+        str(tmp_path),
+    )
+
+    assert (tmp_path / "yellow_tripdata_2021-01.csv").read_bytes() == RAW_CSV
+
+
+def test_raw_downloads_can_be_kept_compressed(tmp_path):
+    compressed = compress_bytes(RAW_CSV, "gzip")
+    backend = azure_backend(
+        {"yellow_tripdata_2021-01.csv": compressed}, keep_downloads_compressed=True
+    )
+
+    backend.download_file(
+        "raw-yellow-taxi-data",
+        Blob_info("yellow_tripdata_2021-01.csv", '"1"', len(compressed), "gzip"),
+        str(tmp_path),
+    )
+
+    assert os.listdir(tmp_path) == ["yellow_tripdata_2021-01.csv.gz"]
+    assert (tmp_path / "yellow_tripdata_2021-01.csv.gz").read_bytes() == compressed
+    assert backend.blob_service_client.downloads == [
+        {"max_concurrency": 4, "decompress": False}
+    ]
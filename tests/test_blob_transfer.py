@@ -0,0 +1,91 @@
+import io
+
+import pytest
+
+from src import blob_transfer
+from src.blob_transfer import Blob_chunk_stream, Blob_transfer, Transfer_error
+
+
+@pytest.fixture
+def waits(monkeypatch):
+    """
+    Records waits between retries instead of sleeping, without jitter.
+    """
+    recorded = []
+    monkeypatch.setattr(blob_transfer.time, "sleep", recorded.append)
+    monkeypatch.setattr(blob_transfer.random, "uniform", lambda low, high: 0.0)
+    return recorded
+
+
+def flaky(failures: int, result="done"):
+    """
+    Returns a transfer failing the first failures calls, and the list of its calls.
+    """
+    calls = []
+
+    def transfer():
+        calls.append(len(calls))
+        if len(calls) <= failures:
+            raise ConnectionError(f"attempt {len(calls)} failed")
+        return result
+
+    return transfer, calls
+
+
+def test_retries_with_exponential_backoff(waits):
+    transfer, calls = flaky(failures=3)
+
+    result = Blob_transfer(retries=3, backoff_seconds=0.5).run_with_retries(
+        "a.csv", transfer
+    )
+
+    assert result == "done"
+    assert len(calls) == 4
+    assert waits == [0.5, 1.0, 2.0]
+
+
+def test_last_error_is_raised_when_retries_run_out(waits):
+    transfer, calls = flaky(failures=10)
+
+    with pytest.raises(ConnectionError, match="attempt 3 failed"):
+        Blob_transfer(retries=2, backoff_seconds=1.0).run_with_retries(
+            "a.csv", transfer
+        )
+    assert len(calls) == 3
+    assert waits == [1.0, 2.0]
+
+
+def test_run_returns_results_and_reports_failed_files(waits):
+    transferred = []
+    transfers = {
+        "a.csv": flaky(failures=1, result="etag-a")[0],
+        "b.csv": flaky(failures=5)[0],
+        "c.csv": flaky(failures=0, result="etag-c")[0],
+    }
+
+    with pytest.raises(Transfer_error) as error:
+        Blob_transfer(max_workers=2, retries=1, backoff_seconds=0.1).run(
+            transfers, on_result=lambda name, result: transferred.append((name, result))
+        )
+
+    assert set(error.value.failures) == {"b.csv"}
+    assert sorted(transferred) == [("a.csv", "etag-a"), ("c.csv", "etag-c")]
+
+
+def test_run_without_failures_returns_every_result(waits):
+    transfers = {f"{month:02d}.csv": (lambda month=month: month) for month in range(12)}
+
+    results = Blob_transfer(max_workers=4).run(transfers)
+
+    assert results == {f"{month:02d}.csv": month for month in range(12)}
+    assert waits == []
+
+
+def test_chunk_stream_reads_across_chunks():
+    chunks = iter([b"pickup,", b"", b"dropoff\n", b"1,2\n"])
+
+    stream = io.BufferedReader(Blob_chunk_stream(chunks), buffer_size=4)
+
+    assert stream.read(3) == b"pic"
+    assert stream.read() == b"kup,dropoff\n1,2\n"
+    assert stream.read() == b""
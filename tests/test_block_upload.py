@@ -0,0 +1,135 @@
+import gzip
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("azure.storage.blob")
+
+from src import block_upload
+from src.block_upload import Block_uploader
+
+
+class Fake_block_blob_client:
+    """
+    Block blob of the azure sdk: staged blocks stay uncommitted until commit_block_list.
+    """
+
+    def __init__(self, fail_blocks=()) -> None:
+        self.container_name = "raw-yellow-taxi-data"
+        self.blob_name = "yellow_tripdata_2021-01.csv"
+        self.fail_blocks = set(fail_blocks)
+        self.uncommitted = {}
+        self.staged_calls = []
+        self.committed = None
+
+    def stage_block(self, block_id: str, data: bytes) -> None:
+        index = int(block_id.rsplit("-", 1)[1])
+        if index in self.fail_blocks:
+            raise ConnectionError(f"block {index} was not staged")
+        self.staged_calls.append(index)
+        self.uncommitted[block_id] = data
+
+    def get_block_list(self, block_list_type: str):
+        return [], [SimpleNamespace(id=block_id) for block_id in self.uncommitted]
+
+    def commit_block_list(self, blocks, content_settings=None) -> dict:
+        self.committed = b"".join(self.uncommitted[block.id] for block in blocks)
+        self.uncommitted = {}
+        return {"etag": '"committed"'}
+
+
+@pytest.fixture
+def raw_file(tmp_path):
+    path = tmp_path / "yellow_tripdata_2021-01.csv"
+    path.write_bytes(
+        b"".join(f"{row},2021-01-01 00:30:10,1\n".encode() for row in range(200))
+    )
+    return path
+
+
+@pytest.fixture
+def uploader(tmp_path):
+    return Block_uploader(
+        journal_path=str(tmp_path / "upload_journal"), block_size=256, max_concurrency=1
+    )
+
+
+def test_file_is_committed_from_blocks(uploader, raw_file, tmp_path):
+    blob_client = Fake_block_blob_client()
+
+    result = uploader.upload(blob_client, str(raw_file))
+
+    assert result == {"etag": '"committed"'}
+    assert blob_client.committed == raw_file.read_bytes()
+    assert blob_client.staged_calls == list(range(-(-raw_file.stat().st_size // 256)))
+    assert os.listdir(tmp_path / "upload_journal") == []
+
+
+def test_interrupted_upload_stages_only_missing_blocks(uploader, raw_file):
+    blob_client = Fake_block_blob_client(fail_blocks={5})
+    with pytest.raises(ConnectionError):
+        uploader.upload(blob_client, str(raw_file))
+    journal = uploader.journal(blob_client.container_name, blob_client.blob_name)
+    staged = journal.load()["staged_blocks"]
+    assert 5 not in staged and {0, 1, 2, 3, 4} <= set(staged)
+
+    blob_client.fail_blocks = set()
+    blob_client.staged_calls = []
+    uploader.upload(blob_client, str(raw_file))
+
+    block_count = -(-raw_file.stat().st_size // 256)
+    assert blob_client.staged_calls == [
+        index for index in range(block_count) if index not in staged
+    ]
+    assert blob_client.committed == raw_file.read_bytes()
+    assert not os.path.exists(journal.path)
+
+
+def test_blocks_dropped_by_the_server_are_staged_again(uploader, raw_file):
+    blob_client = Fake_block_blob_client(fail_blocks={5})
+    with pytest.raises(ConnectionError):
+        uploader.upload(blob_client, str(raw_file))
+
+    # uncommitted blocks expired on the server
+    blob_client.uncommitted = {}
+    blob_client.fail_blocks = set()
+    blob_client.staged_calls = []
+    uploader.upload(blob_client, str(raw_file))
+
+    assert blob_client.staged_calls[:5] == [0, 1, 2, 3, 4]
+    assert blob_client.committed == raw_file.read_bytes()
+
+
+def test_changed_file_starts_a_new_upload(uploader, raw_file):
+    blob_client = Fake_block_blob_client(fail_blocks={5})
+    with pytest.raises(ConnectionError):
+        uploader.upload(blob_client, str(raw_file))
+    journal = uploader.journal(blob_client.container_name, blob_client.blob_name)
+    first_upload_id = journal.load()["upload_id"]
+
+    raw_file.write_bytes(raw_file.read_bytes() + b"200,2021-01-01 00:30:10,2\n")
+    blob_client.fail_blocks = set()
+    blob_client.staged_calls = []
+    uploader.upload(blob_client, str(raw_file))
+
+    assert blob_client.staged_calls[:5] == [0, 1, 2, 3, 4]
+    assert all(
+        not block_id.startswith(first_upload_id) for block_id in blob_client.uncommitted
+    )
+    assert blob_client.committed == raw_file.read_bytes()
+
+
+def test_compressed_blocks_make_one_gzip_stream(uploader, raw_file):
+    blob_client = Fake_block_blob_client()
+
+    uploader.upload(blob_client, str(raw_file), compression="gzip")
+
+    assert gzip.decompress(blob_client.committed) == raw_file.read_bytes()
+
+
+def test_files_needing_too_many_blocks_are_rejected(uploader, raw_file, monkeypatch):
+    monkeypatch.setattr(block_upload, "MAX_BLOCKS", 3)
+
+    with pytest.raises(ValueError, match="block_size"):
+        uploader.upload(Fake_block_blob_client(), str(raw_file))
@@ -0,0 +1,97 @@
+import gzip
+import io
+
+import pytest
+
+from src import compression as compression_module
+from src.compression import (
+    Compressing_reader,
+    Decompressing_writer,
+    check_compression,
+    compress_bytes,
+    compressed_file_path,
+    compression_of_file,
+    existing_file_path,
+    open_decompressed,
+    open_file_decompressed,
+)
+
+COMPRESSIONS = [
+    "gzip",
+    pytest.param(
+        "zstd",
+        marks=pytest.mark.skipif(
+            compression_module.zstandard is None, reason="zstandard is not installed"
+        ),
+    ),
+]
+
+RAW_CSV = (
+    b"pickup_datetime,dropoff_datetime,passenger_count\n"
+    + b"".join(
+        f"2021-01-{day:02d} 00:30:10,2021-01-{day:02d} 00:45:{day:02d},{day % 6}.0\n".encode()
+        for day in range(1, 29)
+    )
+    * 200
+)
+
+
+def write_in_pieces(data: bytes, compression: str, piece_size: int) -> bytes:
+    target = io.BytesIO()
+    writer = Decompressing_writer(target, compression)
+    for start in range(0, len(data), piece_size):
+        writer.write(data[start : start + piece_size])
+    writer.finish()
+    return target.getvalue()
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_compressing_reader_round_trip(compression):
+    reader = io.BufferedReader(
+        Compressing_reader(io.BytesIO(RAW_CSV), compression, chunk_size=1000)
+    )
+    compressed = reader.read()
+
+    assert len(compressed) < len(RAW_CSV)
+    assert write_in_pieces(compressed, compression, 4096) == RAW_CSV
+    assert open_decompressed(io.BytesIO(compressed), compression).read() == RAW_CSV
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_streams_of_many_members_are_decompressed(compression):
+    # blobs uploaded in blocks are a gzip member / zstd frame per block
+    blocks = [RAW_CSV[start : start + 5000] for start in range(0, len(RAW_CSV), 5000)]
+    compressed = b"".join(compress_bytes(block, compression) for block in blocks)
+
+    assert write_in_pieces(compressed, compression, 333) == RAW_CSV
+    assert write_in_pieces(compressed, compression, len(compressed)) == RAW_CSV
+    assert open_decompressed(io.BytesIO(compressed), compression).read() == RAW_CSV
+
+
+def test_gzip_output_is_readable_by_gzip():
+    assert gzip.decompress(compress_bytes(RAW_CSV, "gzip", level=1)) == RAW_CSV
+
+
+def test_plain_sources_are_read_as_they_are():
+    source = io.BytesIO(RAW_CSV)
+
+    assert open_decompressed(source, None) is source
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_compressed_files_are_found_and_opened(tmp_path, compression):
+    path = str(tmp_path / "yellow_tripdata_2021-01.csv")
+    compressed_path = compressed_file_path(path, compression)
+    with open(compressed_path, "wb") as file:
+        file.write(compress_bytes(RAW_CSV, compression))
+
+    assert compression_of_file(compressed_path) == compression
+    assert existing_file_path(path) == compressed_path
+    with open_file_decompressed(compressed_path) as file:
+        assert file.read() == RAW_CSV
+
+
+def test_unknown_compression_is_rejected():
+    with pytest.raises(ValueError):
+        check_compression("brotli")
+    check_compression(None)
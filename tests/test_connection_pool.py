@@ -0,0 +1,166 @@
+import pytest
+
+from src import connection_pool
+from src.connection_pool import Connection_pool, Connection_pool_timeout
+from src.sql_backend import Sqlite_backend
+
+
+class Fake_cursor:
+    def __init__(self, connection) -> None:
+        self.connection = connection
+
+    def execute(self, sql: str) -> "Fake_cursor":
+        if not self.connection.healthy:
+            raise ConnectionError("communication link failure")
+        return self
+
+    def fetchall(self) -> list:
+        return [(1,)]
+
+    def close(self) -> None:
+        pass
+
+
+class Fake_connection:
+    def __init__(self, rollback_fails: bool = False) -> None:
+        self.healthy = True
+        self.closed = False
+        self.rollbacks = 0
+        self.rollback_fails = rollback_fails
+
+    def cursor(self) -> Fake_cursor:
+        return Fake_cursor(self)
+
+    def rollback(self) -> None:
+        if self.rollback_fails:
+            raise ConnectionError("connection is broken")
+        self.rollbacks += 1
+
+    def close(self) -> None:
+        self.closed = True
+
+
+@pytest.fixture
+def opened():
+    return []
+
+
+@pytest.fixture
+def connect(opened):
+    def connect(**settings):
+        connection = Fake_connection(**settings)
+        opened.append(connection)
+        return connection
+
+    return connect
+
+
+def test_connections_are_reused(connect, opened):
+    pool = Connection_pool(connect)
+
+    with pool.checkout() as first:
+        pass
+    with pool.checkout() as second:
+        pass
+
+    assert first is second
+    assert pool.stats() == {
+        "opened": 1,
+        "reused": 1,
+        "discarded": 0,
+        "idle": 1,
+        "in_use": 0,
+    }
+
+
+def test_connection_failing_health_check_is_replaced(connect, opened):
+    pool = Connection_pool(connect)
+    with pool.checkout() as first:
+        pass
+    first.healthy = False
+
+    with pool.checkout() as second:
+        pass
+
+    assert second is not first
+    assert first.closed
+    assert pool.stats()["discarded"] == 1
+
+
+def test_work_is_rolled_back_when_the_block_raises(connect):
+    pool = Connection_pool(connect)
+
+    with pytest.raises(ValueError):
+        with pool.checkout() as connection:
+            raise ValueError("insert failed")
+
+    assert connection.rollbacks == 1
+    assert not connection.closed
+    assert pool.stats()["idle"] == 1
+
+
+def test_connection_that_can_not_roll_back_is_discarded():
+    pool = Connection_pool(lambda: Fake_connection(rollback_fails=True))
+
+    with pytest.raises(ValueError):
+        with pool.checkout() as connection:
+            raise ValueError("insert failed")
+
+    assert connection.closed
+    assert pool.stats()["idle"] == 0
+    assert pool.stats()["discarded"] == 1
+
+
+def test_idle_connections_expire(connect, opened, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(connection_pool.time, "monotonic", lambda: now[0])
+    pool = Connection_pool(connect, idle_timeout_seconds=300)
+    with pool.checkout():
+        pass
+
+    now[0] += 300
+    with pool.checkout() as connection:
+        pass
+
+    assert connection is opened[1]
+    assert opened[0].closed
+    assert pool.stats()["opened"] == 2
+
+
+def test_checkout_waits_only_until_the_timeout(connect):
+    pool = Connection_pool(connect, max_size=1, checkout_timeout_seconds=0.05)
+
+    with pool.checkout():
+        with pytest.raises(Connection_pool_timeout):
+            with pool.checkout():
+                pass
+
+    assert pool.stats()["in_use"] == 0
+
+
+def test_close_all_closes_idle_connections(connect, opened):
+    pool = Connection_pool(connect)
+    with pool.checkout():
+        pass
+
+    pool.close_all()
+
+    assert opened[0].closed
+    assert pool.stats()["idle"] == 0
+
+
+def test_uncommitted_sqlite_rows_are_rolled_back(tmp_path):
+    pool = Connection_pool(Sqlite_backend(str(tmp_path / "pool.sqlite")).connect)
+    with pool.checkout() as connection:
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE trips (passenger_count INT)")
+        cursor.commit()
+
+    with pytest.raises(ValueError):
+        with pool.checkout() as connection:
+            connection.cursor().execute("INSERT INTO trips VALUES (?)", 1)
+            raise ValueError("load failed")
+
+    with pool.checkout() as connection:
+        assert connection.cursor().execute("SELECT COUNT(*) FROM trips").fetchval() == 0
+    assert pool.stats()["opened"] == 1
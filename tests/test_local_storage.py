@@ -0,0 +1,140 @@
+import os
+
+import pytest
+
+from src.ETL import ETL
+from src.storage_backend import (
+    Local_storage_backend,
+    Storage_backend,
+    create_storage_backend,
+)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return Local_storage_backend(str(tmp_path / "blob_storage"))
+
+
+def test_uploaded_file_is_listed_read_and_downloaded(storage, tmp_path):
+    raw_path = tmp_path / "yellow_tripdata_2021-01.csv"
+    raw_path.write_bytes(b"january")
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+
+    properties = storage.upload_file(
+        "raw-yellow-taxi-data", str(raw_path), raw_path.name
+    )
+    (blob,) = storage.list_blobs("raw-yellow-taxi-data")
+    storage.download_file("raw-yellow-taxi-data", blob, str(downloads))
+
+    assert (blob.name, blob.etag, blob.size) == (raw_path.name, properties["etag"], 7)
+    assert storage.get_blob_etag("raw-yellow-taxi-data", raw_path.name) == blob.etag
+    with storage.open_blob_stream("raw-yellow-taxi-data", raw_path.name) as stream:
+        assert stream.read() == b"january"
+    assert (downloads / raw_path.name).read_bytes() == b"january"
+    assert os.listdir(downloads) == [raw_path.name]
+
+
+def test_new_version_of_a_blob_has_a_new_etag(storage):
+    first = storage.upload_data("transformed-yellow-taxi-data", b"v1", "2021-01.csv")
+    second = storage.upload_data("transformed-yellow-taxi-data", b"v2", "2021-01.csv")
+
+    assert first["etag"] != second["etag"]
+    with storage.open_blob_stream(
+        "transformed-yellow-taxi-data", "2021-01.csv"
+    ) as stream:
+        assert stream.read() == b"v2"
+
+
+def test_removing_the_local_file_keeps_the_blob(storage, tmp_path):
+    raw_path = tmp_path / "yellow_tripdata_2021-01.csv"
+    raw_path.write_bytes(b"january")
+
+    storage.upload_file("raw-yellow-taxi-data", str(raw_path), raw_path.name)
+    os.remove(raw_path)
+
+    with storage.open_blob_stream("raw-yellow-taxi-data", raw_path.name) as stream:
+        assert stream.read() == b"january"
+
+
+def test_partial_files_are_not_listed(storage):
+    storage.upload_data(
+        "raw-yellow-taxi-data", b"january", "yellow_tripdata_2021-01.csv"
+    )
+    partial_path = storage.blob_path(
+        "raw-yellow-taxi-data", "yellow_tripdata_2021-02.csv.part"
+    )
+    with open(partial_path, "wb") as file:
+        file.write(b"febr")
+
+    assert [blob.name for blob in storage.list_blobs("raw-yellow-taxi-data")] == [
+        "yellow_tripdata_2021-01.csv"
+    ]
+
+
+def test_missing_blobs_and_containers(storage):
+    storage.create_container("raw-yellow-taxi-data")
+
+    assert storage.get_blob_etag("raw-yellow-taxi-data", "missing.csv") is None
+    assert not storage.blob_exists("raw-yellow-taxi-data", "missing.csv")
+    with pytest.raises(ValueError):
+        storage.list_blobs("transformed-yellow-taxi-data")
+
+
+def test_deleted_blobs_and_containers_are_gone(storage):
+    storage.upload_data(
+        "raw-yellow-taxi-data", b"january", "yellow_tripdata_2021-01.csv"
+    )
+    storage.upload_data(
+        "raw-yellow-taxi-data", b"february", "yellow_tripdata_2021-02.csv"
+    )
+
+    storage.delete_blob("raw-yellow-taxi-data", "yellow_tripdata_2021-01.csv")
+    assert [blob.name for blob in storage.list_blobs("raw-yellow-taxi-data")] == [
+        "yellow_tripdata_2021-02.csv"
+    ]
+
+    storage.delete_container("raw-yellow-taxi-data")
+    with pytest.raises(ValueError):
+        storage.list_blobs("raw-yellow-taxi-data")
+
+
+def test_backend_is_selected_by_name_or_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("STORAGE_BACKEND", "local")
+    monkeypatch.setenv("LOCAL_STORAGE_PATH", str(tmp_path / "from_env"))
+
+    storage = create_storage_backend()
+
+    assert isinstance(storage, Local_storage_backend)
+    assert storage.root == str(tmp_path / "from_env")
+    assert isinstance(
+        create_storage_backend("local", root="elsewhere"), Storage_backend
+    )
+    with pytest.raises(ValueError):
+        create_storage_backend("s3")
+
+
+def test_etl_moves_raw_months_through_local_storage(workdir):
+    (workdir / "data" / "raw_data").mkdir()
+    (workdir / "data" / "extracted_from_azure_raw").mkdir()
+    for month in ["01", "02"]:
+        (
+            workdir / "data" / "raw_data" / f"yellow_tripdata_2021-{month}.csv"
+        ).write_bytes(month.encode())
+    etl = ETL(storage_backend="local")
+
+    etl.upload_raw_data_to_azure(1, 2)
+    etl.extract_raw_taxi_data_from_azure()
+
+    assert os.listdir("data/raw_data") == []
+    assert sorted(os.listdir("data/extracted_from_azure_raw")) == [
+        "yellow_tripdata_2021-01.csv",
+        "yellow_tripdata_2021-02.csv",
+    ]
+    assert (
+        workdir
+        / "data"
+        / "blob_storage"
+        / "raw-yellow-taxi-data"
+        / "yellow_tripdata_2021-02.csv"
+    ).read_bytes() == b"02"
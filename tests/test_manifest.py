@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+from src.ETL import ETL
+from src.manifest import Run_manifest, file_sha256, month_key_of_file
+
+
+def test_month_key_of_file():
+    assert month_key_of_file("yellow_tripdata_2021-01.csv") == "2021-01"
+    assert month_key_of_file("transformed_2021-07.parquet") == "2021-07"
+    with pytest.raises(ValueError):
+        month_key_of_file("yellow_tripdata.csv")
+
+
+def test_records_are_saved_and_reloaded(tmp_path):
+    path = str(tmp_path / "run_manifest.json")
+    manifest = Run_manifest(path)
+
+    manifest.record("transform", "2021-01", '"etag-1"', rows=10)
+    manifest.record("sql_load", "2021-01", '"etag-2"', rows=10)
+
+    reloaded = Run_manifest(path)
+    assert reloaded.is_unchanged("transform", "2021-01", '"etag-1"')
+    assert not reloaded.is_unchanged("transform", "2021-01", '"etag-3"')
+    assert not reloaded.is_unchanged("transform", "2021-02", '"etag-1"')
+    assert reloaded.get("sql_load", "2021-01")["rows"] == 10
+    assert os.listdir(tmp_path) == ["run_manifest.json"]
+
+    reloaded.forget("transform", "2021-01")
+    assert Run_manifest(path).get("transform", "2021-01") is None
+    assert Run_manifest(path).get("sql_load", "2021-01") is not None
+
+
+@pytest.fixture
+def etl(workdir):
+    (workdir / "data" / "raw_data").mkdir()
+    (workdir / "data" / "extracted_from_azure_raw").mkdir()
+    return ETL(storage_backend="local", backoff_seconds=0)
+
+
+def write_raw_month(month: str, content: bytes) -> str:
+    path = os.path.join("data/raw_data", f"yellow_tripdata_2021-{month}.csv")
+    with open(path, "wb") as file:
+        file.write(content)
+    return path
+
+
+def test_unchanged_raw_months_are_not_uploaded_again(etl):
+    manifest = Run_manifest()
+    january_fingerprint = file_sha256(write_raw_month("01", b"january"))
+    write_raw_month("02", b"february")
+
+    etl.upload_raw_data_to_azure(1, 2, manifest=manifest)
+
+    container = "raw-yellow-taxi-data"
+    first_etags = {
+        month: etl.get_blob_etag(container, f"yellow_tripdata_2021-{month}.csv")
+        for month in ["01", "02"]
+    }
+    assert os.listdir("data/raw_data") == []
+    assert manifest.get("raw_upload", "2021-01")["etag"] == first_etags["01"]
+    assert manifest.is_unchanged("raw_upload", "2021-01", january_fingerprint)
+
+    write_raw_month("01", b"january")
+    write_raw_month("02", b"february, corrected")
+    etl.upload_raw_data_to_azure(1, 2, manifest=manifest)
+
+    assert (
+        etl.get_blob_etag(container, "yellow_tripdata_2021-01.csv") == first_etags["01"]
+    )
+    assert (
+        etl.get_blob_etag(container, "yellow_tripdata_2021-02.csv") != first_etags["02"]
+    )
+    with etl.open_blob_stream(container, "yellow_tripdata_2021-02.csv") as stream:
+        assert stream.read() == b"february, corrected"
+
+
+def test_extracted_and_transformed_blobs_are_skipped(etl, monkeypatch):
+    manifest = Run_manifest()
+    write_raw_month("01", b"january")
+    write_raw_month("02", b"february")
+    etl.upload_raw_data_to_azure(1, 2, manifest=manifest)
+    downloads = []
+    download_file = etl.storage.download_file
+    monkeypatch.setattr(
+        etl.storage,
+        "download_file",
+        lambda container, blob, path: downloads.append(blob.name)
+        or download_file(container, blob, path),
+    )
+
+    etl.extract_raw_taxi_data_from_azure(manifest=manifest)
+    etl.extract_raw_taxi_data_from_azure(manifest=manifest)
+
+    assert sorted(downloads) == [
+        "yellow_tripdata_2021-01.csv",
+        "yellow_tripdata_2021-02.csv",
+    ]
+
+    # a transformed month is skipped even when its download was removed
+    january = etl.get_blob_etag("raw-yellow-taxi-data", "yellow_tripdata_2021-01.csv")
+    manifest.record("transform", "2021-01", january, rows=1)
+    for file_name in os.listdir("data/extracted_from_azure_raw"):
+        os.remove(os.path.join("data/extracted_from_azure_raw", file_name))
+    etl.extract_raw_taxi_data_from_azure(manifest=manifest)
+
+    assert downloads[2:] == ["yellow_tripdata_2021-02.csv"]
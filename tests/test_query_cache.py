@@ -0,0 +1,84 @@
+import pytest
+
+from src import query_cache
+from src.query_cache import Query_cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Monotonic clock of the cache, moved forward by tests.
+    """
+    now = [1000.0]
+    monkeypatch.setattr(query_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = Query_cache(max_entries=2, ttl_seconds=None)
+    cache.put("january", 1.5, cache.generation)
+    cache.put("february", 1.6, cache.generation)
+
+    assert cache.get("january") == (True, 1.5)
+    cache.put("march", 1.7, cache.generation)
+
+    assert cache.get("february") == (False, None)
+    assert cache.get("january") == (True, 1.5)
+    assert cache.get("march") == (True, 1.7)
+    assert cache.metrics()["evictions"] == 1
+
+
+def test_results_expire_after_ttl(clock):
+    cache = Query_cache(ttl_seconds=300)
+    cache.put("january", 1.5, cache.generation)
+
+    clock[0] += 299
+    assert cache.get("january") == (True, 1.5)
+    clock[0] += 1
+    assert cache.get("january") == (False, None)
+
+    metrics = cache.metrics()
+    assert metrics["expirations"] == 1
+    assert metrics["entries"] == 0
+
+
+def test_invalidate_drops_results_and_starts_a_new_generation():
+    cache = Query_cache()
+    cache.put("january", 1.5, cache.generation)
+
+    cache.invalidate()
+
+    assert cache.get("january") == (False, None)
+    assert cache.generation == 1
+
+
+def test_result_of_a_query_started_before_a_change_is_not_stored():
+    cache = Query_cache()
+    generation = cache.generation
+
+    # data changes while the query runs
+    cache.invalidate()
+    cache.put("january", 1.5, generation)
+
+    assert cache.get("january") == (False, None)
+    cache.put("january", 1.4, cache.generation)
+    assert cache.get("january") == (True, 1.4)
+
+
+def test_metrics_count_hits_and_misses():
+    cache = Query_cache()
+    cache.get("january")
+    cache.put("january", None, cache.generation)
+    cache.get("january")
+    cache.get("january")
+
+    metrics = cache.metrics()
+    assert (metrics["hits"], metrics["misses"]) == (2, 1)
+    assert metrics["hit_rate"] == pytest.approx(2 / 3)
+
+
+def test_zero_entries_disables_the_cache():
+    cache = Query_cache(max_entries=0)
+    cache.put("january", 1.5, cache.generation)
+
+    assert cache.get("january") == (False, None)
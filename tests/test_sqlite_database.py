@@ -0,0 +1,135 @@
+import pandas as pd
+import pytest
+
+from src.database import Database_interactions
+from src.sql_backend import Sqlite_backend, create_sql_backend
+
+
+@pytest.fixture
+def database(workdir):
+    return Database_interactions(
+        sql_backend="sqlite", sqlite_path=str(workdir / "data" / "trips.sqlite")
+    )
+
+
+def expected_average(trips: pd.DataFrame, start: str, end: str) -> float:
+    in_period = (
+        (trips.pickup_datetime >= start)
+        & (trips.pickup_datetime <= end)
+        & (trips.dropoff_datetime <= end)
+    )
+    return trips.passenger_count[in_period].mean()
+
+
+def row_count(database: Database_interactions) -> int:
+    with database.connection() as (conn, cursor):
+        return cursor.execute(f"SELECT COUNT(*) FROM {database.table_name}").fetchval()
+
+
+def test_sqlite_cursor_behaves_like_pyodbc(tmp_path):
+    backend = Sqlite_backend(str(tmp_path / "backend.sqlite"))
+    connection = backend.connect()
+    cursor = connection.cursor()
+
+    cursor.execute(
+        backend.create_table_if_missing_sql("trips", "pickup_datetime DATETIME2")
+    )
+    cursor.execute(
+        backend.create_table_if_missing_sql("trips", "pickup_datetime DATETIME2")
+    )
+    cursor.executemany(
+        "INSERT INTO trips VALUES (?)",
+        [
+            (pd.Timestamp("2021-02-01 10:15:00").to_pydatetime(),),
+            (pd.Timestamp("2021-02-01 23:59:59"),),
+        ],
+    )
+    hours = cursor.execute(
+        f"SELECT DISTINCT {backend.hour_bucket_sql('pickup_datetime')} FROM trips ORDER BY 1"
+    ).fetchall()
+
+    assert backend.table_exists(cursor, "trips")
+    assert not backend.table_exists(cursor, "missing")
+    assert cursor.execute("SELECT COUNT(*) FROM trips").fetchval() == 2
+    assert [hour for (hour,) in hours] == ["2021-02-01 10:00:00", "2021-02-01 23:00:00"]
+    cursor.execute(backend.truncate_table_sql("trips"))
+    assert cursor.execute("SELECT COUNT(*) FROM trips").fetchval() == 0
+    connection.close()
+
+
+def test_backend_is_selected_by_name_or_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("SQL_BACKEND", "sqlite")
+    monkeypatch.setenv("SQLITE_DATABASE_PATH", str(tmp_path / "from_env.sqlite"))
+
+    backend = create_sql_backend()
+
+    assert isinstance(backend, Sqlite_backend)
+    assert backend.path == str(tmp_path / "from_env.sqlite")
+    with pytest.raises(ValueError):
+        create_sql_backend("postgres")
+
+
+@pytest.mark.parametrize("rollups", [True, False])
+def test_average_matches_the_trips(database, trips, rollups):
+    database.rollups = rollups
+    database.create_table()
+    database.insert_dataframe_to_sql_db(trips, "2021-02")
+
+    for start, end in [
+        ("2021-02-01 00:00:00", "2021-03-01 00:00:00"),
+        ("2021-02-03 10:21:34", "2021-02-19 04:12:22"),
+        ("2021-02-10 12:00:00", "2021-02-10 13:30:00"),
+    ]:
+        average = database.get_average_passenger_count_between_two_dates(start, end)
+        assert average == pytest.approx(expected_average(trips, start, end))
+
+    assert row_count(database) == len(trips)
+
+
+def test_existing_table_is_kept(database, trips):
+    database.create_table()
+    database.insert_dataframe_to_sql_db(trips, "2021-02")
+
+    database.create_table()
+
+    assert row_count(database) == len(trips)
+
+
+def test_cached_average_is_dropped_when_data_changes(database, trips):
+    database.create_table()
+    database.insert_dataframe_to_sql_db(trips.iloc[:2500], "2021-02")
+    period = ("2021-02-01 00:00:00", "2021-03-01 00:00:00")
+
+    first = database.get_average_passenger_count_between_two_dates(*period)
+    assert database.get_average_passenger_count_between_two_dates(*period) == first
+    assert database.query_cache.metrics()["hits"] == 1
+
+    database.insert_dataframe_to_sql_db(trips.iloc[2500:], "2021-02")
+
+    assert database.get_average_passenger_count_between_two_dates(
+        *period
+    ) == pytest.approx(expected_average(trips, *period))
+
+
+def test_replaced_month_is_not_loaded_twice(database, trips):
+    database.create_table()
+
+    database.insert_dataframe_to_sql_db(trips, "2021-02", replace_month_key="2021-02")
+    database.insert_dataframe_to_sql_db(trips, "2021-02", replace_month_key="2021-02")
+
+    assert row_count(database) == len(trips)
+
+
+def test_truncate_removes_all_rows(database, trips):
+    database.create_table()
+    database.insert_dataframe_to_sql_db(trips, "2021-02")
+
+    database.truncate_table()
+
+    assert row_count(database) == 0
+    assert (
+        database.get_average_passenger_count_between_two_dates(
+            "2021-02-01 00:00:00", "2021-03-01 00:00:00"
+        )
+        is None
+    )
@@ -0,0 +1,116 @@
+import importlib
+import threading
+import time
+
+import pytest
+
+from src.stage_scheduler import SKIP_ITEM, Stage_scheduler
+
+
+def test_items_go_through_all_stages_in_order():
+    calls = []
+    lock = threading.Lock()
+
+    def stage(name):
+        def function(key, value):
+            with lock:
+                calls.append((name, key))
+            return (value or []) + [name]
+
+        return function
+
+    scheduler = Stage_scheduler(
+        [
+            ("upload", stage("upload")),
+            ("transform", stage("transform"), 2),
+            ("load", stage("load")),
+        ],
+        queue_size=1,
+    )
+
+    results = scheduler.run(["01", "02", "03", "04"])
+
+    assert results == {
+        month: ["upload", "transform", "load"] for month in ["01", "02", "03", "04"]
+    }
+    for month in ["01", "02", "03", "04"]:
+        stages_of_month = [name for name, key in calls if key == month]
+        assert stages_of_month == ["upload", "transform", "load"]
+    assert scheduler.stage_stats["transform"]["items"] == 4
+    assert not scheduler.failures and not scheduler.skipped
+
+
+def test_skipped_items_do_not_reach_later_stages():
+    loaded = []
+
+    def upload(key, value):
+        return SKIP_ITEM if key == "02" else key
+
+    def load(key, value):
+        loaded.append(key)
+        return value
+
+    scheduler = Stage_scheduler([("upload", upload), ("load", load)])
+    results = scheduler.run(["01", "02", "03"])
+
+    assert results == {"01": "01", "03": "03"}
+    assert scheduler.skipped == ["02"]
+    assert sorted(loaded) == ["01", "03"]
+
+
+def test_failed_items_are_reported_and_other_items_go_on():
+    loaded = []
+
+    def transform(key, value):
+        if key == "02":
+            raise ValueError("broken csv")
+        return key
+
+    def load(key, value):
+        loaded.append(key)
+        return value
+
+    scheduler = Stage_scheduler(
+        [("upload", lambda key, value: key), ("transform", transform), ("load", load)]
+    )
+    results = scheduler.run(["01", "02", "03"])
+
+    assert set(results) == {"01", "03"}
+    assert sorted(loaded) == ["01", "03"]
+    assert scheduler.failures == {
+        "02": {"stage": "transform", "error": repr(ValueError("broken csv"))}
+    }
+
+
+def test_stages_overlap():
+    def slow(key, value):
+        time.sleep(0.2)
+        return key
+
+    scheduler = Stage_scheduler([("upload", slow), ("transform", slow), ("load", slow)])
+    scheduler.run(["01", "02", "03", "04"])
+
+    # 4 items in 3 stages take 6 steps when stages overlap, 12 one after another
+    assert scheduler.wall_seconds < 2.0
+
+
+def test_queue_size_must_be_positive():
+    with pytest.raises(ValueError):
+        Stage_scheduler([("upload", lambda key, value: key)], queue_size=0)
+
+
+@pytest.mark.parametrize("staging, pipelined", [(False, False), (True, True)])
+def test_runs_without_local_files_reject_workers(
+    workdir, monkeypatch, staging, pipelined
+):
+    monkeypatch.setenv("STORAGE_BACKEND", "local")
+    monkeypatch.setenv("SQL_BACKEND", "sqlite")
+    main = importlib.import_module("src.main")
+    task = main.Perform_the_assesment_task()
+    task.staging = staging
+    task.pipelined = pipelined
+    task.workers = 2
+
+    run = task.run_pipelined_pipeline if pipelined else task.run_in_memory_pipeline
+    with pytest.raises(ValueError, match="staged pipeline"):
+        run()